@@ -1,42 +1,46 @@
+from metrics import track_stage
+from packing import CONTEXT_BUDGETS, Section, pack_sections
+from prompts import PromptLayout
+from tracing import tracer
+
 system_prompt = "You are an expert in scientific research and meta-analysis."
-metareview_prompt = """\
+metareview_prompt = PromptLayout(
+instructions="""\
 You are an expert in scientific research and meta-analysis.
-Synthesize a comprehensive meta-review of provided reviews pertaining to the following research goal:
-
-Goal: {goal}
-
-Preferences:
-{preferences}
-
-Provided reviews for meta-analysis:
-{reviews}
+Synthesize a comprehensive meta-review of the provided reviews pertaining to the research goal below.
 
 Instructions:
    * Generate a structured meta-analysis report of the provided reviews.
    * Focus on identifying recurring critique points and common issues raised by reviewers.
    * The generated meta-analysis should provide actionable insights for researchers developing future proposals.
-   * Refrain from evaluating individual proposals or reviews; focus on producing a synthesized meta-analysis.
-   
-Response:\
-"""
+   * Refrain from evaluating individual proposals or reviews; focus on producing a synthesized meta-analysis.\
+""",
+shared=[
+    "Goal: {goal}",
+    "Preferences:\n{preferences}",
+],
+item=["Provided reviews for meta-analysis:\n{reviews}"],
+closing="Response:",
+)
 
+@track_stage
 def metareview_generator(llm, goal, preferences, hypotheses):
 
     results = []
+    messages_list = []
 
     for hyp_dict in hypotheses:
 
-        id_ = hyp_dict["id_"]
-
-        review_dict = {
-            "full_review": hyp_dict["full_review"],
-            "deep_review": hyp_dict["deep_review"],
-            "observation_review": hyp_dict["observation_review"],
-            "simulation_review": hyp_dict["simulation_review"],
-            # "tournament_review": hyp_dict["tournament_review"],
-            "ranking_win_results": hyp_dict["ranking_win_results"],
-            "ranking_lose_results": hyp_dict["ranking_lose_results"]
-        }
+        # match transcripts grow with every tournament round : older ones are condensed first, then the reviews are truncated
+        review_dict = pack_sections([
+            Section("full_review", hyp_dict["full_review"], priority=3, min_tokens=1000),
+            Section("deep_review", hyp_dict["deep_review"], priority=2, min_tokens=500),
+            Section("observation_review", hyp_dict["observation_review"], priority=2, min_tokens=500),
+            Section("simulation_review", hyp_dict["simulation_review"], priority=2, min_tokens=500),
+            # Section("tournament_review", hyp_dict["tournament_review"], priority=2),
+            Section("ranking_win_results", hyp_dict["ranking_win_results"], priority=1, strategy="summarize"),
+            Section("ranking_lose_results", hyp_dict["ranking_lose_results"], priority=0, strategy="summarize"),
+        ], CONTEXT_BUDGETS["meta_review"], label=hyp_dict["id_"])
         reviews_parsed = ""
         for review_type, review in review_dict.items():
             reviews_parsed += f"[{review_type}]\n{review}\n\n"
@@ -51,8 +55,15 @@ def metareview_generator(llm, goal, preferences, hypotheses):
                 "content": initial_review_input
             }
         ]
-        llm_result = llm.chat(input_messages) # no return format for now
-        print(f"meta review of id {id_}: {llm_result}\n##########################################") # needs improvement in logging (e.g. save in cache dir)
+        messages_list.append(input_messages)
+
+    llm_results = llm.chat_many(messages_list, hyp_ids=[hyp_dict["id_"] for hyp_dict in hypotheses], batch=True) # no return format for now
+
+    for hyp_dict, llm_result in zip(hypotheses, llm_results):
+
+        id_ = hyp_dict["id_"]
+
+        tracer.event("meta_review", level="debug", hyp_ids=(id_,), text=llm_result)
 
         hyp_dict["meta_review"] = llm_result
         results.append(hyp_dict)
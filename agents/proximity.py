@@ -1,6 +1,9 @@
 import re
 import random
 
+from metrics import track_stage
+from tracing import tracer
+
 system_prompt = "You are an expert tasked with comparing scientific hypotheses based on their relevance and similarity to a given research goal."
 proximity_prompt = """You are given a set of hypotheses related to the following research goal. Your task is to assess the conceptual similarity between each pair of hypotheses, based on how closely they address the same mechanisms, scientific reasoning, or biological pathways relevant to the research goal.
 
@@ -103,6 +106,7 @@ def parse_proximity_graph_with_ids(llm_result, tmp_idx_dict):
 
     return id_pairs
 
+@track_stage
 def calculate_proximity(llm, research_goal, hypotheses):
 
     tmp_idx_dict = dict()
@@ -135,10 +139,11 @@ def calculate_proximity(llm, research_goal, hypotheses):
     id_to_dict = {h["id_"]: h for h in hypotheses}
     final_list = [(id_to_dict[a], id_to_dict[b]) for a, b in real_id_pairs]
     
-    print(f"proximity result: {final_list}\n##########################################")
+    tracer.event("proximity_pairs", pairs=real_id_pairs)
     
     return final_list
 
+@track_stage
 def exclude_same_hyp(llm, research_goal, hypotheses):
 
     tmp_idx_dict = dict()
@@ -171,6 +176,6 @@ def exclude_same_hyp(llm, research_goal, hypotheses):
     id_to_dict = {h["id_"]: h for h in hypotheses}
     final_list = [id_to_dict[id_] for id_ in real_id_pairs]
     
-    print(f"same hypotheses filtering result: {final_list}\n##########################################")
+    tracer.event("distinct_hypotheses", kept=real_id_pairs, removed=len(hypotheses) - len(final_list))
     
     return final_list
\ No newline at end of file
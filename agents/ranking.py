@@ -2,58 +2,45 @@ import re
 import math
 from collections import defaultdict
 import random
+from typing import Literal
+
+from pydantic import BaseModel
+
+from budget import budget
+from metrics import current_hypotheses, track_stage
+from models import run_concurrently, stop_on_pattern
+from prompts import PromptLayout
+from tracing import tracer
 
 system_prompt_hyp_comparison = "You are an expert evaluator tasked with comparing two hypotheses."
 system_prompt_sci_debate = "You are an expert in comparative analysis, simulating a panel of domain experts engaged in a structured discussion to evaluate two competing hypotheses."
 
-hyp_comparison_prompt = """\
+hyp_comparison_prompt = PromptLayout(
+instructions="""\
 Evaluate the two provided hypotheses (hypothesis 1 and hypothesis 2) and determine which one is superior based on the specified attributes: {idea_attributes}.
 Provide a concise rationale for your selection, concluding with the phrase "better idea: <1 or 2>".
 
-Goal: {goal}
-
-Evaluation criteria:
-{preferences}
-
 Each hypothesis includes an independent review. These reviews may contain numerical scores.
-Disregard these scores in your comparative analysis, as they may not be directly comparable across reviews.
-
-Hypothesis 1:
-{hypothesis_1}
-
-Hypothesis 2:
-{hypothesis_2}
- 
-Review of hypothesis 1:
-{review_1}
-
-Review of hypothesis 2:
-{review_2}
-
-Reasoning and conclusion (end with "better hypothesis: <1 or 2>"):\
-"""
-
-hyp_comparison_scientific_debate_prompt = """\
+Disregard these scores in your comparative analysis, as they may not be directly comparable across reviews.\
+""",
+shared=[
+   "Goal: {goal}",
+   "Evaluation criteria:\n{preferences}",
+],
+item=[
+   "Hypothesis 1:\n{hypothesis_1}",
+   "Hypothesis 2:\n{hypothesis_2}",
+   "Review of hypothesis 1:\n{review_1}",
+   "Review of hypothesis 2:\n{review_2}",
+],
+closing="""Reasoning and conclusion (end with "better hypothesis: <1 or 2>"):""",
+)
+
+hyp_comparison_scientific_debate_prompt = PromptLayout(
+instructions="""\
 The objective is to rigorously determine which hypothesis is superior based on a predefined set of attributes and criteria.
 The experts possess no pre-existing biases toward either hypothesis and are solely focused on identifying the optimal choice, given that only one can be implemented.
 
-Goal: {goal}
-
-Criteria for hypothesis superiority:
-{preferences}
-
-Hypothesis 1:
-{hypothesis_1}
-
-Hypothesis 2:
-{hypothesis_2}
-
-Initial review of hypothesis 1:
-{review_1}
-
-Initial review of hypothesis 2:
-{review_2}
-
 Debate procedure:
 
 The discussion will unfold in a series of turns, typically ranging from 3 to 5, with a maximum of 10.
@@ -76,12 +63,27 @@ Termination and judgment:
 Once the discussion has reached a point of sufficient depth (typically 3-5 turns, up to 10 turns) and all relevant questions and concerns have been thoroughly addressed, provide a conclusive judgment.
 This judgment should succinctly state the rationale for the selection.
 Then, indicate the superior hypothesis by writing the phrase "better idea: ", followed by "1" (for hypothesis 1) or "2" (for hypothesis 2).\
-"""
-
-def default_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict_b):
-
-   hypothesis_1 = hyp_dict_a["hyp_full"]
-   hypothesis_2 = hyp_dict_b["hyp_full"]
+""",
+shared=[
+   "Goal: {goal}",
+   "Criteria for hypothesis superiority:\n{preferences}",
+],
+item=[
+   "Hypothesis 1:\n{hypothesis_1}",
+   "Hypothesis 2:\n{hypothesis_2}",
+   "Initial review of hypothesis 1:\n{review_1}",
+   "Initial review of hypothesis 2:\n{review_2}",
+],
+)
+
+class MatchVerdict(BaseModel): # structured-output fallback when the verdict cannot be parsed
+   rationale: str
+   better_hypothesis: Literal[1, 2]
+
+DEFAULT_MATCH_PATTERN = r"better hypothesis\s*:\s*<?\s*([12])\s*>?"
+DEBATE_MATCH_PATTERN = r"better idea\s*:\s*['\"]?([12])['\"]?"
+
+def format_reviews(hyp_dict_a, hyp_dict_b):
 
    review_dict_1 = {
       "full_review": hyp_dict_a["full_review"],
@@ -103,65 +105,73 @@ def default_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict
    for review_type, review in review_dict_2.items():
       review_2 += f"[{review_type}]\n{review}\n\n"
 
-   hyp_comparison_input = hyp_comparison_prompt.format(idea_attributes=research_plan_config["Attributes"], goal=research_goal, preferences=research_plan_config["Preferences"], hypothesis_1=hypothesis_1, hypothesis_2=hypothesis_2, review_1=review_1.strip(), review_2=review_2.strip())
-   input_messages = [
+   return review_1.strip(), review_2.strip()
+
+def default_match_messages(research_goal, research_plan_config, hyp_dict_a, hyp_dict_b):
+
+   hypothesis_1 = hyp_dict_a["hyp_full"]
+   hypothesis_2 = hyp_dict_b["hyp_full"]
+   review_1, review_2 = format_reviews(hyp_dict_a, hyp_dict_b)
+
+   hyp_comparison_input = hyp_comparison_prompt.format(idea_attributes=research_plan_config["Attributes"], goal=research_goal, preferences=research_plan_config["Preferences"], hypothesis_1=hypothesis_1, hypothesis_2=hypothesis_2, review_1=review_1, review_2=review_2)
+   return [
       {"role": "system", "content": system_prompt_hyp_comparison},
       {"role": "user", "content": hyp_comparison_input},
    ]
 
-   # ensure that there is always a winner (temperature=0.2)
-   parsed = False
-   while not parsed:
-      llm_result = llm.chat(input_messages)
-      match = re.search(r"better hypothesis\s*:\s*<?\s*([12])\s*>?", llm_result.strip(), re.IGNORECASE)
-      if match:
-         parsed = True
+def debate_match_messages(research_goal, research_plan_config, hyp_dict_a, hyp_dict_b):
 
-   return llm_result, int(match.group(1))
-
-def debate_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict_b):
-   
    hypothesis_1 = hyp_dict_a["hyp_full"]
    hypothesis_2 = hyp_dict_b["hyp_full"]
+   review_1, review_2 = format_reviews(hyp_dict_a, hyp_dict_b)
 
-   review_dict_1 = {
-      "full_review": hyp_dict_a["full_review"],
-      "deep_review": hyp_dict_a["deep_review"],
-      "observation_review": hyp_dict_a["observation_review"],
-      "simulation_review": hyp_dict_a["simulation_review"],
-   }
-   review_dict_2 = {
-      "full_review": hyp_dict_b["full_review"],
-      "deep_review": hyp_dict_b["deep_review"],
-      "observation_review": hyp_dict_b["observation_review"],
-      "simulation_review": hyp_dict_b["simulation_review"],
-   }
-
-   review_1 = ""
-   for review_type, review in review_dict_1.items():
-      review_1 += f"[{review_type}]\n{review}\n\n"
-   review_2 = ""
-   for review_type, review in review_dict_2.items():
-      review_2 += f"[{review_type}]\n{review}\n\n"
-
-   sci_debate_comparison_input = hyp_comparison_scientific_debate_prompt.format(goal=research_goal, preferences=research_plan_config["Preferences"], hypothesis_1=hypothesis_1, hypothesis_2=hypothesis_2, review_1=review_1.strip(), review_2=review_2.strip())
-   input_messages = [
+   sci_debate_comparison_input = hyp_comparison_scientific_debate_prompt.format(goal=research_goal, preferences=research_plan_config["Preferences"], hypothesis_1=hypothesis_1, hypothesis_2=hypothesis_2, review_1=review_1, review_2=review_2)
+   return [
       {"role": "system", "content": system_prompt_sci_debate},
       {"role": "user", "content": sci_debate_comparison_input},
    ]
 
-   # ensure that there is always a winner (temperature=0.2)
-   parsed = False
-   while not parsed:
-      llm_result = llm.chat(input_messages)
-      match = re.search(r"better idea\s*:\s*['\"]?([12])['\"]?", llm_result.strip(), re.IGNORECASE)
-      if match:
-         parsed = True
+def verdict_parser(pattern):
+   def parse(llm_result):
+      match = re.search(pattern, llm_result.strip(), re.IGNORECASE)
+      return int(match.group(1)) if match else None
+   return parse
+
+def parse_verdict_structured(structured):
+   return structured["better_hypothesis"]
+
+def default_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict_b):
+
+   input_messages = default_match_messages(research_goal, research_plan_config, hyp_dict_a, hyp_dict_b)
+
+   # bounded retries (temperature=0.2), stop generating once the verdict is written; winner_int is None if no verdict
+   return llm.chat_and_parse(input_messages, verdict_parser(DEFAULT_MATCH_PATTERN), stop=stop_on_pattern(DEFAULT_MATCH_PATTERN, re.IGNORECASE), fallback_format=MatchVerdict, fallback_parse=parse_verdict_structured)
+
+def debate_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict_b):
+
+   input_messages = debate_match_messages(research_goal, research_plan_config, hyp_dict_a, hyp_dict_b)
+
+   # bounded retries (temperature=0.2), stop generating once the verdict is written; winner_int is None if no verdict
+   return llm.chat_and_parse(input_messages, verdict_parser(DEBATE_MATCH_PATTERN), stop=stop_on_pattern(DEBATE_MATCH_PATTERN, re.IGNORECASE), fallback_format=MatchVerdict, fallback_parse=parse_verdict_structured)
+
+async def aplay_match(llm, input_messages, pattern, hyp_ids=()):
+
+   # async counterpart of default_match / debate_match, used to run a tournament round concurrently
+   current_hypotheses.set(hyp_ids) # runs as its own task : attribute the match to both hypotheses
+   return await llm.achat_and_parse(input_messages, verdict_parser(pattern), stop=stop_on_pattern(pattern, re.IGNORECASE), fallback_format=MatchVerdict, fallback_parse=parse_verdict_structured)
 
-   return llm_result, int(match.group(1))
+def play_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict_b, use_debate):
 
+   # one match as a standalone call, run by a worker process in distributed mode (job_queue.JobQueue)
+   current_hypotheses.set((hyp_dict_a["id_"], hyp_dict_b["id_"]))
+   if use_debate:
+      return debate_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict_b)
+   return default_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict_b)
 
-def elo_tournament(llm, research_goal, research_plan_config, paired_hypotheses):
+@track_stage
+def elo_tournament(llm, research_goal, research_plan_config, paired_hypotheses, num_rounds=4, checkpoint=None, job_queue=None, initial_scores=None):
+
+   # initial_scores : {id_: Elo} carried over from earlier iterations (IterationController.initial_elo), others start at INITIAL_ELO
 
    INITIAL_ELO = 1200
    K_FACTOR = 32
@@ -182,11 +192,9 @@ def elo_tournament(llm, research_goal, research_plan_config, paired_hypotheses):
       id_score_dict[winner_id] = Ra + K_FACTOR * (1 - Ea)
       id_score_dict[loser_id] = Rb + K_FACTOR * (0 - Eb)
 
-   ## 1. provide initial Elo rating of 1200, and do pairwise comparison
-   for hyp_dict_a, hyp_dict_b in paired_hypotheses:
-
-      match_result, winner_int = default_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict_b)
-
+   def record_match(hyp_dict_a, hyp_dict_b, match_result, winner_int):
+      if winner_int is None: # no verdict within the retry budget : the match does not count
+         return
       if winner_int == 1:
          update_elo(hyp_dict_a["id_"], hyp_dict_b["id_"])
          id_result_win_dict[hyp_dict_a["id_"]].append(match_result)
@@ -196,10 +204,67 @@ def elo_tournament(llm, research_goal, research_plan_config, paired_hypotheses):
          id_result_win_dict[hyp_dict_b["id_"]].append(match_result)
          id_result_lose_dict[hyp_dict_a["id_"]].append(match_result)
 
-   ## 2. sort by score, split to winner-loser group(4-4), and conduct separate match (x4 for now)
-   
-   # needs improvement : add number of iterations as argument 
-   for _ in range(4):
+   # with a checkpoint store, every match outcome is stored as soon as it is played; on resume the recorded
+   # pairings and outcomes are replayed in order, which restores the Elo state, and only missing matches are played
+   async def checkpointed_match(match_key, coroutine):
+      match_outcome = await coroutine
+      checkpoint.put("elo_tournament", match_key, match_outcome)
+      return match_outcome
+
+   def round_pairs(round_key, make_matches):
+      if checkpoint is None:
+         return make_matches()
+      hit, recorded = checkpoint.get("elo_tournament", f"{round_key}/pairs")
+      if hit:
+         return [(id_hyp_dict[id_a], id_hyp_dict[id_b], use_debate) for id_a, id_b, use_debate in recorded]
+      matches = make_matches()
+      checkpoint.put("elo_tournament", f"{round_key}/pairs", [(a["id_"], b["id_"], use_debate) for a, b, use_debate in matches])
+      return matches
+
+   # matches within a round are independent: play them concurrently, then apply Elo updates in match order
+   def play_round(round_key, matches): # matches : [(hyp_dict_a, hyp_dict_b, use_debate), ...]
+      match_outcomes = [None] * len(matches)
+      coroutines, pending = [], []
+      for j, (hyp_dict_a, hyp_dict_b, use_debate) in enumerate(matches):
+         if checkpoint is not None:
+            hit, match_outcomes[j] = checkpoint.get("elo_tournament", f"{round_key}/match{j}")
+            if hit:
+               continue
+         if job_queue is not None: # matches are played by the worker processes
+            pending.append(j)
+            continue
+         if use_debate:
+            input_messages = debate_match_messages(research_goal, research_plan_config, hyp_dict_a, hyp_dict_b)
+            coroutine = aplay_match(llm, input_messages, DEBATE_MATCH_PATTERN, (hyp_dict_a["id_"], hyp_dict_b["id_"]))
+         else:
+            input_messages = default_match_messages(research_goal, research_plan_config, hyp_dict_a, hyp_dict_b)
+            coroutine = aplay_match(llm, input_messages, DEFAULT_MATCH_PATTERN, (hyp_dict_a["id_"], hyp_dict_b["id_"]))
+         coroutines.append(checkpointed_match(f"{round_key}/match{j}", coroutine) if checkpoint is not None else coroutine)
+         pending.append(j)
+
+      if job_queue is not None:
+         remote_outcomes = job_queue.call_many(
+            play_match,
+            [(llm, research_goal, research_plan_config, *matches[j]) for j in pending],
+            [f"elo_tournament/{round_key}/match{j}" for j in pending],
+         )
+         for j, match_outcome in zip(pending, remote_outcomes):
+            if checkpoint is not None:
+               checkpoint.put("elo_tournament", f"{round_key}/match{j}", match_outcome)
+            match_outcomes[j] = match_outcome
+      else:
+         for j, match_outcome in zip(pending, run_concurrently(coroutines)):
+            match_outcomes[j] = match_outcome
+      for (hyp_dict_a, hyp_dict_b, _), (match_result, winner_int) in zip(matches, match_outcomes):
+         record_match(hyp_dict_a, hyp_dict_b, match_result, winner_int)
+
+   ## 1. provide initial Elo rating (1200, or the carried-over one), and do pairwise comparison
+   for id_ in id_hyp_dict: # every hypothesis is ranked, even if none of its matches gets a verdict
+      id_score_dict[id_] = (initial_scores or {}).get(id_, INITIAL_ELO)
+   play_round("round0", [(hyp_dict_a, hyp_dict_b, False) for hyp_dict_a, hyp_dict_b in paired_hypotheses])
+
+   ## 2. sort by score, split to winner-loser group(4-4), and conduct separate match (x num_rounds)
+   def split_matches():
 
       sorted_ids = sorted(id_score_dict.items(), key=lambda x: x[1], reverse=True)
       sorted_hyp_dicts = [id_hyp_dict[id_] for id_, _ in sorted_ids]
@@ -215,37 +280,20 @@ def elo_tournament(llm, research_goal, research_plan_config, paired_hypotheses):
       winner_pairs = [(winners[i], winners[i+1]) for i in range(0, len(winners)-1, 2)]
       loser_pairs = [(losers[i], losers[i+1]) for i in range(0, len(losers)-1, 2)]
       
-      # debate match for top pairs
-      for hyp_dict_a, hyp_dict_b in winner_pairs:
-         
-         match_result, winner_int = debate_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict_b)
-
-         if winner_int == 1:
-            update_elo(hyp_dict_a["id_"], hyp_dict_b["id_"])
-            id_result_win_dict[hyp_dict_a["id_"]].append(match_result)
-            id_result_lose_dict[hyp_dict_b["id_"]].append(match_result)
-         else:
-            update_elo(hyp_dict_b["id_"], hyp_dict_a["id_"])
-            id_result_win_dict[hyp_dict_b["id_"]].append(match_result)
-            id_result_lose_dict[hyp_dict_a["id_"]].append(match_result)
-
-      # default match for low pairs
-      for hyp_dict_a, hyp_dict_b in loser_pairs:
-      
-         match_result, winner_int = default_match(llm, research_goal, research_plan_config, hyp_dict_a, hyp_dict_b)
-
-         if winner_int == 1:
-            update_elo(hyp_dict_a["id_"], hyp_dict_b["id_"])
-            id_result_win_dict[hyp_dict_a["id_"]].append(match_result)
-            id_result_lose_dict[hyp_dict_b["id_"]].append(match_result)
-         else:
-            update_elo(hyp_dict_b["id_"], hyp_dict_a["id_"])
-            id_result_win_dict[hyp_dict_b["id_"]].append(match_result)
-            id_result_lose_dict[hyp_dict_a["id_"]].append(match_result)
+      # debate match for top pairs (unless the run budget is tight), default match for low pairs
+      use_debate = budget.debate_matches()
+      return (
+         [(hyp_dict_a, hyp_dict_b, use_debate) for hyp_dict_a, hyp_dict_b in winner_pairs]
+         + [(hyp_dict_a, hyp_dict_b, False) for hyp_dict_a, hyp_dict_b in loser_pairs]
+      )
+
+   for round_index in range(1, num_rounds + 1):
+      if not budget.tournament_round(round_index, num_rounds): # fewer rounds as the run budget tightens
+         break
+      play_round(f"round{round_index}", round_pairs(f"round{round_index}", split_matches))
    
    ## 3. return 
    hyp_after_ranking = []
-   elo_scores = [score for score in id_score_dict.values()]
    for id_, score in id_score_dict.items():
       hyp_dict = id_hyp_dict[id_]
       
@@ -255,7 +303,7 @@ def elo_tournament(llm, research_goal, research_plan_config, paired_hypotheses):
 
       hyp_after_ranking.append(hyp_dict)
 
-   print(f"elo scores: {elo_scores}\n##########################################") # needs improvement in logging (e.g. save in cache dir)
+   tracer.event("elo_scores", scores=dict(id_score_dict))
 
    ## return top scoring (half) hypotheses
    hyp_after_ranking.sort(key=lambda x: x["elo_score"], reverse=True)
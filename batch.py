@@ -0,0 +1,142 @@
+import io
+import json
+import os
+import threading
+import time
+import uuid
+
+from tracing import tracer
+
+BATCH_ENDPOINT_URL = "/v1/chat/completions"
+
+def build_batch_lines(requests, model_name, temperature):
+    # requests : {custom_id: messages} -> JSONL lines in the OpenAI Batch API input format
+    lines = []
+    for custom_id, messages in requests.items():
+        lines.append(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": BATCH_ENDPOINT_URL,
+            "body": {"model": model_name, "messages": messages, "temperature": temperature},
+        }, ensure_ascii=False))
+    return "\n".join(lines) + "\n"
+
+def parse_batch_output(output_text):
+    # Batch API output JSONL -> {custom_id: response body}, failed requests are left out
+    results = {}
+    for line in output_text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            continue
+        results[record["custom_id"]] = response["body"]
+    return results
+
+class OpenAIBatchEndpoint:
+    def __init__(self, client_fn, completion_window="24h"):
+        self.client_fn = client_fn # batches are owned by one API key, so a single client is used per batch
+        self.completion_window = completion_window
+
+    def submit(self, batch_text):
+        client = self.client_fn()
+        input_file = client.files.create(file=("batch_input.jsonl", io.BytesIO(batch_text.encode("utf-8"))), purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT_URL, completion_window=self.completion_window)
+        return batch.id
+
+    def poll(self, batch_id):
+        # returns (finished, output_text)
+        batch = self.client_fn().batches.retrieve(batch_id)
+        if batch.status in ("validating", "in_progress", "finalizing"):
+            return False, None
+        if batch.status != "completed":
+            raise RuntimeError(f"batch {batch_id} ended with status {batch.status}")
+        if not batch.output_file_id:
+            return True, ""
+        return True, self.client_fn().files.content(batch.output_file_id).text
+
+class LocalBatchEndpoint:
+    # file-based stand-in for the Batch API (offline testing) : every batch is a directory with
+    # input.jsonl / output.jsonl, and requests are answered by responder(body) -> content
+    def __init__(self, batch_dir, responder=None):
+        self.batch_dir = batch_dir
+        self.responder = responder or (lambda body: f"[local batch response to {len(body['messages'])} messages]")
+        os.makedirs(batch_dir, exist_ok=True)
+
+    def submit(self, batch_text):
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(os.path.join(self.batch_dir, batch_id))
+        with open(os.path.join(self.batch_dir, batch_id, "input.jsonl"), "w", encoding="utf-8") as wf:
+            wf.write(batch_text)
+        return batch_id
+
+    def poll(self, batch_id):
+        output_path = os.path.join(self.batch_dir, batch_id, "output.jsonl")
+        if not os.path.exists(output_path):
+            self.process(batch_id)
+        with open(output_path, encoding="utf-8") as rf:
+            return True, rf.read()
+
+    def process(self, batch_id):
+        output_lines = []
+        with open(os.path.join(self.batch_dir, batch_id, "input.jsonl"), encoding="utf-8") as rf:
+            for line in rf:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    content = self.responder(request["body"])
+                    record = {
+                        "custom_id": request["custom_id"],
+                        "response": {"status_code": 200, "body": {"model": request["body"]["model"], "choices": [{"message": {"role": "assistant", "content": content}}]}},
+                        "error": None,
+                    }
+                except Exception as error:
+                    record = {"custom_id": request["custom_id"], "response": None, "error": {"message": str(error)}}
+                output_lines.append(json.dumps(record, ensure_ascii=False))
+
+        tmp_path = os.path.join(self.batch_dir, batch_id, "output.jsonl.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as wf:
+            wf.write("\n".join(output_lines) + "\n")
+        os.replace(tmp_path, os.path.join(self.batch_dir, batch_id, "output.jsonl"))
+
+class BatchRunner:
+    def __init__(self, endpoint, poll_interval=30.0, timeout=24 * 3600):
+        self.endpoint = endpoint
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.batches = self.requests = self.failed = 0
+        self.wait_seconds = 0.0
+
+    def run(self, requests, model_name, temperature):
+        # requests : {custom_id: messages} -> {custom_id: response body}; ids missing from the result failed in the batch
+        if not requests:
+            return {}
+        batch_id = self.endpoint.submit(build_batch_lines(requests, model_name, temperature))
+        tracer.event("batch_submitted", batch_id=batch_id, requests=len(requests))
+
+        start = time.time()
+        while True:
+            finished, output_text = self.endpoint.poll(batch_id)
+            if finished:
+                break
+            if time.time() - start > self.timeout:
+                raise TimeoutError(f"batch {batch_id} did not finish within {self.timeout} seconds")
+            time.sleep(self.poll_interval)
+
+        results = parse_batch_output(output_text)
+        results = {custom_id: results[custom_id] for custom_id in requests if custom_id in results}
+        seconds = time.time() - start
+        tracer.event("batch_finished", batch_id=batch_id, requests=len(requests), failed=len(requests) - len(results), seconds=round(seconds, 3))
+        with self._lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.failed += len(requests) - len(results)
+            self.wait_seconds += seconds
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {"batches": self.batches, "requests": self.requests, "failed": self.failed, "wait_seconds": round(self.wait_seconds, 1)}
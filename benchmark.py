@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+from db_pool import db_pool
+from hypothesis_store import Hypothesis, blob_store
+from fake_llm import LatencyModel, register_fake_llm
+from metrics import peak_rss_mb, usage_tracker
+from models import StructuredLLM, get_llm
+from tracing import tracer
+from trace_viewer import ancestors, load_trace
+from agents.reflection import initial_reviewer, reflection_graph
+from agents.proximity import calculate_proximity
+from agents.ranking import elo_tournament
+from agents.evolution import evolve_hypotheses
+import run_pipeline
+
+# end-to-end and per-agent benchmarks against a synthetic model (fake_llm.FakeModel) and synthetic articles, so a
+# change to run_pipeline.py or agents/ can be timed without the API or the article database. every (case, number of
+# hypotheses) runs in its own process, so peak RSS and the process-wide trackers are per case. results are written
+# as JSON (wall clock, CPU time, peak RSS, LLM calls and tokens, per case and per top-level stage) to diff between commits
+
+RESEARCH_GOAL = "Develop a novel hypothesis for the key factor or process which causes amyotrophic lateral sclerosis (ALS)."
+RESEARCH_PLAN_CONFIG = {
+    "Preferences" : "Focus on providing a novel hypothesis, with detailed explanation of the mechanism of action.",
+    "Attributes" : "novel, feasible",
+    "Constraints" : "should be correct, should be novel."
+}
+NUM_ARTICLES = 20
+CHUNKS_PER_ARTICLE = 3
+
+def synthetic_retriever(text, limit):
+    # stands in for the article database (db_pool.use_retriever) : the same NUM_ARTICLES articles for every query
+    chunks = []
+    for pmid in range(1, NUM_ARTICLES + 1):
+        article = SimpleNamespace(pmid=pmid, title=f"Synthetic article {pmid} on motor neuron degeneration")
+        for chunk_index in range(CHUNKS_PER_ARTICLE):
+            chunk_text = f"{article.title}\n" + " ".join(["Motor neuron loss is associated with protein aggregation and impaired axonal transport."] * 8)
+            chunks.append((1.0 / (pmid + chunk_index), SimpleNamespace(pmid=pmid, chunk_index=chunk_index, chunk_text=chunk_text, article=article)))
+    return chunks[:limit]
+
+def synthetic_hypotheses(num_hypotheses):
+    # hypotheses as they come out of the reflection agent and the tournament, with every key the later agents read
+    review = "The hypothesis is plausible but the proposed mechanism needs more direct evidence. " * 10
+    hypotheses = []
+    for i in range(num_hypotheses):
+        hyp_full = f"Hypothesis {i}: impaired clearance of misfolded protein variant {i} in motor neurons drives ALS progression. " * 5
+        hypotheses.append(Hypothesis({
+            "id_": f"hyp{i}",
+            "hyp_full": hyp_full,
+            "hyp_main": hyp_full[:120],
+            "initial_review": review,
+            "full_review": review,
+            "related_articles_text": "",
+            "deep_review": review,
+            "observation_review": review,
+            "simulation_review": review,
+            "elo_score": 1200 + i,
+            "ranking_win_results": [review],
+            "ranking_lose_results": [review],
+        }))
+    return hypotheses
+
+def benchmark_reflection(llm, args, hypotheses):
+    hypotheses = initial_reviewer(llm, hypotheses)
+    return reflection_graph.run((llm,), hypotheses, max_workers=args.max_concurrency)
+
+def benchmark_proximity(llm, args, hypotheses):
+    return calculate_proximity(llm, RESEARCH_GOAL, hypotheses)
+
+def benchmark_tournament(llm, args, hypotheses):
+    paired_hypotheses = list(zip(hypotheses[0::2], hypotheses[1::2]))
+    return elo_tournament(llm, RESEARCH_GOAL, RESEARCH_PLAN_CONFIG, paired_hypotheses, args.tournament_rounds)
+
+def benchmark_evolution(llm, args, hypotheses):
+    return evolve_hypotheses(llm, RESEARCH_GOAL, RESEARCH_PLAN_CONFIG["Preferences"], hypotheses)
+
+def benchmark_pipeline(args, work_dir, trace_path):
+    # run_pipeline.main end to end, iterations stop at --pipeline_iters
+    goal_path = os.path.join(work_dir, "research_goal.txt")
+    with open(goal_path, "w") as wf:
+        wf.write(RESEARCH_GOAL)
+    pipeline_args = run_pipeline.build_parser().parse_args([
+        "--llm", "fake",
+        "--input_path", goal_path,
+        "--save_path", os.path.join(work_dir, "results"),
+        "--num_init_hyp", str(args.num_hypotheses[0]),
+        "--max_iters", str(args.pipeline_iters),
+        "--max_concurrency", str(args.max_concurrency),
+        "--tournament_rounds", str(args.tournament_rounds),
+        "--trace_path", trace_path,
+        "--blob_store", args.blob_store,
+    ])
+    run_pipeline.main(pipeline_args)
+
+AGENT_CASES = {
+    "reflection": benchmark_reflection,
+    "calculate_proximity": benchmark_proximity,
+    "elo_tournament": benchmark_tournament,
+    "evolve_hypotheses": benchmark_evolution,
+}
+CASES = list(AGENT_CASES) + ["pipeline"]
+
+def merged_seconds(intervals):
+    # wall time covered by possibly overlapping (t0, t1) intervals, e.g. one stage run per hypothesis
+    total, end = 0.0, None
+    for t0, t1 in sorted(intervals):
+        if end is None or t0 > end:
+            total += t1 - t0
+            end = t1
+        elif t1 > end:
+            total += t1 - end
+            end = t1
+    return total
+
+def stage_results(trace_path):
+    # per top-level stage (nested stages are part of their parent), summed over iterations. cpu_seconds is process
+    # CPU while the stage ran, so stages that overlap (reflection tasks of different hypotheses) share it
+    spans, _ = load_trace(trace_path)
+    intervals, stages = defaultdict(list), defaultdict(lambda: {"cpu_seconds": 0.0, "max_rss_mb": 0.0, "runs": 0})
+    for span in spans.values():
+        if span["kind"] != "stage" or any(parent["kind"] == "stage" for parent in ancestors(span, spans)):
+            continue
+        intervals[span["name"]].append((span["t0"], span["t1"]))
+        row = stages[span["name"]]
+        row["runs"] += 1
+        row["cpu_seconds"] += span["a"].get("cpu_seconds", 0.0)
+        row["max_rss_mb"] = max(row["max_rss_mb"], span["a"].get("max_rss_mb", 0.0))
+
+    usage = defaultdict(list)
+    for call in usage_tracker.calls:
+        usage[call["stage"].split("/")[0]].append(call)
+
+    for stage in set(stages) | set(usage):
+        row = stages[stage]
+        row["wall_seconds"] = round(merged_seconds(intervals[stage]), 4)
+        row["cpu_seconds"] = round(row["cpu_seconds"], 4)
+        row.update(llm_totals(usage[stage]))
+    return dict(sorted(stages.items()))
+
+def results_mb(directory):
+    # size of the per-stage result files (JSONL) of a pipeline run
+    if not os.path.isdir(directory):
+        return 0.0
+    return round(sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.endswith(".jsonl")) / 2**20, 3)
+
+def llm_totals(calls):
+    return {
+        "llm_calls": len(calls),
+        "llm_retries": sum(call["retries"] for call in calls),
+        "prompt_tokens": sum(call["prompt_tokens"] for call in calls),
+        "completion_tokens": sum(call["completion_tokens"] for call in calls),
+    }
+
+def run_case(args):
+    # one case in this process : writes its result to args.case_output
+    register_fake_llm(
+        "fake",
+        latency=LatencyModel(args.latency_distribution, args.latency_mean, args.latency_spread, args.latency_per_token),
+        completion_tokens=args.completion_tokens,
+        completion_spread=args.completion_spread,
+        failure_rate=args.failure_rate,
+        max_retries=args.max_retries,
+        seed=args.seed,
+    )
+    db_pool.use_retriever(synthetic_retriever)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        trace_path = os.path.join(work_dir, "trace.jsonl")
+        wall_start, cpu_start = time.monotonic(), time.process_time()
+        if args.run_case == "pipeline":
+            benchmark_pipeline(args, work_dir, trace_path)
+        else:
+            tracer.configure(trace_path, level="info")
+            blob_store.configure(os.path.join(work_dir, "blobs") if args.blob_store == "disk" else None)
+            llm = StructuredLLM(llm_name="fake", temperature=0.2, max_concurrency=args.max_concurrency, max_parse_attempts=args.max_parse_attempts)
+            AGENT_CASES[args.run_case](llm, args, synthetic_hypotheses(args.num_hypotheses[0]))
+            tracer.close()
+        wall_seconds, cpu_seconds = time.monotonic() - wall_start, time.process_time() - cpu_start
+        stages = stage_results(trace_path)
+        result_files_mb = results_mb(os.path.join(work_dir, "results"))
+        blob_stats = blob_store.stats()
+        blob_store.configure() # closes the blob file before the work directory goes
+
+    result = {
+        "case": args.run_case,
+        "num_hypotheses": args.num_hypotheses[0],
+        "wall_seconds": round(wall_seconds, 4),
+        "cpu_seconds": round(cpu_seconds, 4),
+        "max_rss_mb": peak_rss_mb(),
+        "results_mb": result_files_mb,
+        "blobs": blob_stats,
+        **llm_totals(usage_tracker.calls),
+        "fake_failures": get_llm("fake").failures,
+        "stages": stages,
+    }
+    with open(args.case_output, "w") as wf:
+        json.dump(result, wf, indent=2, sort_keys=True)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(args):
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "cases", "num_hypotheses", "run_case", "case_output", "verbose")}
+    results = []
+    print(f"{'case':<24}{'hyps':>6}{'wall s':>10}{'cpu s':>10}{'rss MB':>10}{'calls':>8}{'tokens':>12}")
+    for case in args.cases:
+        for num_hypotheses in args.num_hypotheses:
+            with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as case_file:
+                case_output = case_file.name
+            try:
+                command = [sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--run_case", case, "--num_hypotheses", str(num_hypotheses), "--case_output", case_output]
+                completed = subprocess.run(command, stdout=None if args.verbose else subprocess.DEVNULL)
+                if completed.returncode != 0:
+                    print(f"{case:<24}{num_hypotheses:>6}  failed (exit code {completed.returncode})")
+                    results.append({"case": case, "num_hypotheses": num_hypotheses, "error": completed.returncode})
+                    continue
+                with open(case_output) as rf:
+                    result = json.load(rf)
+            finally:
+                os.remove(case_output)
+            results.append(result)
+            print(f"{case:<24}{num_hypotheses:>6}{result['wall_seconds']:>10.2f}{result['cpu_seconds']:>10.2f}{result['max_rss_mb']:>10.1f}{result['llm_calls']:>8}{result['prompt_tokens'] + result['completion_tokens']:>12}")
+
+    with open(args.output, "w") as wf:
+        json.dump({
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "config": config,
+            "results": results,
+        }, wf, indent=2, sort_keys=True)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=str, nargs="+", default=CASES, choices=CASES)
+    parser.add_argument("--num_hypotheses", type=int, nargs="+", default=[8, 16, 32, 64, 128, 256], help="hypothesis counts to sweep (initial hypotheses for the pipeline case)")
+    parser.add_argument("--output", type=str, default=os.path.join(os.path.abspath(os.path.dirname(__file__)), "benchmarks", "results.json"))
+    parser.add_argument("--latency_distribution", type=str, default="lognormal", choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--latency_mean", type=float, default=0.2, help="seconds per request (median for lognormal)")
+    parser.add_argument("--latency_spread", type=float, default=0.5, help="sigma (lognormal) or relative half-width (uniform) of the latency")
+    parser.add_argument("--latency_per_token", type=float, default=0.0, help="added seconds per completion token")
+    parser.add_argument("--completion_tokens", type=int, default=300, help="median completion tokens per response")
+    parser.add_argument("--completion_spread", type=float, default=0.3, help="lognormal sigma of the completion tokens")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="share of requests that fail transiently and are retried")
+    parser.add_argument("--max_retries", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max_concurrency", type=int, default=8)
+    parser.add_argument("--max_parse_attempts", type=int, default=3)
+    parser.add_argument("--tournament_rounds", type=int, default=4)
+    parser.add_argument("--blob_store", type=str, default="memory", choices=["memory", "disk"], help="--blob_store of the pipeline, also used for the synthetic hypotheses of the agent cases")
+    parser.add_argument("--pipeline_iters", type=int, default=2, help="--max_iters of the pipeline case")
+    parser.add_argument("--verbose", action="store_true", help="show the output of every case")
+    parser.add_argument("--run_case", type=str, default=None, choices=CASES, help=argparse.SUPPRESS) # internal : run one case in this process
+    parser.add_argument("--case_output", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_case:
+        run_case(args)
+    else:
+        main(args)
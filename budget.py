@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+
+from metrics import current_goal, current_iteration, current_stage, usage_tracker
+from tracing import tracer
+
+# (pressure at which the step starts, settings) : pressure is the largest used share of the token, wall-clock and cost
+# budgets. tournament_rounds scales the bracket rounds, debate_turns caps the turns of a generation debate,
+# optional_reviews runs the reviewers marked optional in the reflection graph (deep and simulation reviews)
+DEGRADATION_STEPS = [
+    (0.0, {"tournament_rounds": 1.0, "debate_matches": True, "debate_turns": None, "optional_reviews": True, "evolution_strategies": ("enhancement_grounding", "feasibility_improver", "out_of_box")}),
+    (0.5, {"tournament_rounds": 0.5, "debate_matches": True, "debate_turns": 6, "optional_reviews": True, "evolution_strategies": ("enhancement_grounding", "feasibility_improver", "out_of_box")}),
+    (0.7, {"tournament_rounds": 0.25, "debate_matches": False, "debate_turns": 4, "optional_reviews": False, "evolution_strategies": ("enhancement_grounding", "feasibility_improver", "out_of_box")}),
+    (0.85, {"tournament_rounds": 0.0, "debate_matches": False, "debate_turns": 2, "optional_reviews": False, "evolution_strategies": ("feasibility_improver",)}),
+]
+
+class BudgetController:
+    # run-level budget over every LLM call of the process (all goals, stages and models) : tokens, wall-clock seconds
+    # and USD cost. as the budget tightens, stages degrade step by step (DEGRADATION_STEPS) instead of running to
+    # completion, and the iteration loop stops once it is spent. every cut is written to the decision log.
+    # unconfigured (no limits), it never cuts anything
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure()
+
+    def configure(self, max_tokens=None, max_seconds=None, max_cost=None):
+        with self._lock:
+            self.max_tokens = max_tokens
+            self.max_seconds = max_seconds
+            self.max_cost = max_cost
+            self.start = time.monotonic()
+            self.step = 0
+            self.steps = [] # step changes : when and at which spend
+            self.cuts = [] # one entry per degraded decision
+
+    def usage(self):
+        spent = usage_tracker.spent()
+        return {"tokens": spent["tokens"], "seconds": round(time.monotonic() - self.start, 3), "cost": round(spent["cost"], 6)}
+
+    def pressure(self, usage=None):
+        usage = usage or self.usage()
+        shares = [
+            usage[key] / limit
+            for key, limit in (("tokens", self.max_tokens), ("seconds", self.max_seconds), ("cost", self.max_cost))
+            if limit
+        ]
+        return max(shares, default=0.0)
+
+    def settings(self):
+        # settings of the current step; the step only goes up, since the spend only grows
+        usage = self.usage()
+        pressure = self.pressure(usage)
+        step = max(i for i, (threshold, _) in enumerate(DEGRADATION_STEPS) if pressure >= threshold)
+        with self._lock:
+            if step > self.step:
+                self.step = step
+                self.steps.append({"step": step, "pressure": round(pressure, 3), **usage})
+                tracer.event("budget_step", level="warning", step=step, pressure=round(pressure, 3), **usage)
+            return DEGRADATION_STEPS[self.step][1]
+
+    def exhausted(self):
+        return self.pressure() >= 1.0
+
+    def cut(self, decision, full, applied):
+        # records a degraded decision, with the stage it was taken in
+        entry = {
+            "decision": decision,
+            "full": full,
+            "applied": applied,
+            "goal": current_goal.get(),
+            "iteration": current_iteration.get(),
+            "stage": current_stage.get(),
+            "step": self.step,
+            "seconds": round(time.monotonic() - self.start, 3),
+        }
+        with self._lock:
+            self.cuts.append(entry)
+        tracer.event("budget_cut", decision=decision, full=full, applied=applied)
+
+    ## decisions taken by the agents
+
+    def tournament_round(self, round_index, num_rounds):
+        # whether bracket round round_index (1-based) of num_rounds is played
+        rounds = int(num_rounds * self.settings()["tournament_rounds"])
+        if round_index > rounds:
+            self.cut("tournament_rounds", num_rounds, round_index - 1)
+            return False
+        return True
+
+    def debate_matches(self):
+        # False : winner brackets play default matches instead of debate matches
+        allowed = self.settings()["debate_matches"]
+        if not allowed:
+            self.cut("debate_matches", True, False)
+        return allowed
+
+    def debate_turns(self, max_turns):
+        cap = self.settings()["debate_turns"]
+        if cap is not None and cap < max_turns:
+            self.cut("debate_turns", max_turns, cap)
+            return cap
+        return max_turns
+
+    def skip_optional(self, task_name):
+        # for TaskGraph.run : skip an optional task (its outputs are left empty)
+        skipped = not self.settings()["optional_reviews"]
+        if skipped:
+            self.cut("optional_review", task_name, None)
+        return skipped
+
+    def evolution_strategies(self, strategies):
+        allowed = [strategy for strategy in strategies if strategy in self.settings()["evolution_strategies"]]
+        if len(allowed) < len(strategies):
+            self.cut("evolution_strategies", list(strategies), allowed)
+        return allowed
+
+    def stats(self):
+        with self._lock:
+            cuts = {}
+            for entry in self.cuts:
+                cuts[entry["decision"]] = cuts.get(entry["decision"], 0) + 1
+            return {"step": self.step, "pressure": round(self.pressure(), 3), **self.usage(), "cuts": cuts}
+
+    def save(self, path):
+        with self._lock:
+            steps, cuts = list(self.steps), list(self.cuts)
+        with open(path, "w", encoding="utf-8") as wf:
+            json.dump({
+                "limits": {"tokens": self.max_tokens, "seconds": self.max_seconds, "cost": self.max_cost},
+                "spent": self.usage(),
+                "steps": steps,
+                "cuts": cuts,
+            }, wf, indent=2)
+
+# process-wide budget, configured by run_pipeline (--budget_tokens, --budget_seconds, --budget_cost)
+budget = BudgetController()
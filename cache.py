@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+# on-disk LLM response cache (SQLite), keyed on a hash of model, messages, temperature and return_format schema.
+# identical requests within a run (e.g. explorator sampling one prompt N times, or a retry after a parsing failure)
+# are keyed by their occurrence index, so a re-run replays the same sequence of samples instead of a single response.
+class ResponseCache:
+
+    def __init__(self, path, max_size_mb=1024, max_age_days=None, read_only=False, bypass=False):
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.max_age_seconds = max_age_days * 24 * 3600 if max_age_days else None
+        self.read_only = read_only
+        self.bypass = bypass # skip lookups (still stores new responses unless read_only)
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        self._occurrences = Counter()
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+        self._conn.commit()
+        # running total of the stored sizes, so eviction does not sum the whole table on every write
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def make_key(self, model, messages, temperature, return_format=None):
+        payload = json.dumps({
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "schema": return_format.schema() if return_format else None,
+        }, sort_keys=True, ensure_ascii=False)
+        digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        with self._lock:
+            occurrence = self._occurrences[digest]
+            self._occurrences[digest] += 1
+        return f"{digest}:{occurrence}"
+
+    def get(self, key):
+        # returns (hit, value)
+        if self.bypass:
+            return False, None
+
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at, size FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is not None and self.max_age_seconds and now - row[1] > self.max_age_seconds:
+                if not self.read_only:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                    self._size -= row[2]
+                    self.evictions += 1
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return False, None
+
+            self.hits += 1
+            if not self.read_only:
+                self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+        return True, json.loads(row[0])
+
+    def put(self, key, value):
+        if self.read_only:
+            return
+
+        serialized = json.dumps(value, ensure_ascii=False)
+        size = len(serialized.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            replaced = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, serialized, size, now, now)
+            )
+            self._conn.commit()
+            self._size += size - (replaced[0] if replaced else 0)
+            self.writes += 1
+        self.evict()
+
+    def evict(self):
+        # drop expired entries, then least recently used entries until the cache fits in max_size_bytes
+        if self.read_only:
+            return
+
+        with self._lock:
+            # both steps only read the expired / least recently used rows, through the created_at and accessed_at indexes
+            if self.max_age_seconds:
+                expired_before = time.time() - self.max_age_seconds
+                count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses WHERE created_at < ?", (expired_before,)).fetchone()
+                if count:
+                    self._conn.execute("DELETE FROM responses WHERE created_at < ?", (expired_before,))
+                    self._size -= size
+                    self.evictions += count
+
+            if self.max_size_bytes and self._size > self.max_size_bytes:
+                stale_keys = []
+                cursor = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC")
+                for key, size in cursor:
+                    if self._size <= self.max_size_bytes:
+                        break
+                    stale_keys.append((key,))
+                    self._size -= size
+                cursor.close()
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+                self.evictions += len(stale_keys)
+            self._conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "size_bytes": self._size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,86 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from hypothesis_store import json_default, json_object_hook
+from metrics import current_iteration
+
+# durable record of completed work (SQLite), keyed on (iteration, stage, key). key is a hypothesis id for
+# per-hypothesis stages, "*" for whole-stage outputs, or e.g. "round2/match3" inside the tournament.
+# every entry is committed as soon as the work finishes, so a restart with --resume only redoes what was in flight
+class CheckpointStore:
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.restored = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "iteration INTEGER NOT NULL, stage TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (iteration, stage, key))"
+        )
+        if not resume: # a fresh run starts from an empty store
+            self._conn.execute("DELETE FROM checkpoints")
+        self._conn.commit()
+
+    def get(self, stage, key="*"):
+        # returns (hit, value) for the current iteration
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM checkpoints WHERE iteration = ? AND stage = ? AND key = ?",
+                (current_iteration.get() or 0, stage, key)
+            ).fetchone()
+        if row is None:
+            return False, None
+        self.restored += 1
+        return True, json.loads(row[0], object_hook=json_object_hook)
+
+    def put(self, stage, key, value):
+        serialized = json.dumps(value, ensure_ascii=False, default=json_default)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (iteration, stage, key, value, created_at) VALUES (?, ?, ?, ?, ?)",
+                (current_iteration.get() or 0, stage, key, serialized, time.time())
+            )
+            self._conn.commit()
+            self.writes += 1
+
+    def run_stage(self, stage, fn, *args, key="*"):
+        # whole-stage checkpoint : fn(*args) only runs if its output is not stored yet
+        hit, value = self.get(stage, key)
+        if hit:
+            return value
+        value = fn(*args)
+        self.put(stage, key, value)
+        return value
+
+    def map_hypotheses(self, stage, fn, args, hypotheses):
+        # per-hypothesis checkpoint for stage functions fn(*args, hypotheses) returning one output per input, in order
+        outputs, missing = [None] * len(hypotheses), []
+        for i, hyp_dict in enumerate(hypotheses):
+            hit, value = self.get(stage, hyp_dict["id_"])
+            if hit:
+                outputs[i] = value
+            else:
+                missing.append(i)
+
+        if missing:
+            for i, value in zip(missing, fn(*args, [hypotheses[i] for i in missing])):
+                self.put(stage, hypotheses[i]["id_"], value)
+                outputs[i] = value
+        return outputs
+
+    def stats(self):
+        return {"restored": self.restored, "writes": self.writes}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1 @@
+# makes the repository root importable from tests/ (the modules are top-level scripts, not a package)
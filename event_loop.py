@@ -0,0 +1,73 @@
+import asyncio
+import atexit
+import threading
+
+class EventLoopThread:
+    # one long-lived event loop on a daemon thread, shared by every LLM coroutine of the process. sync callers
+    # (agent stages, task graph nodes, stream producers and consumers) hand their coroutines to it with run, so
+    # the async clients and their HTTP connections, the vLLM micro-batch and the concurrency limiter are shared
+    # by all threads instead of being rebuilt for each asyncio.run
+    def __init__(self, name="llm-loop"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._loop = self._thread = None
+
+    def get(self):
+        with self._lock:
+            if self._loop is None:
+                ready = threading.Event()
+                self._thread = threading.Thread(target=self._serve, args=(ready,), name=self.name, daemon=True)
+                self._thread.start()
+                ready.wait()
+            return self._loop
+
+    def _serve(self, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        ready.set()
+        self._loop.run_forever()
+
+    def in_loop(self):
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def run(self, coroutine):
+        # runs coroutine on the shared loop and blocks until it is done. the task starts in a copy of the caller's
+        # context, so stage / hypothesis attribution and trace spans carry over
+        if self.in_loop():
+            coroutine.close()
+            raise RuntimeError(f"{self.name}: blocking on the shared loop from its own thread would deadlock")
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.get())
+        try:
+            return future.result()
+        except BaseException: # e.g. KeyboardInterrupt in the caller : do not leave the request running
+            future.cancel()
+            raise
+
+    async def submit(self, coroutine):
+        # awaits coroutine on the shared loop from a coroutine running on any loop
+        if self.in_loop():
+            return await coroutine
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.get()))
+
+    def close(self):
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+
+        async def shutdown():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await loop.shutdown_asyncgens()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+# process-wide loop for LLM requests (models.run_concurrently)
+llm_loop = EventLoopThread()
+atexit.register(llm_loop.close)
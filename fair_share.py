@@ -0,0 +1,84 @@
+import asyncio
+import contextlib
+import itertools
+import threading
+from collections import defaultdict, deque
+
+class FairShareScheduler:
+    # process-wide cap on in-flight LLM requests, shared by all research goals of a batch run (run_pipeline --goals_path).
+    # a free slot goes to the waiting goal with the fewest requests in flight (then the longest-waiting request), so a
+    # goal in a wide stage cannot starve the others. goals and stages run their own event loops, so waiters are
+    # (loop, future) pairs woken thread-safely
+    def __init__(self, max_in_flight=100):
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        self.max_in_flight = max_in_flight
+        self.in_flight = defaultdict(int)
+        self.total_in_flight = 0
+        self.waiters = defaultdict(deque) # goal -> deque of (sequence, loop, future)
+        self.granted = defaultdict(int)
+
+    async def acquire(self, goal):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self.waiters[goal].append((next(self._sequence), loop, future))
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                queued = [waiter for waiter in self.waiters[goal] if waiter[2] is future]
+                for waiter in queued:
+                    self.waiters[goal].remove(waiter)
+            if not queued and future.done() and not future.cancelled(): # granted, but cancelled before running
+                self.release(goal)
+            raise
+
+    def try_acquire(self, goal):
+        # takes a slot only if one is free right now and no request is waiting for it (e.g. for a hedged duplicate,
+        # which is pointless once it has to queue); release it with release(goal)
+        with self._lock:
+            if self.total_in_flight >= self.max_in_flight or any(self.waiters.values()):
+                return False
+            self.in_flight[goal] += 1
+            self.total_in_flight += 1
+            self.granted[goal] += 1
+            return True
+
+    def _dispatch(self):
+        # called with the lock held
+        while self.total_in_flight < self.max_in_flight:
+            waiting = [goal for goal, queue in self.waiters.items() if queue]
+            if not waiting:
+                return
+            goal = min(waiting, key=lambda goal: (self.in_flight[goal], self.waiters[goal][0][0]))
+            _, loop, future = self.waiters[goal].popleft()
+            self.in_flight[goal] += 1
+            self.total_in_flight += 1
+            self.granted[goal] += 1
+            loop.call_soon_threadsafe(self._wake, goal, future)
+
+    def _wake(self, goal, future):
+        if future.cancelled(): # the waiter gave up after its slot was granted
+            self.release(goal)
+        else:
+            future.set_result(None)
+
+    def release(self, goal):
+        with self._lock:
+            self.in_flight[goal] -= 1
+            self.total_in_flight -= 1
+            self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, goal):
+        await self.acquire(goal)
+        try:
+            yield
+        finally:
+            self.release(goal)
+
+    def stats(self):
+        with self._lock:
+            return {"max_in_flight": self.max_in_flight, "granted": dict(self.granted)}
@@ -0,0 +1,194 @@
+import asyncio
+import itertools
+import math
+import random
+import re
+import threading
+import time
+
+from pydantic import BaseModel
+
+from gpt import SimpleResponse
+from metrics import usage_tracker
+from rate_limit import estimate_tokens
+
+class FakeLLMError(RuntimeError):
+    pass
+
+class LatencyModel:
+    # seconds per request : "fixed" (always mean), "uniform" (mean +- spread * mean) or "lognormal" (median mean,
+    # sigma spread, i.e. a long tail like real APIs), plus per_token seconds per completion token
+    def __init__(self, distribution="lognormal", mean=1.0, spread=0.5, per_token=0.0):
+        assert distribution in ("fixed", "uniform", "lognormal")
+        self.distribution = distribution
+        self.mean = mean
+        self.spread = spread
+        self.per_token = per_token
+
+    def sample(self, rng, completion_tokens):
+        if self.distribution == "fixed":
+            seconds = self.mean
+        elif self.distribution == "uniform":
+            seconds = self.mean * (1 + rng.uniform(-self.spread, self.spread))
+        else:
+            seconds = self.mean * math.exp(rng.gauss(0, self.spread))
+        return max(0.0, seconds) + self.per_token * completion_tokens
+
+# (prompt marker, answer) : the first marker found in the prompt decides the answer format, so every agent's parser
+# succeeds on the first attempt. order matters : prompts quote earlier outputs, e.g. the search query prompt quotes
+# lost match transcripts ("better hypothesis: 2") and the enhancement prompt quotes the search queries; the default
+# match prompt also mentions "better idea"
+ANSWER_FORMATS = [
+    ("Revised Hypothesis", lambda fake, prompt: f"Revised Hypothesis: {fake.hypothesis()}"),
+    ("Search Queries", lambda fake, prompt: "Search Queries:\n" + "\n".join(fake.hypothesis() for _ in range(2))),
+    ("FINAL HYPOTHESIS ONLY", lambda fake, prompt: f"4. {fake.hypothesis()}"),
+    ("Proximity Graph", lambda fake, prompt: "Proximity Graph:\n" + "\n".join(f"[{a}]-[{b}]" for a, b in fake.pairs(prompt))),
+    ("Final Hypotheses", lambda fake, prompt: "Final Hypotheses: " + ", ".join(f"[{i}]" for i in fake.indices(prompt))),
+    ("better hypothesis", lambda fake, prompt: f"better hypothesis: {fake.choice((1, 2))}"),
+    ("better idea", lambda fake, prompt: f"better idea: {fake.choice((1, 2))}"),
+    ("[HYPOTHESIS:", lambda fake, prompt: f"[HYPOTHESIS: {fake.hypothesis()}]"),
+    ("HYPOTHESIS", lambda fake, prompt: f"HYPOTHESIS {fake.hypothesis()}"),
+]
+FILLER_WORDS = "the proposed mechanism suggests that increased expression of the target pathway modulates downstream signaling in affected cells".split()
+
+class FakeModel:
+    # stand-in for a chat model, for benchmarks and offline runs without an API (benchmark.py) : sleeps a sampled
+    # latency, answers in whatever format the prompt asks for, padded to a sampled number of completion tokens,
+    # fails transiently at failure_rate (retried up to max_retries times, like the API clients) and records usage
+    # like the real backends. seeded, so the same configuration gives the same answers and latencies
+    def __init__(self, model_name="fake", latency=None, completion_tokens=300, completion_spread=0.3, failure_rate=0.0, max_retries=3, seed=0):
+        self.model_name = model_name
+        self.latency = latency or LatencyModel()
+        self.completion_tokens = completion_tokens
+        self.completion_spread = completion_spread
+        self.failure_rate = failure_rate
+        self.max_retries = max_retries
+        self.failures = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._hypotheses = itertools.count(1)
+
+    ## answers
+
+    def choice(self, options):
+        with self._lock:
+            return self._rng.choice(options)
+
+    def hypothesis(self):
+        return f"synthetic hypothesis {next(self._hypotheses)}: " + " ".join(FILLER_WORDS[:12])
+
+    def indices(self, prompt):
+        return [int(i) for i in re.findall(r"^\[(\d+)\]$", prompt, re.MULTILINE)]
+
+    def pairs(self, prompt):
+        indices = self.indices(prompt)
+        with self._lock:
+            self._rng.shuffle(indices)
+        return list(zip(indices[0::2], indices[1::2]))
+
+    def answer(self, messages):
+        prompt = messages[-1]["content"]
+        with self._lock:
+            num_tokens = max(1, int(self.completion_tokens * math.exp(self._rng.gauss(0, self.completion_spread))))
+        filler = " ".join(FILLER_WORDS[i % len(FILLER_WORDS)] for i in range(num_tokens * 3 // 4)) # ~4 characters per token
+        tail = next((answer(self, prompt) for marker, answer in ANSWER_FORMATS if marker in prompt), "hypothesis: neutral")
+        return f"{filler}\n\n{tail}"
+
+    def structured_answer(self, return_format: BaseModel):
+        # one value per field of the JSON schema : strings, lists of strings and enums (e.g. Literal[1, 2])
+        values = {}
+        for name, field in return_format.schema()["properties"].items():
+            if "enum" in field:
+                values[name] = self.choice(field["enum"])
+            elif field.get("type") == "array":
+                values[name] = [self.hypothesis()]
+            elif field.get("type") in ("integer", "number"):
+                values[name] = 1
+            else:
+                values[name] = self.hypothesis()
+        return return_format.parse_obj(values)
+
+    ## latency, failures and usage
+
+    def attempt(self, completion):
+        # -> (seconds to sleep, failed)
+        with self._lock:
+            seconds = self.latency.sample(self._rng, len(completion) // 4)
+            failed = self._rng.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        return seconds, failed
+
+    def record(self, messages, completion, start, retries):
+        usage_tracker.record(self.model_name, estimate_tokens(messages), len(completion) // 4, latency=time.monotonic() - start, retries=retries)
+
+    def invoke(self, messages, temperature, completion=None):
+        completion = completion if completion is not None else self.answer(messages)
+        start = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            seconds, failed = self.attempt(completion)
+            time.sleep(seconds)
+            if not failed:
+                self.record(messages, completion, start, attempt)
+                return SimpleResponse(content=completion)
+        raise FakeLLMError(f"{self.model_name}: request failed {self.max_retries + 1} times")
+
+    async def ainvoke(self, messages, temperature, completion=None):
+        completion = completion if completion is not None else self.answer(messages)
+        start = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            seconds, failed = self.attempt(completion)
+            await asyncio.sleep(seconds)
+            if not failed:
+                self.record(messages, completion, start, attempt)
+                return SimpleResponse(content=completion)
+        raise FakeLLMError(f"{self.model_name}: request failed {self.max_retries + 1} times")
+
+    async def astream(self, messages, temperature, chunk_size=16):
+        # the sampled latency is spread over the chunks; failed attempts fail before the first chunk.
+        # a stream cut by the caller records what was consumed
+        completion = self.answer(messages)
+        start = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            seconds, failed = self.attempt(completion)
+            if not failed:
+                break
+            await asyncio.sleep(seconds)
+        else:
+            raise FakeLLMError(f"{self.model_name}: request failed {self.max_retries + 1} times")
+
+        delay = seconds / max(1, len(completion) // chunk_size)
+        text = ""
+        try:
+            for i in range(0, len(completion), chunk_size):
+                await asyncio.sleep(delay)
+                text += completion[i:i + chunk_size]
+                yield completion[i:i + chunk_size]
+        finally:
+            self.record(messages, text, start, attempt)
+
+    def with_structured_output(self, return_format: BaseModel):
+        return FakeStructuredModel(self, return_format)
+
+class FakeStructuredModel:
+    def __init__(self, fake_model, return_format: BaseModel):
+        self.fake_model = fake_model
+        self.return_format = return_format
+
+    def invoke(self, messages, temperature=0):
+        response = self.fake_model.structured_answer(self.return_format)
+        self.fake_model.invoke(messages, temperature, completion=response.json())
+        return response
+
+    async def ainvoke(self, messages, temperature=0):
+        response = self.fake_model.structured_answer(self.return_format)
+        await self.fake_model.ainvoke(messages, temperature, completion=response.json())
+        return response
+
+def register_fake_llm(llm_name="fake", **config):
+    # registers a FakeModel under llm_name in get_llm (config : FakeModel arguments) and returns that name
+    from models import register_llm
+
+    fake_model = FakeModel(model_name=llm_name, **config)
+    register_llm(llm_name, lambda: fake_model)
+    return llm_name
@@ -1,21 +1,61 @@
-from openai import OpenAI
 from pydantic import BaseModel
-import os
+import time
+from types import SimpleNamespace
+
+from key_pool import key_pool
+from metrics import usage_tracker
+from rate_limit import estimate_tokens
 
 class ModelGPTWrapper:
     def __init__(self, model_name):
-        self.client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])  # Assuming OpenAI API client is initialized this way
+        # requests are spread over every configured API key by the shared key_pool
         self.model_name = model_name
 
     def invoke(self, messages, temperature):
-        response = self.client.chat.completions.create(
+        response = key_pool.call(lambda client: client.chat.completions.create(
             model=self.model_name,
             messages=messages,
             # temperature=0  # Assuming deterministic output
             temperature=temperature
-        )
+        ), messages)
         return SimpleResponse(content=response.choices[0].message.content)
 
+    async def ainvoke(self, messages, temperature):
+        response = await key_pool.acall(lambda client: client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            temperature=temperature
+        ), messages)
+        return SimpleResponse(content=response.choices[0].message.content)
+
+    async def astream(self, messages, temperature):
+        # yields content deltas; closing the generator early closes the HTTP response, which stops generation
+        start = time.monotonic()
+        stream = await key_pool.acall(lambda client: client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        ), messages, record_usage=False)
+
+        model, usage, text = self.model_name, None, ""
+        try:
+            async for chunk in stream:
+                model = chunk.model or model
+                if chunk.usage is not None: # last chunk, only received when the stream is fully consumed
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+            latency = time.monotonic() - start
+            if usage is not None:
+                usage_tracker.record_response(SimpleNamespace(model=model, usage=usage), latency=latency)
+            else: # cut early : estimate what was generated
+                usage_tracker.record(model, estimate_tokens(messages), len(text) // 4, latency=latency)
+
     def with_structured_output(self, return_format: BaseModel):
         return StructuredOutputModel(self, return_format)
 
@@ -31,24 +71,33 @@ class StructuredOutputModel:
         self.model_wrapper = model_wrapper
         self.return_format = return_format
 
-    def invoke(self, messages, temperature):
+    def functions(self):
         # Here, we assume OpenAI function calling or JSON mode is used for structured output.
-        functions = [{
+        return [{
             "name": "structured_response",
             "parameters": self.return_format.schema()
         }]
-        response = self.model_wrapper.client.chat.completions.create(
+
+    def invoke(self, messages, temperature=0):
+        response = key_pool.call(lambda client: client.chat.completions.create(
             model=self.model_wrapper.model_name,
             messages=messages,
-            functions=functions,
+            functions=self.functions(),
             function_call={"name": "structured_response"},
             # temperature=0
             temperature=temperature
-        )
+        ), messages)
         structured_data = response.choices[0].message.function_call.arguments
         # Convert to dict following the pydantic model
         return self.return_format.parse_raw(structured_data)
 
-# Instantiate the specific model wrappers
-modelGPT4o = ModelGPTWrapper("gpt-4o")
-modelGPTo1 = ModelGPTWrapper("gpt-o1")
+    async def ainvoke(self, messages, temperature=0):
+        response = await key_pool.acall(lambda client: client.chat.completions.create(
+            model=self.model_wrapper.model_name,
+            messages=messages,
+            functions=self.functions(),
+            function_call={"name": "structured_response"},
+            temperature=temperature
+        ), messages)
+        structured_data = response.choices[0].message.function_call.arguments
+        return self.return_format.parse_raw(structured_data)
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict, deque
+
+from metrics import current_stage, percentile, usage_tracker
+from rate_limit import estimate_tokens
+
+class HedgePolicy:
+    # tail-latency hedging : once a call has been running longer than the given quantile of recent latencies
+    # in its stage, an identical request is sent; the first successful response wins and the other is cancelled.
+    # at most max_hedge_rate of all requests are hedged. cancelled requests are recorded in the usage metrics
+    # (marked hedge=True) since the provider bills them anyway : their prompt tokens, and as completion tokens the
+    # length of the winning response (the same request, so an upper bound of what the cancelled one generated).
+    # a hedge needs a concurrency slot of its own (try_slot), and is skipped when none is free
+    def __init__(self, quantile=0.95, max_hedge_rate=0.05, min_samples=20, min_delay=2.0, window=200):
+        self._lock = threading.Lock()
+        self.quantile = quantile
+        self.max_hedge_rate = max_hedge_rate
+        self.min_samples = min_samples # no hedging in a stage until its latency distribution is known
+        self.min_delay = min_delay
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+
+        self.num_requests = 0
+        self.num_hedges = 0
+        self.num_hedge_wins = 0
+        self.num_skipped = 0 # no free slot for the hedge
+        self.extra_prompt_tokens = 0
+        self.extra_completion_tokens = 0
+
+    def hedge_delay(self, stage):
+        with self._lock:
+            samples = list(self.latencies[stage])
+        if len(samples) < self.min_samples:
+            return None
+        return max(self.min_delay, percentile(samples, self.quantile))
+
+    def observe(self, stage, latency):
+        with self._lock:
+            self.latencies[stage].append(latency)
+
+    def acquire_hedge(self):
+        with self._lock:
+            if self.num_hedges + 1 > self.max_hedge_rate * self.num_requests:
+                return False
+            self.num_hedges += 1
+            return True
+
+    async def run(self, request_fn, messages, model_name, try_slot=None):
+        # request_fn() -> coroutine performing the request; called a second time for the hedge.
+        # try_slot() -> release function, or None when no slot is free (see StructuredLLM.try_slot)
+        stage = current_stage.get()
+        with self._lock:
+            self.num_requests += 1
+        start = time.monotonic()
+        primary = asyncio.ensure_future(request_fn())
+        delay = self.hedge_delay(stage)
+        if delay is not None:
+            try:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+            except asyncio.CancelledError: # asyncio.wait leaves the awaited task running
+                primary.cancel()
+                raise
+            release_slot = self.hedge_slot(try_slot) if not done else None
+            if release_slot is not None:
+                hedge = asyncio.ensure_future(request_fn())
+                hedge.add_done_callback(lambda _: release_slot()) # held until the hedge has finished or been cancelled
+                winner = await self.first_success(primary, hedge, messages, model_name)
+                self.observe(stage, time.monotonic() - start)
+                return winner.result()
+
+        result = await primary
+        self.observe(stage, time.monotonic() - start)
+        return result
+
+    def hedge_slot(self, try_slot):
+        # -> release function of the hedge's slot, or None if the request is not hedged
+        release_slot = try_slot() if try_slot is not None else (lambda: None)
+        if release_slot is None:
+            with self._lock:
+                self.num_skipped += 1
+            return None
+        if not self.acquire_hedge():
+            release_slot()
+            return None
+        return release_slot
+
+    async def first_success(self, primary, hedge, messages, model_name):
+        pending, winner = {primary, hedge}, None
+        try:
+            while winner is None and pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.cancelled() and task.exception() is None:
+                        winner = task
+                        break
+        finally:
+            completion_tokens = len(str(winner.result())) // 4 if winner is not None else 0
+            for task in pending:
+                task.cancel()
+                usage_tracker.record(model_name, estimate_tokens(messages), completion_tokens, hedge=True)
+                with self._lock:
+                    self.extra_prompt_tokens += estimate_tokens(messages)
+                    self.extra_completion_tokens += completion_tokens
+        if winner is None: # both failed : surface the primary's error
+            return primary
+        if winner is hedge:
+            with self._lock:
+                self.num_hedge_wins += 1
+        return winner
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.num_requests,
+                "hedges": self.num_hedges,
+                "hedge_rate": round(self.num_hedges / self.num_requests, 4) if self.num_requests else 0.0,
+                "hedge_wins": self.num_hedge_wins,
+                "skipped_no_slot": self.num_skipped,
+                "extra_prompt_tokens": self.extra_prompt_tokens,
+                "extra_completion_tokens": self.extra_completion_tokens,
+            }
@@ -0,0 +1,44 @@
+import asyncio
+import threading
+
+import httpx
+
+class HTTPPool:
+    # one keep-alive connection pool shared by every OpenAI client (all models, all API keys),
+    # so TLS handshakes are reused across StructuredLLM instances
+    def __init__(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0, timeout=600.0):
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = self._async_loop = None
+        self.configure(max_connections, max_keepalive_connections, keepalive_expiry, timeout)
+
+    def configure(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0, timeout=600.0):
+        with self._lock:
+            self.limits = httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            )
+            self.timeout = httpx.Timeout(timeout, connect=10.0)
+            self._client = None
+            self._async_client = self._async_loop = None
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(limits=self.limits, timeout=self.timeout)
+            return self._client
+
+    def async_client(self):
+        # httpx.AsyncClient is bound to the event loop it is used in. LLM requests all run on event_loop.llm_loop, so
+        # this is created once; a caller on another loop replaces it, and the previous client is closed on its loop
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._async_loop is not loop:
+                previous, previous_loop = self._async_client, self._async_loop
+                self._async_client, self._async_loop = httpx.AsyncClient(limits=self.limits, timeout=self.timeout), loop
+                if previous is not None and not previous_loop.is_closed():
+                    previous_loop.call_soon_threadsafe(previous_loop.create_task, previous.aclose())
+            return self._async_client
+
+http_pool = HTTPPool()
@@ -0,0 +1,251 @@
+import hashlib
+import mmap
+import os
+import threading
+from collections.abc import MutableMapping
+
+# large text fields of a hypothesis, kept in the blob store (strings, and lists of strings for the match transcripts)
+TEXT_FIELDS = ("hyp_full", "hyp_main", "initial_review", "full_review", "related_articles_text", "deep_review", "observation_review", "simulation_review", "meta_review")
+TEXT_LIST_FIELDS = ("ranking_win_results", "ranking_lose_results")
+FIELDS = ("id_", "prev_id", *TEXT_FIELDS, "elo_score", *TEXT_LIST_FIELDS)
+MIN_BLOB_CHARS = 256 # shorter texts stay inline
+
+BLOB_FILE = "blobs.bin"
+
+class BlobRef(str):
+    # key of a text in the blob store, as held by a Hypothesis instead of the text
+    __slots__ = ()
+
+class BlobStore:
+    # content-addressed text store (sha256 of the text -> text) shared by every hypothesis of the process; identical
+    # texts (a match transcript in the winner's and the loser's results, hyp_main == hyp_full) are stored once.
+    # in memory by default, where texts are reference-counted by the hypotheses holding them and dropped with the last
+    # one (filtered out, replaced by evolution, finished goals of a batch run), so memory follows the live hypotheses.
+    # with a directory, texts are appended to <directory>/blobs.bin and read back through mmap, so they stay on disk
+    # until a prompt needs them, and the keys in result files and checkpoints stay resolvable after the run (and on
+    # --resume)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = self._map = None
+        self.configure()
+
+    def configure(self, directory=None):
+        with self._lock:
+            self._close()
+            self.directory = directory
+            self._texts = {} # in memory : key -> text
+            self._counts = {} # in memory : key -> references held
+            self._chars = self._peak_chars = 0
+            self._offsets = {} # on disk : key -> (offset, length)
+            self._size = 0
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                self._file = open(os.path.join(directory, BLOB_FILE), "a+b")
+                self._load_index()
+
+    @property
+    def persistent(self):
+        return self.directory is not None
+
+    def _load_index(self):
+        # records are "<key> <length>\n<utf-8 text>"; a record cut short by a crash is dropped and overwritten
+        self._file.seek(0)
+        offset = 0
+        while True:
+            header = self._file.readline()
+            if not header.endswith(b"\n"):
+                break
+            key, length = header.decode("ascii").split()
+            length = int(length)
+            if len(self._file.read(length)) < length:
+                break
+            offset += len(header)
+            self._offsets[key] = (offset, length)
+            offset += length
+        self._file.truncate(offset)
+        self._size = offset
+
+    def put(self, text):
+        data = text.encode("utf-8")
+        key = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if self.directory is None:
+                if key not in self._texts:
+                    self._texts[key] = text
+                    self._chars += len(text)
+                    self._peak_chars = max(self._peak_chars, self._chars)
+                self._counts[key] = self._counts.get(key, 0) + 1
+            elif key not in self._offsets:
+                header = f"{key} {len(data)}\n".encode("ascii")
+                self._file.write(header + data)
+                self._file.flush()
+                self._offsets[key] = (self._size + len(header), len(data))
+                self._size += len(header) + len(data)
+        return BlobRef(key)
+
+    def get(self, key):
+        with self._lock:
+            if self.directory is None:
+                return self._texts[key]
+            offset, length = self._offsets[key]
+            if self._map is None or len(self._map) < offset + length: # the file grew since it was mapped
+                if self._map is not None:
+                    self._map.close()
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map[offset:offset + length].decode("utf-8")
+
+    def retain(self, key):
+        with self._lock:
+            if key in self._counts:
+                self._counts[key] += 1
+
+    def release(self, value):
+        # drops the references of a held value (see offload); in memory, a text without references is freed
+        if isinstance(value, tuple):
+            for item in value:
+                self.release(item)
+        elif isinstance(value, BlobRef):
+            with self._lock:
+                count = self._counts.get(value, 0)
+                if count == 1:
+                    del self._counts[value]
+                    self._chars -= len(self._texts.pop(value))
+                elif count > 1:
+                    self._counts[value] = count - 1
+
+    ## field values
+
+    def offload(self, value):
+        # text (or list of texts) -> what a Hypothesis holds : long texts become blob keys, each holding one
+        # reference until released. {"$blob": key} is the reference written by to_json
+        if isinstance(value, dict) and "$blob" in value:
+            value = BlobRef(value["$blob"])
+        if isinstance(value, BlobRef):
+            self.retain(value)
+            return value
+        if isinstance(value, str):
+            return self.put(value) if len(value) >= MIN_BLOB_CHARS else value
+        if isinstance(value, (list, tuple)):
+            return tuple(self.offload(item) for item in value)
+        return value
+
+    def materialize(self, value):
+        if isinstance(value, BlobRef):
+            return self.get(value)
+        if isinstance(value, tuple):
+            return tuple(self.materialize(item) for item in value)
+        return value
+
+    def reference(self, value):
+        # JSON form of a held value : blob keys as {"$blob": key} when the store outlives the process, texts otherwise
+        if isinstance(value, BlobRef):
+            return {"$blob": str(value)} if self.persistent else self.get(value)
+        if isinstance(value, tuple):
+            return [self.reference(item) for item in value]
+        return value
+
+    def stats(self):
+        with self._lock:
+            if self.directory is None:
+                return {"blobs": len(self._texts), "chars": self._chars, "peak_chars": self._peak_chars}
+            return {"blobs": len(self._offsets), "bytes": self._size}
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+        if self._file is not None:
+            self._file.close()
+        self._file = self._map = None
+
+# process-wide store, configured by run_pipeline (--blob_store, --blob_dir)
+blob_store = BlobStore()
+
+class Hypothesis(MutableMapping):
+    # one hypothesis, read and written like the dicts the agents pass around (hyp_dict["hyp_full"], .get, .update).
+    # TEXT_FIELDS and TEXT_LIST_FIELDS are held as blob keys and materialized on every read, so the hypothesis
+    # lists of a run, its checkpoints and its result files hold keys instead of copies of the texts. list fields
+    # read back as tuples : a materialized copy cannot be changed in place, assign a new list instead.
+    # keys outside FIELDS go to extra
+    __slots__ = (*FIELDS, "extra")
+
+    def __init__(self, *args, **fields):
+        self.extra = {}
+        self.update(*args, **fields)
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            return self.extra[key]
+        try:
+            return blob_store.materialize(getattr(self, key))
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key in TEXT_FIELDS or key in TEXT_LIST_FIELDS:
+            previous = getattr(self, key, None)
+            setattr(self, key, blob_store.offload(value))
+            blob_store.release(previous)
+        elif key in FIELDS:
+            setattr(self, key, value)
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in FIELDS:
+            del self.extra[key]
+            return
+        try:
+            value = getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+        delattr(self, key)
+        blob_store.release(value)
+
+    def __del__(self):
+        for key in (*TEXT_FIELDS, *TEXT_LIST_FIELDS):
+            if hasattr(self, key):
+                blob_store.release(getattr(self, key))
+
+    def __contains__(self, key):
+        return hasattr(self, key) if key in FIELDS else key in self.extra
+
+    def __iter__(self):
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Hypothesis(id_={getattr(self, 'id_', None)!r}, keys={list(self)})"
+
+    def to_dict(self):
+        # every text materialized, e.g. for job queue workers that cannot read this process's blob store
+        return {key: self[key] for key in self}
+
+    def to_json(self):
+        # record for result files and checkpoints (blob keys as {"$blob": key} when the store is on disk);
+        # Hypothesis(record) reads it back
+        record = {key: blob_store.reference(getattr(self, key)) for key in FIELDS if hasattr(self, key)}
+        record.update(self.extra)
+        return record
+
+def json_default(obj):
+    # json.dumps(..., default=json_default)
+    if isinstance(obj, Hypothesis):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def json_default_inline(obj):
+    # json.dumps(..., default=json_default_inline) : the texts themselves, for readers in other processes
+    if isinstance(obj, Hypothesis):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def json_object_hook(record):
+    # json.loads(..., object_hook=json_object_hook) : hypothesis records come back as Hypothesis
+    if "id_" in record and "hyp_full" in record:
+        return Hypothesis(record)
+    return record
@@ -0,0 +1,81 @@
+import json
+import time
+
+from budget import budget
+from metrics import current_goal, usage_tracker
+
+class IterationController:
+    # decides after every tournament whether another generate -> review -> rank -> evolve iteration is worth its cost.
+    # the run stops at max_iters, once a wall-clock (seconds), token or run budget is spent, or once the ranking converges :
+    # the top_k hypotheses come from the same lineages as in the previous iteration (debated / evolved hypotheses
+    # are traced back to their first ancestor through "prev_id"), or the best Elo score improved by less than min_improvement.
+    # Elo scores carry over between tournaments (initial_elo), so successive best scores are on the same scale
+    def __init__(self, max_iters=2, max_seconds=None, max_tokens=None, top_k=None, min_improvement=None):
+        self.max_iters = max_iters
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.top_k = top_k
+        self.min_improvement = min_improvement
+        self.start = time.monotonic()
+        self.roots = {} # hypothesis id -> id of its first ancestor
+        self.elo = {} # hypothesis id -> Elo score after its last tournament
+        self.history = [] # one entry per iteration
+
+    def root(self, hyp_dict):
+        prev_id = hyp_dict.get("prev_id")
+        root = self.roots.get(prev_id, prev_id) if prev_id else hyp_dict["id_"]
+        self.roots[hyp_dict["id_"]] = root
+        return root
+
+    def initial_elo(self, hypotheses):
+        # {id_: Elo} to seed the next tournament with : a hypothesis keeps its score, a debated or evolved one starts
+        # from its parent's; hypotheses without either start at the tournament's initial score
+        scores = {}
+        for hyp_dict in hypotheses:
+            score = self.elo.get(hyp_dict["id_"], self.elo.get(hyp_dict.get("prev_id")))
+            if score is not None:
+                scores[hyp_dict["id_"]] = score
+        return scores
+
+    def observe(self, iteration, ranked_hypotheses):
+        # ranked_hypotheses : tournament output (with "elo_score"). returns the reason to stop, or None to go on
+        ranked = sorted(ranked_hypotheses, key=lambda hyp_dict: hyp_dict["elo_score"], reverse=True)
+        roots = [self.root(hyp_dict) for hyp_dict in ranked]
+        self.elo.update((hyp_dict["id_"], hyp_dict["elo_score"]) for hyp_dict in ranked)
+        top_roots = sorted(set(roots[:self.top_k or len(roots)]))
+        best_elo = ranked[0]["elo_score"] if ranked else None
+        goal = current_goal.get() # goals of a batch run have separate budgets
+        tokens = usage_tracker.per_goal().get(goal, {}) if goal is not None else usage_tracker.totals()
+        tokens = tokens.get("prompt_tokens", 0) + tokens.get("completion_tokens", 0)
+        elapsed = time.monotonic() - self.start
+
+        previous = self.history[-1] if self.history else None
+        if iteration >= self.max_iters:
+            stop_reason = "max_iters"
+        elif self.max_seconds is not None and elapsed >= self.max_seconds:
+            stop_reason = "time_budget"
+        elif self.max_tokens is not None and tokens >= self.max_tokens:
+            stop_reason = "token_budget"
+        elif budget.exhausted(): # run-level budget of all goals (--budget_tokens, --budget_seconds, --budget_cost)
+            stop_reason = "run_budget"
+        elif previous and self.top_k and top_roots == previous["top_roots"]:
+            stop_reason = "top_k_stable"
+        elif previous and self.min_improvement is not None and None not in (best_elo, previous["best_elo"]) and best_elo - previous["best_elo"] < self.min_improvement:
+            stop_reason = "no_improvement"
+        else:
+            stop_reason = None
+
+        self.history.append({
+            "iteration": iteration,
+            "num_hypotheses": len(ranked),
+            "best_elo": best_elo,
+            "top_roots": top_roots,
+            "tokens": tokens,
+            "seconds": round(elapsed, 3),
+            "stop_reason": stop_reason,
+        })
+        return stop_reason
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as wf:
+            json.dump(self.history, wf, indent=2)
@@ -0,0 +1,236 @@
+import contextvars
+import importlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+from hypothesis_store import json_default_inline, json_object_hook
+from metrics import current_agent, current_goal, current_iteration, current_stage
+from tracing import tracer
+
+# durable queue of stage calls (SQLite in WAL mode) between one coordinator process and any number of worker
+# processes (run_pipeline --worker) on machines that share the file. a job is one call fn(*args) of a module-level
+# agent function; StructuredLLM arguments travel as their role ("llm", "llm_review", ...) and every worker binds its own.
+# workers lease the jobs they claim and keep extending the lease while they run, so the job of a crashed worker
+# goes back to the queue once its lease expires
+class JobQueue:
+
+    def __init__(self, path, llms=None, lease_seconds=300, max_attempts=3, poll_interval=0.5):
+        self.path = path
+        self.llms = llms or {} # role -> StructuredLLM
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.submitted = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None) # transactions are explicit
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, module TEXT NOT NULL, name TEXT NOT NULL, "
+            "payload TEXT NOT NULL, status TEXT NOT NULL, worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+    def clear(self):
+        # a fresh coordinator run starts from an empty queue
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs")
+
+    def encode_args(self, args):
+        encoded = []
+        for arg in args:
+            role = next((role for role, llm in self.llms.items() if arg is llm), None)
+            encoded.append({"__llm__": role} if role is not None else arg)
+        return encoded
+
+    def decode_args(self, args):
+        return [self.llms[arg["__llm__"]] if isinstance(arg, dict) and "__llm__" in arg else arg for arg in args]
+
+    ## coordinator side
+
+    def submit(self, fn, args, key):
+        # key identifies the call within the current goal and iteration (e.g. "full_reviewer/<hyp id>"); submitting
+        # an existing key returns the existing job, so a resumed coordinator picks up work that is queued or done
+        key = f"{current_goal.get()}/{current_iteration.get()}/{key}"
+        payload = json.dumps({
+            "args": self.encode_args(args),
+            "context": {"goal": current_goal.get(), "iteration": current_iteration.get(), "stage": current_stage.get(), "agent": current_agent.get()},
+        }, ensure_ascii=False, default=json_default_inline)
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO jobs (key, module, name, payload, status, created_at, updated_at) VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (key, fn.__module__, fn.__name__, payload, now, now)
+            )
+            if cursor.rowcount:
+                self.submitted += 1
+            else:
+                self.reused += 1
+            return self._conn.execute("SELECT id FROM jobs WHERE key = ?", (key,)).fetchone()[0]
+
+    def wait(self, job_ids):
+        # results in the order of job_ids; raises once a job has failed on every attempt
+        results, pending = {}, set(job_ids)
+        while pending:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT id, status, result, error FROM jobs WHERE id IN ({','.join('?' * len(pending))}) AND status IN ('done', 'failed')",
+                    tuple(pending)
+                ).fetchall()
+            for job_id, status, result, error in rows:
+                if status == "failed":
+                    raise RuntimeError(f"job {job_id} failed after {self.max_attempts} attempts:\n{error}")
+                results[job_id] = json.loads(result, object_hook=json_object_hook)
+                pending.discard(job_id)
+            if pending:
+                time.sleep(self.poll_interval)
+        return [results[job_id] for job_id in job_ids]
+
+    def call_many(self, fn, args_list, keys):
+        return self.wait([self.submit(fn, args, key) for args, key in zip(args_list, keys)])
+
+    def remote(self, fn):
+        # drop-in for a stage function fn(*args, hypotheses) : one job per hypothesis, outputs concatenated in order
+        def run(*args):
+            *leading, hypotheses = args
+            outputs = self.call_many(fn, [(*leading, [hyp_dict]) for hyp_dict in hypotheses], [f"{fn.__name__}/{hyp_dict['id_']}" for hyp_dict in hypotheses])
+            return [hyp_dict for output in outputs for hyp_dict in output]
+        return run
+
+    ## worker side
+
+    def claim(self, worker_id):
+        # returns (job_id, module, name, payload) or None
+        while True:
+            now = time.time()
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self._conn.execute(
+                        "SELECT id, module, name, payload, attempts FROM jobs "
+                        "WHERE status = 'queued' OR (status = 'running' AND lease_until < ?) ORDER BY id LIMIT 1",
+                        (now,)
+                    ).fetchone()
+                    if row is None:
+                        self._conn.execute("COMMIT")
+                        return None
+                    job_id, module, name, payload, attempts = row
+                    if attempts >= self.max_attempts: # its workers kept dying
+                        self._conn.execute(
+                            "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                            (f"lease expired on attempt {attempts}", now, job_id)
+                        )
+                        self._conn.execute("COMMIT")
+                        continue
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (worker_id, now + self.lease_seconds, now, job_id)
+                    )
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            return job_id, module, name, payload
+
+    def extend(self, job_id, worker_id):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, job_id, worker_id)
+            )
+
+    def complete(self, job_id, worker_id, result):
+        # ignored if the lease was lost and the job handed to another worker
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, lease_until = NULL, updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (json.dumps(result, ensure_ascii=False, default=json_default_inline), time.time(), job_id, worker_id)
+            )
+
+    def fail(self, job_id, worker_id, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, error = ?, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (self.max_attempts, error, time.time(), job_id, worker_id)
+            )
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {"submitted": self.submitted, "reused": self.reused, **counts}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class JobWorker:
+    # claims and runs jobs with `threads` jobs in flight (each stage call fans out its own LLM requests),
+    # until the queue has been empty for idle_timeout seconds (forever if None)
+    def __init__(self, queue, worker_id=None, threads=4, idle_timeout=None):
+        self.queue = queue
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.threads = threads
+        self.idle_timeout = idle_timeout
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def run(self):
+        threads = [threading.Thread(target=contextvars.copy_context().run, args=(self.loop, f"{self.worker_id}/{i}")) for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def loop(self, worker_id):
+        idle_since = time.monotonic()
+        while self.idle_timeout is None or time.monotonic() - idle_since < self.idle_timeout:
+            job = self.queue.claim(worker_id)
+            if job is None:
+                time.sleep(self.queue.poll_interval)
+                continue
+            contextvars.copy_context().run(self.execute, worker_id, *job)
+            idle_since = time.monotonic()
+
+    def execute(self, worker_id, job_id, module, name, payload):
+        payload = json.loads(payload, object_hook=json_object_hook)
+        context = payload["context"]
+        current_goal.set(context["goal"])
+        current_iteration.set(context["iteration"])
+        current_stage.set(context["stage"])
+        current_agent.set(context["agent"])
+
+        done = threading.Event()
+        def keep_lease():
+            while not done.wait(self.queue.lease_seconds / 3):
+                self.queue.extend(job_id, worker_id)
+        heartbeat = threading.Thread(target=keep_lease, daemon=True)
+        heartbeat.start()
+        try:
+            fn = getattr(importlib.import_module(module), name)
+            with tracer.span("job", name, job_id=job_id, goal=context["goal"], iteration=context["iteration"]):
+                result = fn(*self.queue.decode_args(payload["args"]))
+        except Exception:
+            self.queue.fail(job_id, worker_id, traceback.format_exc())
+            with self._lock:
+                self.failed += 1
+        else:
+            self.queue.complete(job_id, worker_id, result)
+            with self._lock:
+                self.completed += 1
+        finally:
+            done.set()
+
+    def stats(self):
+        return {"worker": self.worker_id, "completed": self.completed, "failed": self.failed}
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import threading
+import time
+
+from http_pool import http_pool
+from metrics import usage_tracker
+from rate_limit import RateLimiter, estimate_tokens
+
+class APIKey:
+    def __init__(self, api_key, requests_per_minute=None, tokens_per_minute=None):
+        self.api_key = api_key
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute) # per-key rate-limit state
+        self.in_flight = 0
+        self.num_failures = 0
+        self.disabled_until = 0.0 # set for keys that fail authentication
+        self._client = None
+        self._async_client = self._async_loop = None
+
+    @property
+    def name(self):
+        return f"...{self.api_key[-4:]}"
+
+    def available_at(self):
+        return max(self.limiter.blocked_until, self.disabled_until)
+
+    def client(self):
+        # created on first use; retries are handled by KeyPool (429-aware backoff and key rotation), not by the client
+        if self._client is None:
+            from openai import OpenAI # imported on first use, it is slow to import
+            self._client = OpenAI(api_key=self.api_key, max_retries=0, http_client=http_pool.client())
+        return self._client
+
+    def async_client(self):
+        # bound to one event loop like the shared httpx client it wraps (see HTTPPool.async_client)
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(api_key=self.api_key, max_retries=0, http_client=http_pool.async_client())
+            self._async_loop = loop
+        return self._async_client
+
+class KeyPool:
+    def __init__(self, api_keys=None, requests_per_minute=None, tokens_per_minute=None, max_retries=6, disable_seconds=600):
+        self._lock = threading.Lock()
+        self.max_retries = max_retries
+        self.disable_seconds = disable_seconds
+        self.keys = []
+        if api_keys:
+            self.configure(api_keys, requests_per_minute, tokens_per_minute)
+
+    def configure(self, api_keys, requests_per_minute=None, tokens_per_minute=None):
+        # rpm / tpm budgets apply to each key, so aggregate throughput grows with the number of keys
+        with self._lock:
+            self.keys = [APIKey(api_key, requests_per_minute, tokens_per_minute) for api_key in api_keys if api_key]
+
+    def primary_client(self):
+        # for requests that must stay on one key (e.g. batch jobs)
+        key, _ = self.acquire()
+        self.release(key)
+        return key.client()
+
+    def acquire(self):
+        # pick the key that is available soonest, preferring the least loaded one; returns (key, seconds to wait)
+        with self._lock:
+            if not self.keys: # not configured : fall back to the single exported key
+                self.keys = [APIKey(os.environ["OPENAI_API_KEY"])]
+            now = time.monotonic()
+            key = min(self.keys, key=lambda k: (max(now, k.available_at()), k.in_flight))
+            key.in_flight += 1
+        return key, max(0.0, key.available_at() - now)
+
+    def release(self, key, error=None, attempt=0):
+        # returns the seconds to back off before retrying the failed request, or None if it should not be retried
+        with self._lock:
+            key.in_flight -= 1
+            if error is None:
+                key.num_failures = 0
+                return None
+            key.num_failures += 1
+
+        from openai import AuthenticationError, PermissionDeniedError
+        if isinstance(error, (AuthenticationError, PermissionDeniedError)):
+            # take the key out of rotation for a while; only retry if another key can serve the request
+            with self._lock:
+                key.disabled_until = time.monotonic() + self.disable_seconds
+                has_other_keys = any(k.disabled_until <= time.monotonic() for k in self.keys)
+            return 0.0 if has_other_keys else None
+
+        if not key.limiter.is_retryable(error):
+            return None
+        delay = key.limiter.on_retryable_error(error, attempt)
+        # a 429 cools this key down for every caller (waited on in acquire, other keys stay in rotation);
+        # 5xx errors and timeouts back off this request only
+        return 0.0 if getattr(error, "status_code", None) == 429 else delay
+
+    def call(self, request_fn, messages):
+        # request_fn(client) -> response
+        estimated_tokens = estimate_tokens(messages)
+        start, queue_wait = time.monotonic(), 0.0
+        for attempt in range(self.max_retries + 1):
+            key, wait = self.acquire()
+            error = retry_delay = None
+            try:
+                wait = max(wait, key.limiter.reserve(estimated_tokens)) # both include the key's 429 cooldown
+                time.sleep(wait)
+                queue_wait += wait
+                response = request_fn(key.client())
+            except Exception as e:
+                error = e
+            finally: # also on KeyboardInterrupt, so the key does not stay counted in flight
+                retry_delay = self.release(key, error, attempt)
+            if error is not None:
+                if retry_delay is None or attempt == self.max_retries:
+                    raise error
+                time.sleep(retry_delay)
+                queue_wait += retry_delay
+                continue
+            key.limiter.settle(estimated_tokens, response)
+            usage_tracker.record_response(response, latency=time.monotonic() - start - queue_wait, queue_wait=queue_wait, retries=attempt)
+            return response
+
+    async def acall(self, request_fn, messages, record_usage=True):
+        # request_fn(async_client) -> awaitable response
+        # (streamed responses carry no usage yet : the caller records them with record_usage=False)
+        estimated_tokens = estimate_tokens(messages)
+        start, queue_wait = time.monotonic(), 0.0
+        for attempt in range(self.max_retries + 1):
+            key, wait = self.acquire()
+            error = retry_delay = None
+            try:
+                wait = max(wait, key.limiter.reserve(estimated_tokens)) # both include the key's 429 cooldown
+                await asyncio.sleep(wait)
+                queue_wait += wait
+                response = await request_fn(key.async_client())
+            except Exception as e:
+                error = e
+            finally: # also when cancelled (the losing request of a hedge, a cancelled goal)
+                retry_delay = self.release(key, error, attempt)
+            if error is not None:
+                if retry_delay is None or attempt == self.max_retries:
+                    raise error
+                await asyncio.sleep(retry_delay)
+                queue_wait += retry_delay
+                continue
+            key.limiter.settle(estimated_tokens, response)
+            if record_usage:
+                usage_tracker.record_response(response, latency=time.monotonic() - start - queue_wait, queue_wait=queue_wait, retries=attempt)
+            return response
+
+    def stats(self):
+        per_key = {key.name: key.limiter.stats() for key in self.keys}
+        total = {}
+        for key_stats in per_key.values():
+            for stat_name in ["requests", "rate_limited", "retries", "total_wait_seconds"]:
+                total[stat_name] = total.get(stat_name, 0) + key_stats[stat_name]
+        total["max_wait_seconds"] = max([key_stats["max_wait_seconds"] for key_stats in per_key.values()], default=0.0)
+        return {"total": total, "per_key": per_key}
+
+# process-wide key pool shared by every model wrapper (configure via key_pool.configure)
+key_pool = KeyPool()
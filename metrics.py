@@ -0,0 +1,257 @@
+import contextvars
+import functools
+import json
+import resource
+import threading
+import time
+from collections import defaultdict
+
+from tracing import tracer
+
+# USD per 1M tokens : (input, cached input, output)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "o1": (15.00, 7.50, 60.00),
+    "gpt-o1": (15.00, 7.50, 60.00),
+}
+BATCH_DISCOUNT = 0.5
+
+# attribution of LLM calls, propagated into asyncio tasks and worker threads
+current_stage = contextvars.ContextVar("current_stage", default="unknown")
+current_agent = contextvars.ContextVar("current_agent", default="unknown")
+current_hypotheses = contextvars.ContextVar("current_hypotheses", default=())
+current_iteration = contextvars.ContextVar("current_iteration", default=None)
+current_goal = contextvars.ContextVar("current_goal", default=None) # research goal of a batch run (run_pipeline --goals_path)
+
+def track_stage(func):
+    # attribute every LLM call made inside an agent function to that function (nested stages keep the outer name)
+    agent = func.__module__.split(".")[-1]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        parent = current_stage.get()
+        stage = func.__name__ if parent == "unknown" else f"{parent}/{func.__name__}"
+        stage_token = current_stage.set(stage)
+        agent_token = current_agent.set(agent)
+        try:
+            with tracer.span("stage", stage, agent=agent) as span:
+                cpu_start = time.process_time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    # process-wide : stages running at the same time share these (see benchmark.py)
+                    span.annotate(cpu_seconds=round(time.process_time() - cpu_start, 4), max_rss_mb=peak_rss_mb())
+        finally:
+            current_stage.reset(stage_token)
+            current_agent.reset(agent_token)
+    return wrapper
+
+def peak_rss_mb():
+    # peak resident memory of this process so far (ru_maxrss is in KB on Linux)
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def model_price(model):
+    # response.model carries a dated snapshot name (e.g. gpt-4o-2024-08-06), so match on the longest known prefix
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_PRICES[name]
+    return None
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = (len(values) - 1) * q
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+class UsageTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = []
+        self._spent = {"tokens": 0, "cost": 0.0} # running totals, cheap to poll (budget.BudgetController)
+        self.parse_events = [] # one per chat_and_parse call : outcome in ("parsed", "fallback", "failed")
+        self.packing_events = [] # one per prompt that had to be shrunk to its token budget (packing.pack_sections)
+
+    def record(self, model, prompt_tokens=0, completion_tokens=0, cached_tokens=0, latency=None, queue_wait=0.0, retries=0, batch=False, cache_hit=False, hedge=False):
+        price = model_price(model) if model else None
+        cost = None
+        if price is not None:
+            input_price, cached_price, output_price = price
+            cost = ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + completion_tokens * output_price) / 1e6
+            if batch:
+                cost *= BATCH_DISCOUNT
+
+        call = {
+            "goal": current_goal.get(),
+            "iteration": current_iteration.get(),
+            "agent": current_agent.get(),
+            "stage": current_stage.get(),
+            "hyp_ids": list(current_hypotheses.get()),
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+            "latency": latency,
+            "queue_wait": queue_wait,
+            "retries": retries,
+            "batch": batch,
+            "cache_hit": cache_hit,
+            "hedge": hedge, # prompt tokens of a duplicate request cancelled by hedging
+            "cost": cost,
+        }
+        with self._lock:
+            self.calls.append(call)
+            self._spent["tokens"] += prompt_tokens + completion_tokens
+            self._spent["cost"] += cost or 0.0
+        tracer.current().add(calls=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cached_tokens=cached_tokens, cost=cost or 0.0, cache_hits=int(cache_hit), hedges=int(hedge))
+        return call
+
+    def record_response(self, response, latency=None, queue_wait=0.0, retries=0, batch=False):
+        # response : OpenAI chat completion (or the equivalent dict from a batch output file)
+        if isinstance(response, dict):
+            model, usage = response.get("model"), response.get("usage") or {}
+            cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+            prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        else:
+            model, usage = getattr(response, "model", None), getattr(response, "usage", None)
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+            prompt_tokens = getattr(usage, "prompt_tokens", 0) if usage is not None else 0
+            completion_tokens = getattr(usage, "completion_tokens", 0) if usage is not None else 0
+        return self.record(model, prompt_tokens, completion_tokens, cached_tokens, latency, queue_wait, retries, batch)
+
+    def record_parse(self, outcome, attempts, tokens):
+        with self._lock:
+            self.parse_events.append({
+                "iteration": current_iteration.get(),
+                "stage": current_stage.get(),
+                "hyp_ids": list(current_hypotheses.get()),
+                "outcome": outcome,
+                "attempts": attempts,
+                "tokens": tokens,
+            })
+
+    def parse_stats(self):
+        table = {}
+        with self._lock:
+            events = list(self.parse_events)
+        for event in events:
+            row = table.setdefault(event["stage"], {"calls": 0, "parsed": 0, "fallback": 0, "failed": 0, "attempts": 0, "max_attempts": 0})
+            row["calls"] += 1
+            row[event["outcome"]] += 1
+            row["attempts"] += event["attempts"]
+            row["max_attempts"] = max(row["max_attempts"], event["attempts"])
+        return table
+
+    def record_packing(self, label, budget, report):
+        with self._lock:
+            self.packing_events.append({
+                "iteration": current_iteration.get(),
+                "stage": current_stage.get(),
+                "hyp_ids": list(current_hypotheses.get()),
+                "label": label,
+                "budget": budget,
+                "sections": report,
+            })
+
+    def packing_stats(self):
+        table = {}
+        with self._lock:
+            events = list(self.packing_events)
+        for event in events:
+            row = table.setdefault(event["stage"], {"prompts": 0, "tokens_removed": 0, "dropped": 0, "summarized": 0, "truncated": 0})
+            row["prompts"] += 1
+            for section in event["sections"].values():
+                row["tokens_removed"] += section["tokens_before"] - section["tokens_after"]
+                row["dropped"] += section["dropped"]
+                row["summarized"] += section["summarized"]
+                row["truncated"] += int(section["truncated"])
+        return table
+
+    def aggregate(self, key_fn, split_cost=False):
+        groups = defaultdict(list)
+        with self._lock:
+            calls = list(self.calls)
+        for call in calls:
+            for key in key_fn(call):
+                groups[key].append(call)
+
+        table = {}
+        for key, group in groups.items():
+            latencies = [call["latency"] for call in group if call["latency"] is not None]
+            # a call shared by several hypotheses (e.g. a match) is split between them in the per-hypothesis view
+            share = [1 / max(1, len(call["hyp_ids"])) if split_cost else 1 for call in group]
+            prompt_tokens = sum(call["prompt_tokens"] for call in group)
+            cached_tokens = sum(call["cached_tokens"] for call in group)
+            table[key] = {
+                "calls": len(group),
+                "cache_hits": sum(call["cache_hit"] for call in group),
+                "retries": sum(call["retries"] for call in group),
+                "hedges": sum(call.get("hedge", False) for call in group),
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": sum(call["completion_tokens"] for call in group),
+                "cached_tokens": cached_tokens,
+                "cached_ratio": cached_tokens / prompt_tokens if prompt_tokens else None, # share of the prompt served from the provider's prompt cache
+                "latency_p50": percentile(latencies, 0.5),
+                "latency_p95": percentile(latencies, 0.95),
+                "queue_wait": sum(call["queue_wait"] for call in group),
+                "cost": sum((call["cost"] or 0.0) * s for call, s in zip(group, share)),
+            }
+        return table
+
+    def per_stage(self):
+        return self.aggregate(lambda call: [call["stage"]])
+
+    def per_hypothesis(self):
+        return self.aggregate(lambda call: call["hyp_ids"], split_cost=True)
+
+    def per_goal(self):
+        return self.aggregate(lambda call: [call.get("goal")])
+
+    def spent(self):
+        # tokens and USD cost of every call so far, without aggregating the call list
+        with self._lock:
+            return dict(self._spent)
+
+    def totals(self):
+        return self.aggregate(lambda call: ["total"]).get("total", {})
+
+    def save(self, path):
+        with self._lock:
+            calls = list(self.calls)
+            packing_events = list(self.packing_events)
+        with open(path, "w", encoding="utf-8") as wf:
+            json.dump({
+                "totals": self.totals(),
+                "per_stage": self.per_stage(),
+                "per_hypothesis": self.per_hypothesis(),
+                "per_goal": self.per_goal(),
+                "parsing": self.parse_stats(),
+                "packing": self.packing_stats(),
+                "packing_events": packing_events,
+                "calls": calls,
+            }, wf, indent=2)
+
+    def summary_table(self):
+        header = f"{'stage':<48}{'calls':>7}{'prompt tok':>12}{'cached %':>10}{'compl tok':>11}{'p50 s':>8}{'p95 s':>8}{'cost $':>10}"
+        lines = [header, "-" * len(header)]
+        rows = list(self.per_stage().items()) + [("TOTAL", self.totals())]
+        for stage, row in rows:
+            if not row:
+                continue
+            p50 = f"{row['latency_p50']:.2f}" if row["latency_p50"] is not None else "-"
+            p95 = f"{row['latency_p95']:.2f}" if row["latency_p95"] is not None else "-"
+            cached = f"{100 * row['cached_ratio']:.1f}" if row["cached_ratio"] is not None else "-"
+            lines.append(f"{stage:<48}{row['calls']:>7}{row['prompt_tokens']:>12}{cached:>10}{row['completion_tokens']:>11}{p50:>8}{p95:>8}{row['cost']:>10.4f}")
+        for stage, row in self.parse_stats().items():
+            if row["fallback"] or row["failed"]:
+                lines.append(f"parse failures in {stage}: {row['fallback']} fell back to structured output, {row['failed']} gave up (max attempts {row['max_attempts']})")
+        for stage, row in self.packing_stats().items():
+            lines.append(f"context packing in {stage}: {row['prompts']} prompts over budget, {row['tokens_removed']} tokens removed ({row['dropped']} items dropped, {row['summarized']} summarized, {row['truncated']} truncated)")
+        return "\n".join(lines)
+
+# process-wide tracker shared by every StructuredLLM
+usage_tracker = UsageTracker()
@@ -1,77 +1,393 @@
-# from .gpt import modelGPT4o, modelGPTo1
-# from .vllm import modelVLLM
 # from .gemini import model_gemini_flash, model_gemini_pro
 # from .claude import model_claude_opus, model_claude_sonnet3_5, model_claude_sonnet3
-from gpt import modelGPT4o
+from gpt import ModelGPTWrapper
+import asyncio
+import contextlib
 import random
+import re
 import json
+import os
+import threading
 from pydantic import BaseModel
 
+from event_loop import llm_loop
+from fair_share import FairShareScheduler
+from metrics import current_goal, current_hypotheses, usage_tracker
+from rate_limit import estimate_tokens
+from tracing import tracer
+
 REFORMAT_PROMPT = """\
 You are an expert in analyzing and validating novel research hypotheses. Above is the response from a research expert system. Your task is to reformat the response into a structured format that adheres to the specified schema. The output should be a JSON instance that conforms to the JSON schema provided below.
 
 Note that you should not change the content of the response, but only reformat it into a structured format. Do not include any personal opinions or additional information in the output.
 """
 
+# model backends are registered as factories and only instantiated on first use
+LLM_REGISTRY = {}
+_llm_instances = {}
+_llm_lock = threading.RLock() # factories of wrapping backends (replay, vllm-gpt_reformat) call get_llm themselves
+
+def register_llm(llm_name, factory):
+    LLM_REGISTRY[llm_name] = factory
+
 def get_llm(llm_name):
-    # return {
-    #     "gpt-4o": modelGPT4o,
-    #     "gpt-o1": modelGPTo1,
-    #     # "gpt-4": modelGPT4,
-    #     "vllm": modelVLLM,
-    #     "vllm-gpt_reformat": modelVLLM,
-    #     "gemini_flash": model_gemini_flash,
-    #     "gemini_pro": model_gemini_pro,
-    #     "claude_opus": model_claude_opus,
-    #     "claude_sonnet3_5": model_claude_sonnet3_5,
-    #     "claude_sonnet3": model_claude_sonnet3,
-    # }[llm_name]
-    return {
-        "gpt-4o": modelGPT4o
-    }[llm_name]
+    with _llm_lock:
+        if llm_name not in _llm_instances:
+            if llm_name not in LLM_REGISTRY:
+                raise KeyError(f"unknown llm '{llm_name}' (registered: {', '.join(sorted(LLM_REGISTRY))})")
+            _llm_instances[llm_name] = LLM_REGISTRY[llm_name]()
+        return _llm_instances[llm_name]
+
+register_llm("gpt-4o", lambda: ModelGPTWrapper("gpt-4o"))
+register_llm("gpt-o1", lambda: ModelGPTWrapper("gpt-o1"))
+
+def vllm_from_env():
+    # default OpenAI-compatible local server; run_pipeline re-registers it from --vllm_* arguments
+    from vllm_server import ModelVLLM
+    return ModelVLLM(os.environ.get("VLLM_MODEL", "default"), os.environ.get("VLLM_BASE_URL", "http://localhost:8000/v1"), os.environ.get("VLLM_API_KEY", "EMPTY"))
+
+register_llm("vllm", vllm_from_env)
+register_llm("vllm-gpt_reformat", lambda: get_llm("vllm"))
+# register_llm("gemini_flash", lambda: model_gemini_flash)
+# register_llm("gemini_pro", lambda: model_gemini_pro)
+# register_llm("claude_opus", lambda: model_claude_opus)
+# register_llm("claude_sonnet3_5", lambda: model_claude_sonnet3_5)
+# register_llm("claude_sonnet3", lambda: model_claude_sonnet3)
+
+def stop_on_pattern(pattern, flags=0, window=300):
+    # stop predicate for chat_until : true once the pattern appears in the tail of the generated text
+    compiled = re.compile(pattern, flags)
+    return lambda text: compiled.search(text[-window:]) is not None
+
+def run_concurrently(coroutines):
+    # run a batch of coroutines from synchronous code and return their results in order. every thread submits to the
+    # same long-lived loop, so requests share the async clients and their keep-alive connections
+    async def gather_all():
+        return await asyncio.gather(*coroutines)
+    return llm_loop.run(gather_all())
 
 class StructuredLLM:
-    def __init__(self, llm_name='gpt-4o', temperature=0):
+    def __init__(self, llm_name='gpt-4o', temperature=0, max_concurrency=8, cache=None, batch_runner=None, max_parse_attempts=3, parse_token_budget=None, hedge_policy=None, scheduler=None, limiter=None):
         self.llm_name = llm_name
+        self.base_llm_name = llm_name.split(":")[-1] # wrapped backends (e.g. "replay:gpt-o1") keep the capabilities of the inner model
         self.llm_model = get_llm(llm_name)
         self.temperature = temperature
+        self.max_concurrency = max_concurrency # max in-flight requests, across every event loop and thread using this instance
+        self.cache = cache # optional cache.ResponseCache, shared between StructuredLLM instances
+        self.batch_runner = batch_runner # optional batch.BatchRunner for non-interactive stages
+        self.max_parse_attempts = max_parse_attempts # defaults for chat_and_parse
+        self.parse_token_budget = parse_token_budget
+        self.hedge_policy = hedge_policy # optional hedging.HedgePolicy for slow live requests
+        self.scheduler = scheduler # optional fair_share.FairShareScheduler shared by the goals of a batch run
+        # a thread-safe FairShareScheduler rather than an asyncio.Semaphore, so the limit also holds for callers that
+        # drive achat from a loop of their own. run_pipeline shares one limiter between its StructuredLLMs
+        self.limiter = limiter or FairShareScheduler(max_in_flight=max_concurrency)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        # concurrency limit, then the batch-wide share of the current goal
+        async with self.limiter.slot(current_goal.get()):
+            if self.scheduler is None:
+                yield
+            else:
+                async with self.scheduler.slot(current_goal.get()):
+                    yield
     
+    def try_slot(self):
+        # slot for a hedged duplicate, only if one is free right now : -> release function, or None
+        goal = current_goal.get()
+        if not self.limiter.try_acquire(goal):
+            return None
+        if self.scheduler is not None and not self.scheduler.try_acquire(goal):
+            self.limiter.release(goal)
+            return None
+
+        def release():
+            if self.scheduler is not None:
+                self.scheduler.release(goal)
+            self.limiter.release(goal)
+        return release
+
     def wrap_messages(self, messages):
-        if self.llm_name == 'gpt-o1': # o1 does not support system prompt
+        if self.base_llm_name == 'gpt-o1': # o1 does not support system prompt
             for message in messages:
                 message['role'] = 'user'
         return messages
 
+    def cache_key(self, messages, return_format: BaseModel=None, model_name=None):
+        if self.cache is None:
+            return None
+        return self.cache.make_key(model_name or self.llm_name, messages, self.temperature, return_format)
+
+    def cache_get(self, cache_key):
+        if cache_key is None:
+            return False, None
+        hit, response = self.cache.get(cache_key)
+        if hit:
+            usage_tracker.record(self.llm_name, cache_hit=True)
+        return hit, response
+
+    def cache_put(self, cache_key, response):
+        if cache_key is not None:
+            self.cache.put(cache_key, response)
+
     def chat(self, messages, return_format: BaseModel=None):
-        messages = self.wrap_messages(messages)
+        # same path as achat, so sync callers (proximity, deduplication) take a slot too
+        return run_concurrently([self.achat(messages, return_format)])[0]
+
+    def _chat(self, messages, return_format: BaseModel=None):
         if not return_format:
             return self.llm_model.invoke(messages, self.temperature).content
 
-        if self.llm_name in [
+        if self.base_llm_name in [
             'gpt-o1', 'vllm-gpt_reformat'
         ]: # does not support formatted output naturally
             return self.chat_and_reformat(messages, return_format)
-        if self.llm_name == 'vllm': # does not support formatted output naturally
+        if self.base_llm_name == 'vllm': # does not support formatted output naturally
             return self.chat_and_reformat_vllm(messages, return_format)
 
         structured_llm = self.llm_model.with_structured_output(return_format)
-        response = structured_llm.invoke(messages)
+        response = structured_llm.invoke(messages, self.temperature)
+        if not isinstance(response, dict):
+            response = response.dict()
+        return response
+
+    async def achat(self, messages, return_format: BaseModel=None):
+        hyp_ids = current_hypotheses.get()
+        with tracer.span("llm", self.llm_name, hyp_ids=list(hyp_ids)) as span:
+            messages = self.wrap_messages(messages)
+            cache_key = self.cache_key(messages, return_format)
+            hit, response = self.cache_get(cache_key)
+            if not hit:
+                async with self.slot():
+                    if self.hedge_policy is not None:
+                        response = await self.hedge_policy.run(lambda: self._achat(messages, return_format), messages, self.llm_name, try_slot=self.try_slot)
+                    else:
+                        response = await self._achat(messages, return_format)
+                self.cache_put(cache_key, response)
+            if tracer.enabled("debug", hyp_ids):
+                span.annotate(messages=messages, response=response)
+            return response
+
+    async def _achat(self, messages, return_format: BaseModel=None):
+        if not hasattr(self.llm_model, 'ainvoke'):
+            return await asyncio.to_thread(self._chat, messages, return_format)
+        if not return_format:
+            return (await self.llm_model.ainvoke(messages, self.temperature)).content
+
+        if self.base_llm_name in [
+            'gpt-o1', 'vllm-gpt_reformat'
+        ]: # does not support formatted output naturally
+            raw_response = (await self.llm_model.ainvoke(messages, self.temperature)).content
+            return await self.areformat(raw_response, return_format)
+        if self.base_llm_name == 'vllm': # does not support formatted output naturally
+            raw_response = (await self.llm_model.ainvoke(messages, self.temperature)).content
+            formatted_response = await self.llm_model.areformat(self.reformat_messages(raw_response), return_format)
+            formatted_response['raw_reasoning'] = raw_response
+            return formatted_response
+
+        structured_llm = self.llm_model.with_structured_output(return_format)
+        response = await structured_llm.ainvoke(messages, self.temperature)
         if not isinstance(response, dict):
             response = response.dict()
         return response
 
+    async def astream(self, messages):
+        # yields content deltas as they are generated
+        messages = self.wrap_messages(messages)
+        async with self.slot():
+            stream = self.llm_model.astream(messages, self.temperature)
+            try:
+                async for delta in stream:
+                    yield delta
+            finally:
+                await stream.aclose()
+
+    async def achat_until(self, messages, stop=None):
+        # streamed chat that cuts generation as soon as stop(text_so_far) returns True
+        # (e.g. once a verdict has been written), saving output tokens and latency
+        if not hasattr(self.llm_model, 'astream'):
+            return await self.achat(messages)
+
+        hyp_ids = current_hypotheses.get()
+        with tracer.span("llm", self.llm_name, hyp_ids=list(hyp_ids), stream=True) as span:
+            text = await self._achat_until(messages, stop)
+            if tracer.enabled("debug", hyp_ids):
+                span.annotate(messages=messages, response=text)
+            return text
+
+    async def _achat_until(self, messages, stop=None):
+        messages = self.wrap_messages(messages)
+        cache_key = self.cache_key(messages, model_name=f"{self.llm_name}:stream")
+        hit, text = self.cache_get(cache_key)
+        if hit:
+            return text
+
+        async def collect():
+            text = ""
+            stream = self.llm_model.astream(messages, self.temperature)
+            try:
+                async for delta in stream:
+                    text += delta
+                    if stop is not None and stop(text):
+                        break
+            finally:
+                await stream.aclose()
+            return text
+
+        async with self.slot():
+            if self.hedge_policy is not None:
+                text = await self.hedge_policy.run(collect, messages, self.llm_name, try_slot=self.try_slot)
+            else:
+                text = await collect()
+        self.cache_put(cache_key, text)
+        return text
+
+    def chat_until(self, messages, stop=None):
+        return run_concurrently([self.achat_until(messages, stop)])[0]
+
+    async def achat_and_parse(self, messages, parse, stop=None, fallback_format: BaseModel=None, fallback_parse=None, max_attempts=None, token_budget=None):
+        # bounded replacement for `while not parsed: llm.chat(...)`.
+        # parse(text) -> value or None. after max_attempts (or once token_budget is spent) the request is sent once more
+        # with fallback_format as structured output and fallback_parse(dict) -> value. returns (llm_result, value or None)
+        max_attempts = max_attempts or self.max_parse_attempts
+        token_budget = token_budget or self.parse_token_budget
+        prompt_tokens = estimate_tokens(messages)
+
+        tokens, attempts, llm_result = 0, 0, None
+        while attempts < max_attempts and (token_budget is None or tokens + prompt_tokens <= token_budget):
+            attempts += 1
+            llm_result = await self.achat_until(messages, stop=stop) if stop is not None else await self.achat(messages)
+            tokens += prompt_tokens + len(llm_result) // 4
+            parsed = parse(llm_result)
+            if parsed is not None:
+                usage_tracker.record_parse("parsed", attempts, tokens)
+                return llm_result, parsed
+
+        if fallback_format is not None:
+            attempts += 1
+            structured = await self.achat(messages, return_format=fallback_format)
+            tokens += prompt_tokens + len(json.dumps(structured)) // 4
+            parsed = fallback_parse(structured) if fallback_parse is not None else structured
+            if parsed is not None:
+                usage_tracker.record_parse("fallback", attempts, tokens)
+                return structured.get("raw_reasoning") or json.dumps(structured, ensure_ascii=False), parsed
+
+        usage_tracker.record_parse("failed", attempts, tokens)
+        return llm_result, None
+
+    def chat_and_parse(self, messages, parse, **kwargs):
+        return run_concurrently([self.achat_and_parse(messages, parse, **kwargs)])[0]
+
+    def chat_many(self, messages_list, return_format: BaseModel=None, hyp_ids=None, batch=False):
+        # fan out independent requests, at most max_concurrency in flight.
+        # hyp_ids attributes each request to its hypothesis in the usage metrics.
+        # batch marks a non-interactive stage: with a batch_runner these requests go through a batch job
+        if hyp_ids is None:
+            hyp_ids = [None] * len(messages_list)
+        if self.batch_runner is not None and batch and not return_format:
+            return self.chat_batch(messages_list, hyp_ids)
+        return run_concurrently([self.achat_for(hyp_id, messages, return_format) for hyp_id, messages in zip(hyp_ids, messages_list)])
+
+    async def achat_for(self, hyp_id, messages, return_format: BaseModel=None):
+        # runs as its own task, so setting the context variable only affects this request
+        if hyp_id is None:
+            return await self.achat(messages, return_format)
+        current_hypotheses.set(hyp_id if isinstance(hyp_id, tuple) else (hyp_id,))
+        with tracer.span("hypothesis", "/".join(current_hypotheses.get())):
+            return await self.achat(messages, return_format)
+
+    def chat_batch(self, messages_list, hyp_ids):
+        results = [None] * len(messages_list)
+        cache_keys = []
+        pending = {}
+        for i, (messages, hyp_id) in enumerate(zip(messages_list, hyp_ids)):
+            messages = self.wrap_messages(messages)
+            cache_key = self.cache_key(messages)
+            hit, response = self.cache_get(cache_key)
+            cache_keys.append(cache_key)
+            if hit:
+                results[i] = response
+            else:
+                pending[f"{hyp_id}-{i}"] = (i, hyp_id, messages)
+
+        batch_results = self.batch_runner.run({custom_id: messages for custom_id, (_, _, messages) in pending.items()}, self.llm_model.model_name, self.temperature)
+
+        failed = []
+        for custom_id, (i, hyp_id, messages) in pending.items():
+            if custom_id in batch_results:
+                body = batch_results[custom_id]
+                results[i] = body["choices"][0]["message"]["content"]
+                token = current_hypotheses.set((hyp_id,) if hyp_id is not None else ())
+                usage_tracker.record_response(body, batch=True)
+                current_hypotheses.reset(token)
+                self.cache_put(cache_keys[i], results[i])
+            else:
+                failed.append((i, hyp_id, messages))
+
+        # requests that failed inside the batch are retried live
+        if failed:
+            responses = run_concurrently([self.achat_for(hyp_id, messages) for _, hyp_id, messages in failed])
+            for (i, _, _), response in zip(failed, responses):
+                results[i] = response
+        return results
+
     def chat_and_reformat_vllm(self, messages, return_format: BaseModel):
-        raw_response = self.llm_model.invoke(messages).content
-        formatted_response = self.llm_model.reformat(raw_response, return_format)
+        # the model reformats its own response, with the schema given in the prompt
+        raw_response = self.llm_model.invoke(messages, self.temperature).content
+        formatted_response = self.llm_model.reformat(self.reformat_messages(raw_response), return_format)
         formatted_response['raw_reasoning'] = raw_response
         return formatted_response
 
     def chat_and_reformat(self, messages, return_format: BaseModel, reformat_model='gpt-4o'):
-        raw_response = self.chat(messages)
+        # runs inside the caller's slot : the raw response is requested directly, not through chat
+        cache_key = self.cache_key(messages)
+        hit, raw_response = self.cache_get(cache_key)
+        if not hit:
+            raw_response = self._chat(messages)
+            self.cache_put(cache_key, raw_response)
         return self.reformat(raw_response, return_format, reformat_model)
 
+    def reformat_llm_name(self, reformat_model):
+        # a wrapped backend (e.g. "replay:gpt-o1") reformats through the same wrapper ("replay:gpt-4o"), so replays stay offline
+        return self.llm_name[:len(self.llm_name) - len(self.base_llm_name)] + reformat_model
+
     def reformat(self, raw_response: str, return_format: BaseModel, reformat_model='gpt-4o'):
-        reformat_messages = [
+        reformat_model = self.reformat_llm_name(reformat_model)
+        reformat_messages = self.reformat_messages(raw_response)
+        cache_key = self.cache_key(reformat_messages, return_format, model_name=reformat_model)
+        hit, formatted_response = self.cache_get(cache_key)
+        if hit:
+            return formatted_response
+
+        reformat_model = get_llm(reformat_model)
+        structured_llm = reformat_model.with_structured_output(return_format)
+        formatted_response = structured_llm.invoke(reformat_messages)
+        if not isinstance(formatted_response, dict):
+            formatted_response = formatted_response.dict()
+        formatted_response['raw_reasoning'] = raw_response
+        self.cache_put(cache_key, formatted_response)
+        return formatted_response
+
+    async def areformat(self, raw_response: str, return_format: BaseModel, reformat_model='gpt-4o'):
+        reformat_model = self.reformat_llm_name(reformat_model)
+        reformat_messages = self.reformat_messages(raw_response)
+        cache_key = self.cache_key(reformat_messages, return_format, model_name=reformat_model)
+        hit, formatted_response = self.cache_get(cache_key)
+        if hit:
+            return formatted_response
+
+        reformat_model = get_llm(reformat_model)
+        structured_llm = reformat_model.with_structured_output(return_format)
+        formatted_response = await structured_llm.ainvoke(reformat_messages)
+        if not isinstance(formatted_response, dict):
+            formatted_response = formatted_response.dict()
+        formatted_response['raw_reasoning'] = raw_response
+        self.cache_put(cache_key, formatted_response)
+        return formatted_response
+
+    def reformat_messages(self, raw_response: str):
+        return [
             {
                 "role": "system",
                 "content": REFORMAT_PROMPT
@@ -80,12 +396,4 @@ class StructuredLLM:
                 "role": "user",
                 "content": raw_response
             }
-        ]
-
-        reformat_model = get_llm(reformat_model)
-        structured_llm = reformat_model.with_structured_output(return_format)
-        formatted_response = structured_llm.invoke(reformat_messages)
-        if not isinstance(formatted_response, dict):
-            formatted_response = formatted_response.dict()
-        formatted_response['raw_reasoning'] = raw_response
-        return formatted_response
\ No newline at end of file
+        ]
\ No newline at end of file
@@ -0,0 +1,110 @@
+from metrics import usage_tracker
+
+# prompt token budgets per packed section group, overridable from run_pipeline
+CONTEXT_BUDGETS = {
+    "related_articles": 8000, # full_reviewer : retrieved articles x chunks
+    "meta_review": 12000, # metareview_generator : every review plus all match transcripts
+    "match_results": 4000, # enhancement_grounding : lost match transcripts
+}
+
+_encoding = None
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken # imported on first use
+        except ImportError: # optional : token counts fall back to the ~4 characters per token estimate
+            _encoding = False
+        else:
+            _encoding = tiktoken.get_encoding("o200k_base") # gpt-4o / o1 tokenizer, close enough for other models
+    return _encoding or None
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text, max_tokens, marker="\n[...]"):
+    if count_tokens(text) <= max_tokens:
+        return text
+    max_tokens = max(0, max_tokens - count_tokens(marker))
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4] + marker
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]) + marker
+
+def tail_summary(text, max_tokens=80):
+    # condensed match transcript : the verdict and final reasoning are at the end, so keep the tail
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = get_encoding()
+    if encoding is None:
+        return "[...] " + text[-max_tokens * 4:]
+    return "[...] " + encoding.decode(encoding.encode(text, disallowed_special=())[-max_tokens:])
+
+class Section:
+    # one part of a prompt to pack. sections with the lowest priority are shrunk first, never below min_tokens.
+    # strategy "truncate" : content is a string, cut at the end
+    # strategy "drop"     : content is a list ranked best first, lowest-ranked items are dropped
+    # strategy "summarize": content is a list ordered oldest first, older items are replaced by summarize(item), then dropped
+    # (any section still over its share is truncated)
+    def __init__(self, name, content, priority=0, strategy="truncate", min_tokens=0, summarize=tail_summary, separator="\n\n"):
+        assert strategy in ("truncate", "drop", "summarize")
+        self.name = name
+        self.items = [content] if isinstance(content, str) else [str(item) for item in content]
+        self.priority = priority
+        self.strategy = strategy
+        self.min_tokens = min_tokens
+        self.summarize = summarize
+        self.separator = separator
+
+    def text(self):
+        return self.separator.join(self.items)
+
+    def fit(self, max_tokens):
+        # shrink to at most max_tokens, returns what was removed
+        info = {"dropped": 0, "summarized": 0, "truncated": False}
+        if self.strategy == "summarize":
+            for i in range(len(self.items)):
+                if count_tokens(self.text()) <= max_tokens:
+                    break
+                summary = self.summarize(self.items[i])
+                if summary != self.items[i]:
+                    self.items[i] = summary
+                    info["summarized"] += 1
+        while count_tokens(self.text()) > max_tokens and len(self.items) > 1:
+            self.items.pop(0 if self.strategy == "summarize" else -1)
+            info["dropped"] += 1
+        if count_tokens(self.text()) > max_tokens:
+            self.items = [truncate_tokens(self.text(), max_tokens)]
+            info["truncated"] = True
+        return info
+
+def pack_sections(sections, budget, label=None):
+    # fits the sections into budget tokens and returns {name: packed text}. what had to be dropped,
+    # summarized or truncated is recorded in the usage metrics under the current stage
+    tokens = {section.name: count_tokens(section.text()) for section in sections}
+    total = sum(tokens.values())
+    report = {}
+    for section in sorted(sections, key=lambda section: section.priority):
+        if total <= budget:
+            break
+        target = max(section.min_tokens, tokens[section.name] - (total - budget))
+        if target >= tokens[section.name]:
+            continue
+        info = section.fit(target)
+        packed_tokens = count_tokens(section.text())
+        total -= tokens[section.name] - packed_tokens
+        report[section.name] = dict(info, tokens_before=tokens[section.name], tokens_after=packed_tokens)
+
+    if report:
+        usage_tracker.record_packing(label, budget, report)
+    return {section.name: section.text() for section in sections}
+
+def pack_list(name, items, budget, strategy="drop", separator="\n\n", label=None):
+    # single-section shorthand, returns the packed items
+    section = Section(name, items, strategy=strategy, separator=separator)
+    pack_sections([section], budget, label)
+    return section.items
@@ -0,0 +1,21 @@
+class PromptLayout:
+    # prompt assembled for provider-side prompt caching, which only discounts an identical prefix :
+    #   instructions (static, or formatted with run-level constants such as idea_attributes)
+    #   shared sections (research goal, preferences : identical for every call of a run)
+    #   item sections (hypotheses, reviews, articles, transcripts : differ per call)
+    #   closing (short static cue for the answer, after the variable content)
+    # sections are templates such as "Goal: {goal}", formatted with the same keyword arguments as str.format
+    def __init__(self, instructions, shared=(), item=(), closing=""):
+        self.instructions = instructions
+        self.shared = list(shared)
+        self.item = list(item)
+        self.closing = closing
+
+    def format(self, **values):
+        parts = [self.instructions.format(**values)]
+        parts += [section.format(**values) for section in self.shared]
+        parts += [section.format(**values) for section in self.item]
+        if self.closing:
+            parts.append(self.closing.format(**values))
+        return "\n\n".join(part.strip("\n") for part in parts)
+
@@ -0,0 +1,78 @@
+import re
+
+from sqlalchemy import (
+    ARRAY,
+    Boolean,
+    Column,
+    Float,
+    ForeignKey,
+    Integer,
+    String,
+)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+
+# ORM models of the PubMed article database. imported by db_pool on first use, so runs that never query the
+# database (synthetic retriever, replayed runs, --help) do not load SQLAlchemy
+Base = declarative_base()
+
+class JournalImpactFactor(Base):
+    __tablename__ = "journal_impact_factors"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    issn_linking = Column(String, unique=True, index=True, nullable=False)
+    impact_factor = Column(Float)
+
+class PubMedArticle(Base):
+    __tablename__ = "pubmed_articles"
+    pmid = Column(Integer, primary_key=True, nullable=False)
+    pmc_id = Column(String)
+    pmc_type = Column(String)
+    doi = Column(String)
+    title = Column(String)
+    abstract = Column(String)
+    authors = Column(ARRAY(String))
+    mesh_terms = Column(ARRAY(String))
+    publication_types = Column(ARRAY(String))
+    keywords = Column(ARRAY(String))
+    chemical_list = Column(ARRAY(String))
+    pubdate = Column(Integer)
+    journal = Column(String)
+    medline_ta = Column(String)
+    nlm_unique_id = Column(String)
+    issn_linking = Column(String)
+    country = Column(String)
+    references = Column(ARRAY(Integer))
+    delete = Column(Boolean)
+    languages = Column(ARRAY(String))
+    vernacular_title = Column(String)
+
+    journal_metrics = relationship(
+        "JournalImpactFactor",
+        primaryjoin="PubMedArticle.issn_linking == JournalImpactFactor.issn_linking",
+        foreign_keys=[issn_linking],
+        uselist=False,
+    )
+
+    @property
+    def impact_factor(self):
+        return self.journal_metrics.impact_factor if self.journal_metrics else None
+
+class PubMedChunk(Base):
+    __tablename__ = "pubmed_chunks"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    pmid = Column(Integer, ForeignKey("pubmed_articles.pmid"), nullable=False)
+    chunk_index = Column(Integer, nullable=False)
+    chunk_text = Column(String, nullable=False)
+
+    article_relation = relationship("PubMedArticle", foreign_keys=[pmid], uselist=False)
+
+    @property
+    def article(self):
+        return self.article_relation
+
+def sanitize_text(text: str) -> str:
+    cleaned_text = re.sub(r"[^\w\s]", " ", text)
+    cleaned_text = re.sub(r"\s+", " ", cleaned_text).strip()
+    return cleaned_text
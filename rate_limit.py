@@ -0,0 +1,109 @@
+import random
+import threading
+import time
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+def estimate_tokens(messages):
+    # rough prompt size estimate (~4 characters per token), good enough for budgeting tokens/min
+    num_chars = sum(len(str(message.get("content") or "")) for message in messages)
+    return num_chars // 4 + 4 * len(messages)
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60.0 # refill per second
+        self.updated_at = time.monotonic()
+
+    def reserve(self, amount, now):
+        # deduct right away (the balance may go negative) and return how long the caller has to wait,
+        # so concurrent callers are served in arrival order
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, base_delay=1.0, max_delay=60.0):
+        self._lock = threading.Lock()
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.blocked_until = 0.0 # set from Retry-After so every caller on this limiter backs off together
+        self.configure(requests_per_minute, tokens_per_minute)
+
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        self.num_retries = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def configure(self, requests_per_minute=None, tokens_per_minute=None):
+        with self._lock:
+            self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+            self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def reserve(self, estimated_tokens):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.request_bucket is not None:
+                wait = max(wait, self.request_bucket.reserve(1, now))
+            if self.token_bucket is not None:
+                wait = max(wait, self.token_bucket.reserve(estimated_tokens, now))
+
+            self.num_requests += 1
+            self.total_wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        return wait
+
+    def settle(self, estimated_tokens, response):
+        # charge the difference between the estimate and the actual usage reported by the API
+        usage = getattr(response, "usage", None)
+        if usage is None or self.token_bucket is None:
+            return
+        with self._lock:
+            self.token_bucket.tokens -= usage.total_tokens - estimated_tokens
+
+    def backoff_delay(self, error, attempt):
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            headers = response.headers
+            try:
+                if headers.get("retry-after-ms"):
+                    retry_after = float(headers["retry-after-ms"]) / 1000
+                elif headers.get("retry-after"):
+                    retry_after = float(headers["retry-after"])
+            except ValueError:
+                retry_after = None
+
+        if retry_after is None:
+            retry_after = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return retry_after * (1 + random.uniform(0, 0.25)) # jitter to avoid synchronized retries
+
+    def on_retryable_error(self, error, attempt):
+        delay = self.backoff_delay(error, attempt)
+        with self._lock:
+            self.num_retries += 1
+            if getattr(error, "status_code", None) == 429:
+                self.num_rate_limited += 1
+                self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return delay
+
+    @staticmethod
+    def is_retryable(error):
+        from openai import APIConnectionError, APIStatusError
+        if isinstance(error, APIConnectionError): # includes timeouts
+            return True
+        return isinstance(error, APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+    def stats(self):
+        return {
+            "requests": self.num_requests,
+            "rate_limited": self.num_rate_limited,
+            "retries": self.num_retries,
+            "total_wait_seconds": round(self.total_wait_seconds, 3),
+            "mean_wait_seconds": round(self.total_wait_seconds / self.num_requests, 3) if self.num_requests else 0.0,
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+        }
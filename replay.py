@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+from pydantic import BaseModel
+
+from gpt import SimpleResponse
+
+class CassetteMiss(KeyError):
+    pass
+
+class Cassette:
+    # JSONL file of recorded (request, response) pairs, looked up by request hash.
+    # identical requests are told apart by their occurrence index, so repeated samples and parse retries replay in order
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = defaultdict(list)
+        self._occurrences = Counter()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as rf:
+                for line in rf:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry["key"]].append(entry)
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @staticmethod
+    def request_key(kind, model_name, messages, temperature, return_format=None):
+        payload = json.dumps({
+            "kind": kind,
+            "model": model_name,
+            "messages": messages,
+            "temperature": temperature,
+            "schema": return_format.schema() if return_format else None,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def next_occurrence(self, key):
+        with self._lock:
+            occurrence = self._occurrences[key]
+            self._occurrences[key] += 1
+        return occurrence
+
+    def lookup(self, key, occurrence):
+        with self._lock:
+            entries = self._entries.get(key, [])
+            return entries[occurrence] if occurrence < len(entries) else None
+
+    def record(self, key, occurrence, kind, model_name, messages, response, latency):
+        entry = {"key": key, "occurrence": occurrence, "kind": kind, "model": model_name, "messages": messages, "response": response, "latency": latency}
+        with self._lock:
+            self._entries[key].append(entry)
+            with open(self.path, "a", encoding="utf-8") as wf:
+                wf.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+class ReplayModel:
+    # mode "record" : call the wrapped model and append every response to the cassette
+    # mode "replay" : serve responses from the cassette; on a miss either fail or fall through to the wrapped model
+    # latency : None to replay instantly, a number of seconds, or "recorded" to sleep the recorded latency (x latency_scale)
+    def __init__(self, inner_model, cassette, mode="replay", miss_policy="fail", latency=None, latency_scale=1.0):
+        assert mode in ("record", "replay")
+        assert miss_policy in ("fail", "fallthrough")
+        self.inner_model = inner_model
+        self.cassette = cassette
+        self.mode = mode
+        self.miss_policy = miss_policy
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.model_name = getattr(inner_model, "model_name", "replay")
+        self.hits = 0
+        self.misses = 0
+
+    def simulated_latency(self, entry):
+        if self.latency == "recorded":
+            return (entry.get("latency") or 0.0) * self.latency_scale
+        return self.latency or 0.0
+
+    def lookup(self, kind, messages, temperature, return_format=None):
+        key = Cassette.request_key(kind, self.model_name, messages, temperature, return_format)
+        occurrence = self.cassette.next_occurrence(key)
+        entry = self.cassette.lookup(key, occurrence) if self.mode == "replay" else None
+        if entry is not None:
+            self.hits += 1
+        elif self.mode == "replay":
+            self.misses += 1
+            if self.miss_policy == "fail" or self.inner_model is None:
+                raise CassetteMiss(f"no recorded response for {kind} request {key} (occurrence {occurrence})")
+        return key, occurrence, entry
+
+    def invoke(self, messages, temperature):
+        key, occurrence, entry = self.lookup("chat", messages, temperature)
+        if entry is not None:
+            time.sleep(self.simulated_latency(entry))
+            return SimpleResponse(content=entry["response"])
+
+        start = time.monotonic()
+        content = self.inner_model.invoke(messages, temperature).content
+        self.cassette.record(key, occurrence, "chat", self.model_name, messages, content, time.monotonic() - start)
+        return SimpleResponse(content=content)
+
+    async def ainvoke(self, messages, temperature):
+        key, occurrence, entry = self.lookup("chat", messages, temperature)
+        if entry is not None:
+            await asyncio.sleep(self.simulated_latency(entry))
+            return SimpleResponse(content=entry["response"])
+
+        start = time.monotonic()
+        content = (await self.inner_model.ainvoke(messages, temperature)).content
+        self.cassette.record(key, occurrence, "chat", self.model_name, messages, content, time.monotonic() - start)
+        return SimpleResponse(content=content)
+
+    async def astream(self, messages, temperature, chunk_size=16):
+        # streamed requests may be cut by the caller, so the recorded text is whatever was consumed
+        key, occurrence, entry = self.lookup("stream", messages, temperature)
+        if entry is not None:
+            text = entry["response"]
+            delay = self.simulated_latency(entry) / max(1, len(text) // chunk_size)
+            for i in range(0, len(text), chunk_size):
+                await asyncio.sleep(delay)
+                yield text[i:i + chunk_size]
+            return
+
+        start = time.monotonic()
+        text = ""
+        stream = self.inner_model.astream(messages, temperature)
+        try:
+            async for delta in stream:
+                text += delta
+                yield delta
+        finally:
+            await stream.aclose()
+            self.cassette.record(key, occurrence, "stream", self.model_name, messages, text, time.monotonic() - start)
+
+    def reformat(self, reformat_messages, return_format: BaseModel, temperature=0):
+        # backends that reformat their own responses (vllm)
+        key, occurrence, entry = self.lookup("reformat", reformat_messages, temperature, return_format)
+        if entry is not None:
+            time.sleep(self.simulated_latency(entry))
+            return entry["response"]
+
+        start = time.monotonic()
+        response = self.inner_model.reformat(reformat_messages, return_format, temperature)
+        self.cassette.record(key, occurrence, "reformat", self.model_name, reformat_messages, response, time.monotonic() - start)
+        return response
+
+    async def areformat(self, reformat_messages, return_format: BaseModel, temperature=0):
+        key, occurrence, entry = self.lookup("reformat", reformat_messages, temperature, return_format)
+        if entry is not None:
+            await asyncio.sleep(self.simulated_latency(entry))
+            return entry["response"]
+
+        start = time.monotonic()
+        response = await self.inner_model.areformat(reformat_messages, return_format, temperature)
+        self.cassette.record(key, occurrence, "reformat", self.model_name, reformat_messages, response, time.monotonic() - start)
+        return response
+
+    def with_structured_output(self, return_format: BaseModel):
+        return ReplayStructuredModel(self, return_format)
+
+class ReplayStructuredModel:
+    def __init__(self, replay_model, return_format: BaseModel):
+        self.replay_model = replay_model
+        self.return_format = return_format
+
+    def invoke(self, messages, temperature=0):
+        key, occurrence, entry = self.replay_model.lookup("structured", messages, temperature, self.return_format)
+        if entry is not None:
+            time.sleep(self.replay_model.simulated_latency(entry))
+            return self.return_format.parse_obj(entry["response"])
+
+        start = time.monotonic()
+        response = self.replay_model.inner_model.with_structured_output(self.return_format).invoke(messages, temperature)
+        self.replay_model.cassette.record(key, occurrence, "structured", self.replay_model.model_name, messages, response.dict(), time.monotonic() - start)
+        return response
+
+    async def ainvoke(self, messages, temperature=0):
+        key, occurrence, entry = self.replay_model.lookup("structured", messages, temperature, self.return_format)
+        if entry is not None:
+            await asyncio.sleep(self.replay_model.simulated_latency(entry))
+            return self.return_format.parse_obj(entry["response"])
+
+        start = time.monotonic()
+        response = await self.replay_model.inner_model.with_structured_output(self.return_format).ainvoke(messages, temperature)
+        self.replay_model.cassette.record(key, occurrence, "structured", self.replay_model.model_name, messages, response.dict(), time.monotonic() - start)
+        return response
+
+_cassettes = {} # path -> Cassette, shared by the models replayed from one file so occurrences are counted once
+
+def register_replay_llm(inner_llm_name, cassette_path, mode="replay", miss_policy="fail", latency=None, latency_scale=1.0):
+    # registers "<mode>:<inner_llm_name>" in get_llm and returns that name
+    from models import get_llm, register_llm
+
+    llm_name = f"{mode}:{inner_llm_name}"
+    if cassette_path not in _cassettes:
+        _cassettes[cassette_path] = Cassette(cassette_path)
+    cassette = _cassettes[cassette_path]
+    register_llm(llm_name, lambda: ReplayModel(get_llm(inner_llm_name), cassette, mode, miss_policy, latency, latency_scale))
+    return llm_name
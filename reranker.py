@@ -0,0 +1,63 @@
+import os
+import threading
+
+MEDCPT_CROSS_ENCODER = "ncbi/MedCPT-Cross-Encoder"
+
+class Reranker:
+    # optional cross-encoder reranking of retrieved article chunks, off unless run_pipeline gets --reranker.
+    # torch and transformers are only imported when the model is first used, so runs without a reranker never
+    # load them; CUDA_VISIBLE_DEVICES is set at that point too, before torch initializes CUDA
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure()
+
+    def configure(self, model_name=None, device="cuda", cuda_visible_devices=None, max_length=512):
+        with self._lock:
+            self.model_name = model_name
+            self.device = device
+            self.cuda_visible_devices = cuda_visible_devices
+            self.max_length = max_length
+            self._tokenizer = self._model = None
+
+    @property
+    def enabled(self):
+        return self.model_name is not None
+
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                if self.cuda_visible_devices is not None:
+                    os.environ["CUDA_VISIBLE_DEVICES"] = self.cuda_visible_devices
+                from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+                self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+                self._model = model.eval().to(self.device).requires_grad_(False)
+            return self._tokenizer, self._model
+
+    def order(self, query, chunks):
+        # indices of chunks ([(score, chunk), ...]) from most to least relevant to query
+        tokenizer, model = self.load()
+        encoded = tokenizer(
+            [[query, chunk.chunk_text] for _, chunk in chunks],
+            truncation=True,
+            padding=True,
+            return_tensors="pt",
+            max_length=self.max_length,
+        )
+        logits = model(**encoded.to(self.device)).logits.squeeze(dim=1)
+        return logits.argsort(descending=True).cpu().tolist()
+
+    def rerank(self, query, chunks, fuse=False):
+        # chunks in reranker order, unchanged when the reranker is off. fuse : reciprocal rank fusion of the reranker
+        # order and the search order instead of the reranker order alone
+        if not self.enabled or not chunks:
+            return chunks
+        indices = self.order(query, chunks)
+        if fuse:
+            ranks = {i: rank for rank, i in enumerate(indices)}
+            indices = sorted(range(len(chunks)), key=lambda i: -(1 / (30 + ranks[i]) + 1 / (30 + i)))
+        return [chunks[i] for i in indices]
+
+# process-wide reranker, configured by run_pipeline (--reranker, --reranker_device, --cuda_visible_devices)
+reranker = Reranker()
@@ -1,31 +1,53 @@
 import argparse
 import os
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 from api_config import API_CONFIG
 for key, api_list in API_CONFIG.items():
     os.environ[key] = api_list[0]
-from openai import OpenAI
 from models import StructuredLLM
+from cache import ResponseCache
+from replay import register_replay_llm
+from vllm_server import register_vllm_llm
+from batch import BatchRunner, OpenAIBatchEndpoint, LocalBatchEndpoint
+from key_pool import key_pool
+from metrics import current_goal, current_iteration, usage_tracker
+from http_pool import http_pool
+from db_pool import db_pool
+from fair_share import FairShareScheduler
+from job_queue import JobQueue, JobWorker
+from tracing import tracer
+from budget import budget
+from hedging import HedgePolicy
+from streaming import HypothesisStream
+from packing import CONTEXT_BUDGETS
+from hypothesis_store import blob_store, json_default
+from reranker import MEDCPT_CROSS_ENCODER, reranker
+from checkpoint import CheckpointStore
+from iteration import IterationController
 from agents.generation import retrieve_and_reasoner, retrieve_from_db, explorator, debate_simulator, assumption_identifier, research_expander 
-from agents.reflection import initial_reviewer, full_reviewer, deep_reviewer, observation_reviewer, simulation_reviewer, tournament_reviewer
+from agents.reflection import initial_reviewer, reflection_graph, tournament_reviewer
 from agents.proximity import calculate_proximity, exclude_same_hyp
 from agents.ranking import elo_tournament
 from agents.evolution import evolve_hypotheses
 from agents.meta_review import metareview_generator
 
+import contextvars
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def main(args):
+def run_goal(args, llm, llm_explorator, llm_review, research_goal, save_path, job_queue=None):
+    # one research goal end to end : results, checkpoints and iteration decisions are written to save_path.
+    # with a job_queue, per-hypothesis reviews, matches, evolution and meta-reviews are run by worker processes
+    remote = job_queue.remote if job_queue is not None else (lambda fn: fn)
+
+    # bounded queue between generation and reviews (--pipeline_mode streaming)
+    hypothesis_stream = HypothesisStream(max_producers=args.max_concurrency, max_consumers=args.max_concurrency, max_pending=args.max_pending_hypotheses)
+
+    os.makedirs(save_path, exist_ok=True)
+
+    # finished (iteration, stage, hypothesis) outputs, restored instead of recomputed with --resume
+    checkpoint = CheckpointStore(args.checkpoint_path or os.path.join(save_path, "checkpoints.sqlite"), resume=args.resume)
 
-    llm = StructuredLLM(llm_name=args.llm, temperature=0.2)
-    llm_explorator = StructuredLLM(llm_name=args.llm, temperature=1.0)
-    
-    os.makedirs(args.save_path, exist_ok=True)
-    
-    with open(args.input_path) as rf:
-        research_goal = rf.read() # Develop a novel hypothesis for the key factor or process which causes ALS ...
-    
     # research_plan_config = research_plan_generator(research_goal) # skip for now
     research_plan_config = {
         "Preferences" : "Focus on providing a novel hypothesis, with detailed explanation of the mechanism of action.",
@@ -33,80 +55,101 @@ def main(args):
         "Constraints" : "should be correct, should be novel."
     }
     
-    visited_hyp = []
+    # stops at --max_iters, when a budget is spent or once the ranking has converged
+    iteration_controller = IterationController(max_iters=args.max_iters, max_seconds=args.max_wall_seconds, max_tokens=args.max_total_tokens, top_k=args.convergence_top_k, min_improvement=args.min_elo_improvement)
+
+    visited_hyp = [] # ids only : holding the hypotheses would keep every text of the goal in memory
     hyp_after_meta_review = []
-    FINISH = False
-    while FINISH==False:
-        # 1. generation agent
-        generation_start = time.time()
-        print(f"Generation agent ...\n##########################################")
-
-        if len(hyp_after_meta_review) == 0:
-            articles_with_reasoning = retrieve_from_db(research_goal, 10) # retrieve top k documents from DB (need update : add reasoning)
-            source_hypothesis = ""
-            generated_hypotheses = explorator(llm_explorator, research_goal, research_plan_config["Preferences"], source_hypothesis, "\n\n".join(articles_with_reasoning), args.num_init_hyp) # keys : "id_", "hyp_full", "hyp_main"
-        else:
-            FINISH=True
-            generated_hypotheses = debate_simulator(llm, research_plan_config["Attributes"], research_goal, research_plan_config["Preferences"], hyp_after_meta_review, 10) # max turns = 10 / return new hyp_dict (+ "prev_id")
+    hyp_after_evolution = []
+    for iteration in range(1, args.max_iters + 1):
+        current_iteration.set(iteration)
+        iteration_span = tracer.start_span("iteration", f"iteration{iteration}")
+        if args.pipeline_mode == "streaming":
+            # generation, initial review and reflection per hypothesis as soon as it exists; deduplication waits for all of them
+            generation_start = time.time()
+            print(f"Streaming generation and reflection (iteration {iteration}) ...\n##########################################")
+            if iteration == 1:
+                articles_with_reasoning = retrieve_from_db(research_goal, 10)
+                producers = [
+                    lambda k=k: checkpoint.run_stage("explorator", explorator, llm_explorator, research_goal, research_plan_config["Preferences"], "", "\n\n".join(articles_with_reasoning), 1, key=f"sample{k}")
+                    for k in range(args.num_init_hyp)
+                ]
+            else:
+                producers = [
+                    lambda hyp_dict=hyp_dict: checkpoint.run_stage("debate_simulator", debate_simulator, llm, research_plan_config["Attributes"], research_goal, research_plan_config["Preferences"], [hyp_dict], 10, key=hyp_dict["id_"])
+                    for hyp_dict in hyp_after_meta_review
+                ]
+                producers += [lambda hyp_dict=hyp_dict: [hyp_dict] for hyp_dict in hyp_after_evolution]
 
-            generated_hypotheses += hyp_after_evolution
-        ### exclude assumptions, unexplored_areas for now
-        # assumptions = assumption_identifier(llm, research_goal) # maybe return "assumptions" and their "sub-assumptions" dict?
-        # unexplored_areas = research_expander(llm, visited_hyp_list, reviews_overview)
-        
-        generation_end = time.time()
-        print(f"Generation agent time : {generation_end - generation_start} seconds")
-        print(f"generated hypothesis (num={len(generated_hypotheses)}): {generated_hypotheses}\n##########################################")
+            def review_hypothesis(hyp_dict):
+                hyp_dicts = [hyp_dict for hyp_dict in checkpoint.map_hypotheses("initial_reviewer", remote(initial_reviewer), (llm_review,), [hyp_dict]) if "INAPPROPRIATE" not in hyp_dict["initial_review"]]
+                return reflection_graph.run((llm_review,), hyp_dicts, max_workers=len(reflection_graph.tasks), checkpoint=checkpoint, job_queue=job_queue, skip_optional=budget.skip_optional)
+
+            hyp_after_simulation_review = hypothesis_stream.run(producers, review_hypothesis)
+            visited_hyp += [hyp_dict["id_"] for hyp_dict in hyp_after_simulation_review]
+            print(f"Streaming generation and reflection time : {time.time() - generation_start} seconds ({hypothesis_stream.stats()})")
 
-        ## filtering duplicate hypotheses
-        filtering_start = time.time()
-        print(f"Filtering duplicates ...\n##########################################")
-        generated_hypotheses = exclude_same_hyp(llm, research_goal, generated_hypotheses)
-        filtering_end = time.time()
-        print(f"Filtering time (num={len(generated_hypotheses)}): {filtering_end - filtering_start} seconds")
+            filtering_start = time.time()
+            print(f"Filtering duplicates ...\n##########################################")
+            hyp_after_simulation_review = checkpoint.run_stage("exclude_same_hyp", exclude_same_hyp, llm, research_goal, hyp_after_simulation_review)
+            print(f"Filtering time (num={len(hyp_after_simulation_review)}): {time.time() - filtering_start} seconds")
+            hyp_with_reviews = hyp_after_simulation_review
+        else:
+            # 1. generation agent
+            generation_start = time.time()
+            print(f"Generation agent (iteration {iteration}) ...\n##########################################")
 
-        ## 2. reflection agent
-        reflection_start = time.time()
-        print(f"Reflection agent ...\n##########################################")
-        hyp_after_init_review = initial_reviewer(llm, generated_hypotheses)
-        hyp_after_init_review = [hyp_dict for hyp_dict in hyp_after_init_review if "INAPPROPRIATE" not in hyp_dict["initial_review"]] # keys : "id_", "hyp_full", "hyp_main", "initial_review"
-        visited_hyp += hyp_after_init_review
+            if iteration == 1:
+                articles_with_reasoning = retrieve_from_db(research_goal, 10) # retrieve top k documents from DB (need update : add reasoning)
+                source_hypothesis = ""
+                generated_hypotheses = checkpoint.run_stage("explorator", explorator, llm_explorator, research_goal, research_plan_config["Preferences"], source_hypothesis, "\n\n".join(articles_with_reasoning), args.num_init_hyp) # keys : "id_", "hyp_full", "hyp_main"
+            else:
+                generated_hypotheses = checkpoint.run_stage("debate_simulator", debate_simulator, llm, research_plan_config["Attributes"], research_goal, research_plan_config["Preferences"], hyp_after_meta_review, 10) # max turns = 10 / return new hyp_dict (+ "prev_id")
 
-        hyp_after_full_review = full_reviewer(llm, hyp_after_init_review) # keys : "id_", "hyp_full", "hyp_main", "initial_review", "full_review", "related_articles_text"
+                generated_hypotheses += hyp_after_evolution
+            ### exclude assumptions, unexplored_areas for now
+            # assumptions = assumption_identifier(llm, research_goal) # maybe return "assumptions" and their "sub-assumptions" dict?
+            # unexplored_areas = research_expander(llm, visited_hyp_list, reviews_overview)
+        
+            generation_end = time.time()
+            print(f"Generation agent time : {generation_end - generation_start} seconds")
+            print(f"generated hypothesis (num={len(generated_hypotheses)})\n##########################################")
+            tracer.event("generated_hypotheses", level="debug", hypotheses=generated_hypotheses)
 
-        hyp_after_deep_review = deep_reviewer(llm, hyp_after_full_review) # keys : "id_", "hyp_full", "hyp_main", "initial_review", "full_review", "related_articles_text", "deep_review"
+            ## filtering duplicate hypotheses
+            filtering_start = time.time()
+            print(f"Filtering duplicates ...\n##########################################")
+            generated_hypotheses = checkpoint.run_stage("exclude_same_hyp", exclude_same_hyp, llm, research_goal, generated_hypotheses)
+            filtering_end = time.time()
+            print(f"Filtering time (num={len(generated_hypotheses)}): {filtering_end - filtering_start} seconds")
 
-        hyp_after_observation_review = observation_reviewer(llm, hyp_after_deep_review) # keys : "id_", "hyp_full", "hyp_main", "initial_review", "full_review", "related_articles_text", "deep_review", "observation_review"
+            ## 2. reflection agent
+            reflection_start = time.time()
+            print(f"Reflection agent ...\n##########################################")
+            hyp_after_init_review = checkpoint.map_hypotheses("initial_reviewer", remote(initial_reviewer), (llm_review,), generated_hypotheses)
+            hyp_after_init_review = [hyp_dict for hyp_dict in hyp_after_init_review if "INAPPROPRIATE" not in hyp_dict["initial_review"]] # keys : "id_", "hyp_full", "hyp_main", "initial_review"
+            visited_hyp += [hyp_dict["id_"] for hyp_dict in hyp_after_init_review]
 
-        hyp_after_simulation_review = simulation_reviewer(llm, hyp_after_observation_review) # keys : "id_", "hyp_full", "hyp_main", "initial_review", "full_review", "related_articles_text", "deep_review", "observation_review", "simulation_review"
+            # full -> observation review, with deep and simulation reviews alongside, scheduled per hypothesis
+            # (stage by stage when the reviews go through batch jobs)
+            hyp_after_simulation_review = reflection_graph.run((llm_review,), hyp_after_init_review, max_workers=args.max_concurrency, barrier=llm_review.batch_runner is not None, checkpoint=checkpoint, job_queue=job_queue, skip_optional=budget.skip_optional) # keys : "id_", "hyp_full", "hyp_main", "initial_review", "full_review", "related_articles_text", "deep_review", "observation_review", "simulation_review"
 
-        # tournament_review = tournament_reviewer(llm, generated_hypothesis, tournament_results)
+            # tournament_review = tournament_reviewer(llm, generated_hypothesis, tournament_results)
         
-        reflection_end = time.time()
-        print(f"Reflection agent time : {reflection_end - reflection_start} seconds")
+            reflection_end = time.time()
+            print(f"Reflection agent time : {reflection_end - reflection_start} seconds")
         
-        hyp_with_reviews = hyp_after_simulation_review
-
-        if len(hyp_after_meta_review) == 0:
-            # save results (중간)
-            with open(os.path.join(args.save_path, "results_iter1_gen_reflect.jsonl"), "w", encoding="utf-8") as wf:
-                for line in hyp_after_simulation_review:
-                    wf.write(json.dumps(line) + "\n")
-        else:
-            with open(os.path.join(args.save_path, "results_iter2_gen_reflect.jsonl"), "w", encoding="utf-8") as wf:
-                for line in hyp_after_simulation_review:
-                    wf.write(json.dumps(line) + "\n")
+            hyp_with_reviews = hyp_after_simulation_review
 
-        # ### tmp ###
-        # hyp_with_reviews = []
-        # with open("/home/taewhoo/aigen/hypothesis/results_skp2/results_iter1_gen_reflect.jsonl") as rf:
-        #     for line in rf:
-        #         hyp_with_reviews.append(json.loads(line))
+        # save results (중간)
+        with open(os.path.join(save_path, f"results_iter{iteration}_gen_reflect.jsonl"), "w", encoding="utf-8") as wf:
+            for line in hyp_after_simulation_review:
+                wf.write(json.dumps(line, default=json_default) + "\n")
 
         ## 3. proximity agent
         proximity_start = time.time()
         print(f"Proximity agent ...\n##########################################")
-        paired_hypotheses = calculate_proximity(llm, research_goal, hyp_with_reviews) # e.g., [(hyp_dict_a, hyp_dict_b), ...]
+        paired_hypotheses = checkpoint.run_stage("calculate_proximity", calculate_proximity, llm, research_goal, hyp_with_reviews) # e.g., [(hyp_dict_a, hyp_dict_b), ...]
         
         proximity_end = time.time()
         print(f"Proximity agent time : {proximity_end - proximity_start} seconds")
@@ -114,17 +157,20 @@ def main(args):
         ## 4. ranking agent
         ranking_start = time.time()
         print(f"Ranking agent ...\n##########################################")
-        hyp_after_tournament = elo_tournament(llm, research_goal, research_plan_config, paired_hypotheses) # keys : "id_", "hyp_full", "hyp_main", "initial_review", "full_review", "related_articles_text", "deep_review", "observation_review", "simulation_review", "elo_score", "ranking_win_results", "ranking_lose_results"
+        hyp_after_tournament = checkpoint.run_stage("elo_tournament_results", elo_tournament, llm, research_goal, research_plan_config, paired_hypotheses, args.tournament_rounds, checkpoint, job_queue, iteration_controller.initial_elo(hyp_with_reviews)) # keys : "id_", "hyp_full", "hyp_main", "initial_review", "full_review", "related_articles_text", "deep_review", "observation_review", "simulation_review", "elo_score", "ranking_win_results", "ranking_lose_results"
 
         ranking_end = time.time()
         print(f"Ranking agent time : {ranking_end - ranking_start} seconds")
+
+        stop_reason = iteration_controller.observe(iteration, hyp_after_tournament)
+        print(f"Iteration {iteration} : {iteration_controller.history[-1]}\n##########################################")
         
-        if len(hyp_after_meta_review) == 0:
+        if stop_reason is None:
 
             ## 5. evolution agent
             evolution_start = time.time()
             print(f"Evolution agent ...\n##########################################")
-            hyp_after_evolution = evolve_hypotheses(llm, research_goal, research_plan_config["Preferences"], hyp_after_tournament)
+            hyp_after_evolution = checkpoint.run_stage("evolve_hypotheses", remote(evolve_hypotheses), llm, research_goal, research_plan_config["Preferences"], hyp_after_tournament)
             # keys: "id_", "hyp_full"
             evolution_end = time.time()
             print(f"Evolution agent time : {evolution_end - evolution_start} seconds")
@@ -132,40 +178,271 @@ def main(args):
             ## 6. meta-review agent
             meta_start = time.time()
             print(f"Meta-review agent ...\n##########################################")
-            hyp_after_meta_review = metareview_generator(llm, research_goal, research_plan_config["Preferences"], hyp_after_tournament)
+            hyp_after_meta_review = checkpoint.map_hypotheses("metareview_generator", remote(metareview_generator), (llm, research_goal, research_plan_config["Preferences"]), hyp_after_tournament)
 
             meta_end = time.time()
             print(f"Meta agent time : {meta_end - meta_start} seconds")
             
             # save intermediate results
-            with open(os.path.join(args.save_path, "results_iter1.jsonl"), "w", encoding="utf-8") as wf:
+            with open(os.path.join(save_path, f"results_iter{iteration}.jsonl"), "w", encoding="utf-8") as wf:
                 for line in hyp_after_meta_review:
-                    wf.write(json.dumps(line) + "\n")
+                    wf.write(json.dumps(line, default=json_default) + "\n")
 
-            with open(os.path.join(args.save_path, "results_iter1_evolution.jsonl"), "w", encoding="utf-8") as wf:
+            with open(os.path.join(save_path, f"results_iter{iteration}_evolution.jsonl"), "w", encoding="utf-8") as wf:
                 for line in hyp_after_evolution:
-                    wf.write(json.dumps(line) + "\n")
+                    wf.write(json.dumps(line, default=json_default) + "\n")
+            iteration_span.end()
 
         else:
-            with open(os.path.join(args.save_path, "results_iter2.jsonl"), "w", encoding="utf-8") as wf:
+            with open(os.path.join(save_path, f"results_iter{iteration}.jsonl"), "w", encoding="utf-8") as wf:
                 for line in hyp_after_tournament:
-                    wf.write(json.dumps(line) + "\n")
+                    wf.write(json.dumps(line, default=json_default) + "\n")
                     
             ### top scorer is selected
             best_dict = max(hyp_after_tournament, key=lambda x: x["elo_score"])
-            print(f"BEST HYPOTHESIS: {best_dict}\n##########################################")
+            print(f"Stopped after iteration {iteration} ({stop_reason})")
+            print(f"BEST HYPOTHESIS (id={best_dict['id_']}, elo={best_dict['elo_score']:.1f}): {best_dict['hyp_main']}\n##########################################")
+            tracer.event("best_hypothesis", hypothesis=best_dict)
+            iteration_span.end()
+            break
 
+    iteration_controller.save(os.path.join(save_path, "iterations.json"))
+    print(f"Checkpoint stats: {checkpoint.stats()}")
+    checkpoint.close()
+    return hyp_after_tournament
 
+def load_goals(goals_path):
+    # directory of research goal files (one goal per file, named after the file), or JSONL of {"id": ..., "goal": ...}
+    if os.path.isdir(goals_path):
+        goals = []
+        for file_name in sorted(os.listdir(goals_path)):
+            if file_name.startswith("."):
+                continue
+            with open(os.path.join(goals_path, file_name)) as rf:
+                goals.append((os.path.splitext(file_name)[0], rf.read()))
+        return goals
 
-if __name__ == "__main__":
+    goals = []
+    with open(goals_path) as rf:
+        for i, line in enumerate(rf):
+            if line.strip():
+                record = json.loads(line)
+                goals.append((str(record.get("id", i)), record["goal"]))
+    return goals
+
+def run_goals(args, llm, llm_explorator, llm_review, goals, job_queue=None):
+    # up to --max_concurrent_goals goals at once over the shared LLMs, caches and pools; each goal writes to
+    # <save_path>/<goal id>. a failed goal does not stop the others, and can be resumed from its checkpoints
+    def run(goal_id, research_goal):
+        current_goal.set(goal_id)
+        with tracer.span("goal", goal_id):
+            return run_goal(args, llm, llm_explorator, llm_review, research_goal, os.path.join(args.save_path, goal_id), job_queue)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.max_concurrent_goals) as pool:
+        futures = {pool.submit(contextvars.copy_context().run, run, goal_id, research_goal): goal_id for goal_id, research_goal in goals}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                print(f"Goal {futures[future]} done\n##########################################")
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"Goal {futures[future]} failed: {e!r}\n##########################################")
+    print(f"Goals done: {len(goals) - len(failed)}/{len(goals)}" + (f" (failed: {', '.join(failed)})" if failed else ""))
+
+def main(args):
+
+    http_pool.configure(max_connections=args.max_connections, max_keepalive_connections=args.max_keepalive_connections)
+    db_pool.configure(pool_size=args.db_pool_size, max_overflow=args.db_max_overflow)
+    key_pool.configure(API_CONFIG["OPENAI_API_KEY"], requests_per_minute=args.rpm, tokens_per_minute=args.tpm)
+    reranker.configure(args.reranker, device=args.reranker_device, cuda_visible_devices=args.cuda_visible_devices) # loaded on first retrieval
+
+    CONTEXT_BUDGETS.update(
+        related_articles=args.related_articles_token_budget,
+        meta_review=args.meta_review_token_budget,
+        match_results=args.match_results_token_budget,
+    )
+
+    cache = None
+    if args.cache_path:
+        cache = ResponseCache(args.cache_path, max_size_mb=args.cache_max_size_mb, max_age_days=args.cache_max_age_days, read_only=args.cache_read_only, bypass=args.cache_bypass)
+
+    batch_runner = None
+    if args.batch_mode == "openai":
+        batch_runner = BatchRunner(OpenAIBatchEndpoint(key_pool.primary_client), poll_interval=args.batch_poll_interval)
+    elif args.batch_mode == "local":
+        batch_runner = BatchRunner(LocalBatchEndpoint(args.batch_dir), poll_interval=args.batch_poll_interval)
+
+    if args.vllm_base_url:
+        register_vllm_llm(args.vllm_model, args.vllm_base_url, max_batch_size=args.vllm_max_batch_size)
+
+    llm_name, review_llm_name = args.llm, args.review_llm or args.llm
+    if args.replay_mode != "off":
+        replay_latency = args.replay_latency if args.replay_latency == "recorded" or args.replay_latency is None else float(args.replay_latency)
+        llm_name = register_replay_llm(args.llm, args.cassette_path, mode=args.replay_mode, miss_policy=args.replay_miss_policy, latency=replay_latency)
+        if review_llm_name != args.llm:
+            review_llm_name = register_replay_llm(review_llm_name, args.cassette_path, mode=args.replay_mode, miss_policy=args.replay_miss_policy, latency=replay_latency)
+        else:
+            review_llm_name = llm_name
+        if "gpt-4o" not in (args.llm, args.review_llm or args.llm): # reformat model of gpt-o1 and vllm-gpt_reformat (StructuredLLM.reformat_llm_name)
+            register_replay_llm("gpt-4o", args.cassette_path, mode=args.replay_mode, miss_policy=args.replay_miss_policy, latency=replay_latency)
+
+    hedge_policy = None
+    if args.hedge_quantile and args.replay_mode != "replay": # a hedged duplicate would consume the next recorded response
+        hedge_policy = HedgePolicy(quantile=args.hedge_quantile, max_hedge_rate=args.max_hedge_rate, min_delay=args.hedge_min_delay)
+
+    # goals of a batch run share one cap on in-flight requests, handed out fairly between them
+    scheduler = None
+    if args.goals_path:
+        scheduler = FairShareScheduler(max_in_flight=args.max_in_flight or args.max_connections)
+
+    # --max_concurrency caps the in-flight requests of all three clients together, whatever thread or loop sends them
+    limiter = FairShareScheduler(max_in_flight=args.max_concurrency)
+
+    llm = StructuredLLM(llm_name=llm_name, temperature=0.2, max_concurrency=args.max_concurrency, cache=cache, batch_runner=batch_runner, max_parse_attempts=args.max_parse_attempts, parse_token_budget=args.parse_token_budget, hedge_policy=hedge_policy, scheduler=scheduler, limiter=limiter)
+    llm_explorator = StructuredLLM(llm_name=llm_name, temperature=1.0, max_concurrency=args.max_concurrency, cache=cache, max_parse_attempts=args.max_parse_attempts, parse_token_budget=args.parse_token_budget, hedge_policy=hedge_policy, scheduler=scheduler, limiter=limiter)
+    llm_review = llm # high-volume review stages, can be offloaded to a self-hosted model with --review_llm vllm
+    if review_llm_name != llm_name:
+        llm_review = StructuredLLM(llm_name=review_llm_name, temperature=0.2, max_concurrency=args.max_concurrency, cache=cache, max_parse_attempts=args.max_parse_attempts, parse_token_budget=args.parse_token_budget, hedge_policy=hedge_policy, scheduler=scheduler, limiter=limiter)
+
+    # coordinator / worker split over a shared job queue file (--job_queue_path)
+    job_queue = None
+    if args.job_queue_path:
+        job_queue = JobQueue(args.job_queue_path, llms={"llm": llm, "llm_review": llm_review, "llm_explorator": llm_explorator}, lease_seconds=args.job_lease_seconds)
+
+    os.makedirs(args.save_path, exist_ok=True)
+    worker = JobWorker(job_queue, threads=args.worker_threads, idle_timeout=args.worker_idle_timeout) if args.worker else None
+
+    # spans and events of this process, see trace_viewer.py for the stage timeline and critical path
+    trace_path = args.trace_path or os.path.join(args.save_path, f"trace_worker_{worker.worker_id}.jsonl.gz" if worker else "trace.jsonl.gz")
+    tracer.configure(trace_path, level=args.trace_level, sample_rate=args.trace_sample_rate)
+
+    # large hypothesis texts (hypotheses, reviews, match transcripts), shared by every goal of the run
+    blob_store.configure((args.blob_dir or os.path.join(args.save_path, "blobs")) if args.blob_store == "disk" else None)
+
+    # run-level budget : stages degrade as it tightens, and no new iteration starts once it is spent
+    budget.configure(max_tokens=args.budget_tokens, max_seconds=args.budget_seconds, max_cost=args.budget_cost)
+
+    with tracer.span("run", "worker" if worker else "coordinator", llm=llm_name, review_llm=review_llm_name):
+        if worker is not None:
+            print(f"Worker {worker.worker_id} waiting for jobs in {args.job_queue_path} ...\n##########################################")
+            worker.run()
+            print(f"Worker stats: {worker.stats()}")
+            usage_tracker.save(os.path.join(args.save_path, f"metrics_worker_{worker.worker_id}.json"))
+        elif args.goals_path:
+            if job_queue is not None and not args.resume:
+                job_queue.clear()
+            run_goals(args, llm, llm_explorator, llm_review, load_goals(args.goals_path), job_queue)
+        else:
+            if job_queue is not None and not args.resume:
+                job_queue.clear()
+            with open(args.input_path) as rf:
+                research_goal = rf.read() # Develop a novel hypothesis for the key factor or process which causes ALS ...
+            run_goal(args, llm, llm_explorator, llm_review, research_goal, args.save_path, job_queue)
+    tracer.close()
+
+    if not args.worker:
+        usage_tracker.save(os.path.join(args.save_path, "metrics.json"))
+        budget.save(os.path.join(args.save_path, "budget.json"))
+    print(f"LLM usage per stage:\n{usage_tracker.summary_table()}")
+    if scheduler is not None:
+        print(f"LLM cost per goal: " + ", ".join(f"{goal}: ${row['cost']:.4f}" for goal, row in usage_tracker.per_goal().items()))
+        print(f"LLM fair-share stats: {scheduler.stats()}")
+    print(f"LLM rate limiter stats: {key_pool.stats()}")
+    print(f"Blob store stats: {blob_store.stats()}")
+    if batch_runner is not None:
+        print(f"Batch stats: {batch_runner.stats()}")
+    if budget.steps or budget.cuts:
+        print(f"Budget stats: {budget.stats()}")
+    if hedge_policy is not None:
+        print(f"LLM hedging stats: {hedge_policy.stats()}")
+    if job_queue is not None:
+        print(f"Job queue stats: {job_queue.stats()}")
+        job_queue.close()
+    if cache is not None:
+        print(f"LLM cache stats: {cache.stats()}")
+        cache.close()
+
+
+
+def build_parser():
+    # also used by benchmark.py to run main() with synthetic models
     parser = argparse.ArgumentParser()
     parser.add_argument("--llm", type=str, default="gpt-4o")
     parser.add_argument("--input_path", type=str, default=os.path.join(os.path.abspath(os.path.dirname(__file__)), "research_goal_enhertu.txt"))
     parser.add_argument("--save_path", type=str, default=os.path.join(os.path.abspath(os.path.dirname(__file__)), "results_enhertu"))
     parser.add_argument("--log_path", type=str, default=os.path.join(os.path.abspath(os.path.dirname(__file__)), "logs"))
+    parser.add_argument("--goals_path", type=str, default=None, help="run every research goal of a directory (one file per goal) or JSONL ({\"id\", \"goal\"}) instead of --input_path, with outputs in <save_path>/<goal id>")
+    parser.add_argument("--max_concurrent_goals", type=int, default=4, help="goals run at the same time (--goals_path)")
+    parser.add_argument("--max_in_flight", type=int, default=None, help="in-flight LLM requests shared fairly by all goals (--goals_path, default: --max_connections)")
     parser.add_argument("--num_init_hyp", type=int, default=8)
+    parser.add_argument("--max_iters", type=int, default=2, help="max number of generate -> review -> rank -> evolve iterations")
+    parser.add_argument("--max_wall_seconds", type=float, default=None, help="no new iteration starts after this many seconds (unlimited if not given)")
+    parser.add_argument("--max_total_tokens", type=int, default=None, help="no new iteration starts once the run has used this many tokens (unlimited if not given)")
+    parser.add_argument("--convergence_top_k", type=int, default=None, help="stop once the top-k hypotheses come from the same lineages as in the previous iteration (disabled if not given)")
+    parser.add_argument("--min_elo_improvement", type=float, default=None, help="stop once the best Elo score improves by less than this over the previous iteration (disabled if not given)")
+    parser.add_argument("--budget_tokens", type=int, default=None, help="run-level token budget over all goals and stages : stages degrade as it tightens (unlimited if not given)")
+    parser.add_argument("--budget_seconds", type=float, default=None, help="run-level wall-clock budget (unlimited if not given)")
+    parser.add_argument("--budget_cost", type=float, default=None, help="run-level budget in USD (unlimited if not given)")
+    parser.add_argument("--tournament_rounds", type=int, default=4, help="winner/loser bracket rounds after the initial round of the Elo tournament")
+    parser.add_argument("--max_concurrency", type=int, default=8, help="max number of in-flight LLM requests, shared by all stages and threads")
+    parser.add_argument("--max_connections", type=int, default=100, help="size of the HTTP connection pool shared by all LLM clients")
+    parser.add_argument("--max_keepalive_connections", type=int, default=20)
+    parser.add_argument("--db_pool_size", type=int, default=5, help="connections kept open to the article database, shared by all agents and goals")
+    parser.add_argument("--db_max_overflow", type=int, default=10)
+    parser.add_argument("--rpm", type=int, default=None, help="requests/min budget per API key, shared by all LLM calls (unlimited if not given)")
+    parser.add_argument("--tpm", type=int, default=None, help="tokens/min budget per API key, shared by all LLM calls (unlimited if not given)")
+    parser.add_argument("--cache_path", type=str, default=None, help="sqlite file for the LLM response cache (disabled if not given)")
+    parser.add_argument("--cache_max_size_mb", type=float, default=1024)
+    parser.add_argument("--cache_max_age_days", type=float, default=None)
+    parser.add_argument("--cache_read_only", action="store_true", help="read from the cache but never write to it")
+    parser.add_argument("--cache_bypass", action="store_true", help="skip cache lookups (fresh responses are still stored)")
+    parser.add_argument("--batch_mode", type=str, default="off", choices=["off", "openai", "local"], help="send non-interactive stages (deep/observation/simulation review, meta-review) as batch jobs")
+    parser.add_argument("--batch_dir", type=str, default=os.path.join(os.path.abspath(os.path.dirname(__file__)), "batches"), help="directory of the local batch stand-in (--batch_mode local)")
+    parser.add_argument("--batch_poll_interval", type=float, default=30.0)
+    parser.add_argument("--replay_mode", type=str, default="off", choices=["off", "record", "replay"], help="record LLM responses to --cassette_path, or replay them offline")
+    parser.add_argument("--cassette_path", type=str, default=os.path.join(os.path.abspath(os.path.dirname(__file__)), "cassettes", "run.jsonl"))
+    parser.add_argument("--replay_miss_policy", type=str, default="fail", choices=["fail", "fallthrough"], help="on a replay miss, raise or call the real model")
+    parser.add_argument("--replay_latency", type=str, default=None, help="simulated latency per replayed call : seconds, or 'recorded'")
+    parser.add_argument("--max_parse_attempts", type=int, default=3, help="free-text attempts per parsed response before falling back to structured output")
+    parser.add_argument("--parse_token_budget", type=int, default=None, help="approx. tokens a single parsed response may spend on retries (unlimited if not given)")
+    parser.add_argument("--review_llm", type=str, default=None, help="model for the initial/full/deep/observation/simulation reviews (defaults to --llm), e.g. vllm")
+    parser.add_argument("--vllm_base_url", type=str, default=None, help="OpenAI-compatible server backing the 'vllm' models (default: $VLLM_BASE_URL or http://localhost:8000/v1)")
+    parser.add_argument("--vllm_model", type=str, default="default", help="model name served at --vllm_base_url")
+    parser.add_argument("--vllm_max_batch_size", type=int, default=32, help="max concurrent requests flushed together to the local server")
+    parser.add_argument("--related_articles_token_budget", type=int, default=8000, help="token budget for the retrieved articles in the full review (lowest-ranked articles are dropped first)")
+    parser.add_argument("--meta_review_token_budget", type=int, default=12000, help="token budget for the reviews and match transcripts in the meta-review (older transcripts are condensed first)")
+    parser.add_argument("--match_results_token_budget", type=int, default=4000, help="token budget for the lost match transcripts in the evolution agent")
+    parser.add_argument("--hedge_quantile", type=float, default=None, help="send a duplicate request once a call exceeds this latency quantile of its stage, e.g. 0.95 (disabled if not given)")
+    parser.add_argument("--max_hedge_rate", type=float, default=0.05, help="max share of requests that may be hedged")
+    parser.add_argument("--hedge_min_delay", type=float, default=2.0, help="never hedge a call that has run for less than this many seconds")
+    parser.add_argument("--pipeline_mode", type=str, default="stages", choices=["stages", "streaming"], help="streaming : review each hypothesis as soon as it is generated, with deduplication, proximity and ranking as the only sync points")
+    parser.add_argument("--max_pending_hypotheses", type=int, default=16, help="generated hypotheses waiting for review before generation blocks (--pipeline_mode streaming)")
+    parser.add_argument("--checkpoint_path", type=str, default=None, help="sqlite file recording finished stages per hypothesis (default: <save_path>/checkpoints.sqlite)")
+    parser.add_argument("--resume", action="store_true", help="restore finished stages from --checkpoint_path instead of starting over")
+    parser.add_argument("--job_queue_path", type=str, default=None, help="sqlite job queue shared with worker processes : reviews, matches, evolution and meta-reviews are run by the workers (local if not given)")
+    parser.add_argument("--worker", action="store_true", help="run as a worker on --job_queue_path instead of a coordinator (takes the same model arguments)")
+    parser.add_argument("--worker_threads", type=int, default=4, help="jobs run at the same time by one worker process")
+    parser.add_argument("--worker_idle_timeout", type=float, default=None, help="worker exits once the queue has been empty this many seconds (runs forever if not given)")
+    parser.add_argument("--job_lease_seconds", type=float, default=300, help="a job whose worker stops renewing its lease for this long goes back to the queue")
+    parser.add_argument("--trace_path", type=str, default=None, help="trace file of spans and events (default: <save_path>/trace.jsonl.gz), see trace_viewer.py")
+    parser.add_argument("--trace_level", type=str, default="info", choices=["off", "warning", "info", "debug"], help="debug adds prompts, responses and full reviews")
+    parser.add_argument("--trace_sample_rate", type=float, default=1.0, help="share of hypotheses whose debug-level content is traced")
+    parser.add_argument("--reranker", type=str, default=None, help=f"cross-encoder reranking retrieved article chunks, e.g. {MEDCPT_CROSS_ENCODER} (off if not given; loads torch and transformers)")
+    parser.add_argument("--reranker_device", type=str, default="cuda")
+    parser.add_argument("--cuda_visible_devices", type=str, default="0", help="CUDA_VISIBLE_DEVICES set before the reranker is loaded")
+    parser.add_argument("--blob_store", type=str, default="memory", choices=["memory", "disk"], help="where large hypothesis texts are kept : disk appends them to --blob_dir and result files and checkpoints reference them by key")
+    parser.add_argument("--blob_dir", type=str, default=None, help="blob directory for --blob_store disk (default: <save_path>/blobs)")
     parser.add_argument("--command", type=str, help="The command that was run")
+    return parser
 
-
+if __name__ == "__main__":
+    parser = build_parser()
     args = parser.parse_args()
+    if args.pipeline_mode == "streaming" and args.batch_mode != "off":
+        parser.error("--pipeline_mode streaming reviews one hypothesis at a time and cannot be combined with --batch_mode")
+    if args.worker and not args.job_queue_path:
+        parser.error("--worker needs --job_queue_path")
+    if args.goals_path and args.checkpoint_path:
+        parser.error("--goals_path keeps one checkpoint file per goal in its output directory and cannot be combined with --checkpoint_path")
     main(args)
\ No newline at end of file
@@ -0,0 +1,123 @@
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+class Task:
+    def __init__(self, name, fn, inputs, outputs, optional=False):
+        self.name = name
+        self.fn = fn # stage function fn(*args, [hyp_dict]) -> [hyp_dict] (or [] to drop the hypothesis)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.optional = optional # may be skipped (outputs left empty) to save budget
+
+class TaskGraph:
+    # per-hypothesis task graph : every (hypothesis, task) pair is a node that becomes ready as soon as the
+    # tasks producing its input keys have finished for that hypothesis, so a hypothesis does not wait for the
+    # slowest one of a stage before moving on. ready nodes run on a thread pool, which only carries the sync parts of a
+    # stage (prompts, article search, parsing) : their LLM requests go through models.run_concurrently to the shared
+    # event loop (event_loop.llm_loop), so every node uses the same loop, clients and connections
+    def __init__(self, name):
+        self.name = name
+        self.tasks = {}
+
+    def task(self, inputs=(), outputs=(), name=None, optional=False):
+        # decorator registering a stage function as a task of this graph
+        def register(fn):
+            task_name = name or fn.__name__
+            self.tasks[task_name] = Task(task_name, fn, inputs, outputs, optional)
+            return fn
+        return register
+
+    def dependencies(self):
+        producers = {}
+        for task in self.tasks.values():
+            for key in task.outputs:
+                producers[key] = task.name
+        return {task.name: {producers[key] for key in task.inputs if key in producers and producers[key] != task.name} for task in self.tasks.values()}
+
+    def order(self):
+        # tasks in dependency order (used for barrier mode, and to fail early on cycles)
+        dependencies, ordered = self.dependencies(), []
+        while len(ordered) < len(self.tasks):
+            ready = [name for name in self.tasks if name not in ordered and dependencies[name] <= set(ordered)]
+            if not ready:
+                raise ValueError(f"cyclic dependencies in task graph {self.name}: {dependencies}")
+            ordered += ready
+        return ordered
+
+    def skip(self, name, hyp_dicts, skip_optional):
+        # fills the outputs of a skipped optional task with "" (not checkpointed, so a resumed run may still run it)
+        if skip_optional is None or not self.tasks[name].optional or not skip_optional(name):
+            return False
+        for hyp_dict in hyp_dicts:
+            hyp_dict.update({key: "" for key in self.tasks[name].outputs})
+        return True
+
+    def run(self, args, hypotheses, max_workers=8, barrier=False, checkpoint=None, job_queue=None, skip_optional=None):
+        # args : leading arguments of every stage function (e.g. (llm,)). returns the hypotheses that were not dropped, in order.
+        # barrier=True runs one task at a time over all hypotheses (needed when a stage is sent as one batch job).
+        # with a checkpoint.CheckpointStore, the outputs of every finished node are stored and restored instead of recomputed.
+        # with a job_queue.JobQueue, every node is sent to the worker processes.
+        # skip_optional(task name) -> bool is asked before each node of an optional task (e.g. budget.skip_optional)
+        functions = {name: job_queue.remote(task.fn) if job_queue is not None else task.fn for name, task in self.tasks.items()}
+        if barrier:
+            for name in self.order():
+                if self.skip(name, hypotheses, skip_optional):
+                    continue
+                if checkpoint is not None:
+                    hypotheses = checkpoint.map_hypotheses(name, functions[name], args, hypotheses)
+                else:
+                    hypotheses = functions[name](*args, hypotheses)
+            return hypotheses
+
+        dependencies = self.dependencies()
+        order = self.order()
+        results = list(hypotheses)
+        finished = [set() for _ in results]
+        started = [set() for _ in results]
+        dropped = set()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            running = {}
+
+            def submit_ready():
+                for i, hyp_dict in enumerate(results):
+                    if i in dropped:
+                        continue
+                    for name in order: # dependency order, so restored nodes unlock their dependents in the same pass
+                        if name not in started[i] and dependencies[name] <= finished[i]:
+                            started[i].add(name)
+                            if checkpoint is not None:
+                                hit, outputs = checkpoint.get(name, hyp_dict["id_"])
+                                if hit:
+                                    hyp_dict.update(outputs)
+                                    finished[i].add(name)
+                                    continue
+                            if self.skip(name, [hyp_dict], skip_optional):
+                                finished[i].add(name)
+                                continue
+                            context = contextvars.copy_context() # keep iteration / stage attribution in the worker thread
+                            running[pool.submit(context.run, functions[name], *args, [hyp_dict])] = (i, name)
+
+            submit_ready()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, name = running.pop(future)
+                    try:
+                        output = future.result()
+                    except Exception:
+                        for other in running:
+                            other.cancel()
+                        raise
+                    if output:
+                        # concurrent tasks of one hypothesis only contribute their declared output keys
+                        outputs = {key: output[0][key] for key in self.tasks[name].outputs if key in output[0]}
+                        results[i].update(outputs)
+                        finished[i].add(name)
+                        if checkpoint is not None:
+                            checkpoint.put(name, results[i]["id_"], outputs)
+                    else:
+                        dropped.add(i)
+                submit_ready()
+
+        return [hyp_dict for i, hyp_dict in enumerate(results) if i not in dropped]
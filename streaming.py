@@ -0,0 +1,89 @@
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+_DONE = object()
+
+class HypothesisStream:
+    # producer/consumer pipeline : every producer() returns a list of new hypotheses (e.g. one explorator sample,
+    # one debate, the evolution of one hypothesis), and each hypothesis is handed to consumer(hyp_dict) -> [hyp_dict, ...]
+    # as soon as it exists. the queue between them is bounded, so producers block when the consumers fall behind
+    def __init__(self, max_producers=8, max_consumers=8, max_pending=16, poll_interval=0.05):
+        self.max_producers = max_producers
+        self.max_consumers = max_consumers
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.num_produced = 0
+        self.num_results = 0
+        self.first_result_seconds = None
+        self.total_seconds = None
+
+    def iterate(self, producers, consumer):
+        # yields consumer results in completion order
+        items = queue.Queue(maxsize=self.max_pending)
+        stop = threading.Event()
+        start = time.monotonic()
+        self.num_produced, self.num_results, self.first_result_seconds = 0, 0, None
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=self.poll_interval)
+                    return
+                except queue.Full: # back-pressure
+                    continue
+
+        def produce(producer):
+            for hyp_dict in producer():
+                put(hyp_dict)
+
+        with ThreadPoolExecutor(max_workers=self.max_producers) as producer_pool, ThreadPoolExecutor(max_workers=self.max_consumers) as consumer_pool:
+            # each task gets its own copy of the context (iteration / stage attribution)
+            producer_futures = [producer_pool.submit(contextvars.copy_context().run, produce, producer) for producer in producers]
+            closer = threading.Thread(target=lambda: (wait(producer_futures), put(_DONE)), daemon=True)
+            closer.start()
+
+            running, finished = set(), False
+            try:
+                while not finished or running:
+                    while not finished and len(running) < self.max_consumers:
+                        try:
+                            item = items.get(timeout=self.poll_interval if running else None)
+                        except queue.Empty:
+                            break
+                        if item is _DONE:
+                            finished = True
+                            break
+                        self.num_produced += 1
+                        running.add(consumer_pool.submit(contextvars.copy_context().run, consumer, item))
+
+                    if not running:
+                        continue
+                    done, running = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for result in future.result():
+                            if self.first_result_seconds is None:
+                                self.first_result_seconds = time.monotonic() - start
+                            self.num_results += 1
+                            yield result
+
+                for future in producer_futures: # surface producer errors
+                    future.result()
+            finally:
+                stop.set()
+                for future in running:
+                    future.cancel()
+                self.total_seconds = time.monotonic() - start
+
+    def run(self, producers, consumer):
+        return list(self.iterate(producers, consumer))
+
+    def stats(self):
+        return {
+            "produced": self.num_produced,
+            "results": self.num_results,
+            "first_result_seconds": round(self.first_result_seconds, 3) if self.first_result_seconds is not None else None,
+            "total_seconds": round(self.total_seconds, 3) if self.total_seconds is not None else None,
+        }
@@ -0,0 +1,18 @@
+from cache import ResponseCache
+
+def stored_size(cache):
+    return cache._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+def test_eviction_keeps_size_under_limit(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"), max_size_mb=0.01)
+    for i in range(200):
+        cache.put(f"key {i}", "x" * 100)
+        cache.put(f"key {i // 2}", "y" * 150) # replaces an entry (or re-adds an evicted one)
+    assert stored_size(cache) <= cache.max_size_bytes
+    assert cache.stats()["size_bytes"] == stored_size(cache)
+    assert cache.get("key 199") == (True, "x" * 100)
+    assert cache.get("key 0") == (False, None) # least recently used
+    cache.close()
+
+    reopened = ResponseCache(str(tmp_path / "cache.db"), max_size_mb=0.01)
+    assert reopened.stats()["size_bytes"] == stored_size(reopened)
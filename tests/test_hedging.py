@@ -0,0 +1,48 @@
+import asyncio
+import threading
+
+from hedging import HedgePolicy
+from metrics import current_stage
+from models import StructuredLLM, register_llm
+
+class SlowModel:
+    # first request is slow, the others fast; records the peak number of requests in flight
+    model_name = "slow"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = self.in_flight = self.peak = 0
+
+    async def ainvoke(self, messages, temperature):
+        with self._lock:
+            self.calls += 1
+            latency = 0.5 if self.calls == 1 else 0.01
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        return type("Response", (), {"content": "answer"})()
+
+def hedged_llm(max_concurrency):
+    model = SlowModel()
+    register_llm(f"slow-{max_concurrency}", lambda: model)
+    policy = HedgePolicy(max_hedge_rate=1.0, min_samples=1, min_delay=0.05)
+    policy.observe(current_stage.get(), 0.01)
+    return StructuredLLM(llm_name=f"slow-{max_concurrency}", max_concurrency=max_concurrency, hedge_policy=policy), model, policy
+
+def test_hedge_takes_a_free_slot():
+    llm, model, policy = hedged_llm(max_concurrency=2)
+    assert llm.chat([{"role": "user", "content": "q"}]) == "answer"
+    assert model.peak == 2
+    assert policy.stats()["hedges"] == 1
+    assert policy.stats()["hedge_wins"] == 1
+
+def test_hedge_is_skipped_without_a_free_slot():
+    llm, model, policy = hedged_llm(max_concurrency=1)
+    assert llm.chat([{"role": "user", "content": "q"}]) == "answer"
+    assert model.peak == 1
+    assert policy.stats()["hedges"] == 0
+    assert policy.stats()["skipped_no_slot"] == 1
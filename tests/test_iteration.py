@@ -0,0 +1,12 @@
+from iteration import IterationController
+
+def test_elo_carries_over_between_iterations():
+    controller = IterationController(max_iters=5, min_improvement=10)
+    assert controller.observe(1, [{"id_": "a", "elo_score": 1260}, {"id_": "b", "elo_score": 1140}]) is None
+
+    # b survives, c evolved from a, d is new
+    hypotheses = [{"id_": "b"}, {"id_": "c", "prev_id": "a"}, {"id_": "d"}]
+    assert controller.initial_elo(hypotheses) == {"b": 1140, "c": 1260}
+
+    # c starts at 1260 : ending at 1265 is a small improvement, not a jump from 1200
+    assert controller.observe(2, [{"id_": "c", "prev_id": "a", "elo_score": 1265}, {"id_": "b", "elo_score": 1150}, {"id_": "d", "elo_score": 1185}]) == "no_improvement"
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import time
+
+from models import StructuredLLM, register_llm, run_concurrently
+
+class CountingModel:
+    # records the peak number of requests in flight at once, whatever thread or loop sends them
+    model_name = "counting"
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.in_flight = self.peak = 0
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def exit(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    async def ainvoke(self, messages, temperature):
+        self.enter()
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.exit()
+        return type("Response", (), {"content": messages[-1]["content"]})()
+
+counting_model = CountingModel()
+register_llm("counting", lambda: counting_model)
+
+def test_max_concurrency_holds_across_threads():
+    llm = StructuredLLM(llm_name="counting", max_concurrency=2)
+    results = {}
+
+    def fan_out(thread):
+        messages_list = [[{"role": "user", "content": f"{thread}-{i}"}] for i in range(6)]
+        results[thread] = llm.chat_many(messages_list)
+
+    def single(thread):
+        results[thread] = [llm.chat([{"role": "user", "content": f"{thread}-0"}])]
+
+    threads = [threading.Thread(target=fan_out, args=(i,)) for i in range(3)] + [threading.Thread(target=single, args=(3,))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counting_model.peak == 2
+    assert results[0] == [f"0-{i}" for i in range(6)]
+    assert results[3] == ["3-0"]
+    assert time.perf_counter() - start >= 19 * counting_model.latency / 2
+
+def test_threads_share_one_loop_and_client():
+    from http_pool import http_pool
+
+    async def client_id():
+        return id(asyncio.get_running_loop()), id(http_pool.async_client())
+
+    ids = []
+    threads = [threading.Thread(target=lambda: ids.append(run_concurrently([client_id()])[0])) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ids.append(run_concurrently([client_id()])[0])
+    assert len(set(ids)) == 1
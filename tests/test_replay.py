@@ -0,0 +1,64 @@
+import json
+
+import pytest
+from pydantic import BaseModel
+
+import models
+import replay
+from fake_llm import FakeModel, LatencyModel
+from models import StructuredLLM, register_llm
+from replay import register_replay_llm
+from vllm_server import ModelVLLM, StandInServer
+
+MESSAGES = [{"role": "user", "content": "Which hypothesis is better supported?"}]
+
+class Verdict(BaseModel):
+    winner: int
+    reason: str
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    # every test registers its own backends, and replays from a fresh cassette object as a new process would
+    monkeypatch.setattr(models, "LLM_REGISTRY", dict(models.LLM_REGISTRY))
+    monkeypatch.setattr(models, "_llm_instances", {})
+    monkeypatch.setattr(replay, "_cassettes", {})
+
+def new_process():
+    models._llm_instances.clear()
+    replay._cassettes.clear()
+
+def responder(body):
+    if body.get("guided_json"):
+        return json.dumps({"winner": 2, "reason": "better supported"})
+    return "Hypothesis 2 is better supported."
+
+def test_replay_vllm_with_return_format(tmp_path):
+    cassette_path = str(tmp_path / "cassette.jsonl")
+    with StandInServer(responder=responder) as server:
+        register_llm("vllm", lambda: ModelVLLM("stand-in", server.base_url))
+        recorded = StructuredLLM(register_replay_llm("vllm", cassette_path, mode="record")).chat(MESSAGES, return_format=Verdict)
+    assert recorded["winner"] == 2
+
+    new_process() # the server is gone : any live request would fail
+    replayed = StructuredLLM(register_replay_llm("vllm", cassette_path, mode="replay")).chat(MESSAGES, return_format=Verdict)
+    assert replayed == recorded
+    kinds = [json.loads(line)["kind"] for line in open(cassette_path, encoding="utf-8")]
+    assert kinds == ["chat", "reformat"]
+
+def test_replay_reformat_model_is_wrapped(tmp_path):
+    # gpt-o1 answers in text and gpt-4o reformats : both steps are recorded and replayed
+    cassette_path = str(tmp_path / "cassette.jsonl")
+    for name in ("gpt-o1", "gpt-4o"):
+        model = FakeModel(model_name=name, latency=LatencyModel("fixed", mean=0.0))
+        register_llm(name, lambda model=model: model)
+    register_replay_llm("gpt-4o", cassette_path, mode="record")
+    recorded = StructuredLLM(register_replay_llm("gpt-o1", cassette_path, mode="record")).chat(MESSAGES, return_format=Verdict)
+
+    new_process()
+    for name in ("gpt-o1", "gpt-4o"):
+        model = FakeModel(model_name=name, failure_rate=1.0, max_retries=0, latency=LatencyModel("fixed", mean=0.0))
+        register_llm(name, lambda model=model: model)
+    register_replay_llm("gpt-4o", cassette_path, mode="replay")
+    replayed = StructuredLLM(register_replay_llm("gpt-o1", cassette_path, mode="replay")).chat(MESSAGES, return_format=Verdict)
+    assert replayed == recorded
+    assert {json.loads(line)["model"] for line in open(cassette_path, encoding="utf-8")} == {"gpt-o1", "gpt-4o"}
@@ -0,0 +1,29 @@
+import asyncio
+
+from models import run_concurrently
+from scheduler import TaskGraph
+
+def test_nodes_share_one_event_loop():
+    graph = TaskGraph("test")
+    loops = set()
+
+    async def request(text):
+        loops.add(id(asyncio.get_running_loop()))
+        await asyncio.sleep(0.01)
+        return text
+
+    @graph.task(inputs=["hyp_full"], outputs=["review"])
+    def review(hypotheses):
+        [hyp_dict] = hypotheses
+        return [{**hyp_dict, "review": run_concurrently([request(f"review of {hyp_dict['hyp_full']}")])[0]}]
+
+    @graph.task(inputs=["review"], outputs=["meta_review"])
+    def meta_review(hypotheses):
+        [hyp_dict] = hypotheses
+        return [{**hyp_dict, "meta_review": run_concurrently([request(f"meta {hyp_dict['review']}")])[0]}]
+
+    hypotheses = [{"id_": str(i), "hyp_full": f"h{i}"} for i in range(6)]
+    results = graph.run((), hypotheses, max_workers=4)
+
+    assert [hyp_dict["meta_review"] for hyp_dict in results] == [f"meta review of h{i}" for i in range(6)]
+    assert len(loops) == 1
@@ -0,0 +1,52 @@
+import functools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import pytest
+
+# cold-start budget of the pipeline CLI : run_pipeline is imported (and its parser built) in fresh interpreters,
+# which must stay fast, small, and free of the modules that are only imported on first use (reranker, article
+# database, API clients)
+
+MAX_SECONDS = 0.75 # median wall time, interpreter startup included
+MAX_RSS_MB = 100
+RUNS = 5
+LAZY_MODULES = ["torch", "transformers", "pubmed_parser", "numpy", "sqlalchemy", "openai", "tiktoken"]
+
+PROBE = """
+import json, sys
+import run_pipeline
+run_pipeline.build_parser()
+from metrics import peak_rss_mb
+print(json.dumps({"max_rss_mb": peak_rss_mb(), "modules": sorted({name.split(".")[0] for name in sys.modules})}))
+"""
+
+def probe():
+    # -> (seconds, result of PROBE) for one fresh interpreter
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", PROBE], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if completed.returncode != 0:
+        pytest.fail(f"importing run_pipeline failed:\n{completed.stderr}", pytrace=False)
+    return seconds, json.loads(completed.stdout.strip().splitlines()[-1])
+
+@functools.cache # shared by the tests below; a failed import fails each of them
+def runs():
+    probe() # warm the file system cache and the bytecode
+    return [probe() for _ in range(RUNS)]
+
+def test_startup_time():
+    seconds = statistics.median(seconds for seconds, _ in runs())
+    assert seconds <= MAX_SECONDS, f"startup took {seconds:.3f} s (median of {RUNS}, budget {MAX_SECONDS} s)"
+
+def test_startup_memory():
+    max_rss_mb = max(result["max_rss_mb"] for _, result in runs())
+    assert max_rss_mb <= MAX_RSS_MB, f"peak RSS {max_rss_mb:.1f} MB at startup (budget {MAX_RSS_MB} MB)"
+
+def test_no_heavy_imports_at_startup():
+    loaded = [name for name in LAZY_MODULES if name in runs()[0][1]["modules"]]
+    assert not loaded, f"imported at startup : {', '.join(loaded)}"
@@ -0,0 +1,97 @@
+import asyncio
+import itertools
+import json
+import threading
+
+import pytest
+from pydantic import BaseModel
+
+from vllm_server import ModelVLLM, StandInServer
+
+MESSAGES = [{"role": "user", "content": "Propose a hypothesis."}]
+
+def numbered_responder():
+    # a different content per generated choice, so merged requests can be told apart
+    counter = itertools.count(1)
+    return lambda body: f"response {next(counter)}"
+
+@pytest.fixture
+def server():
+    with StandInServer(responder=numbered_responder()) as server:
+        yield server
+
+def test_identical_requests_are_merged(server):
+    model = ModelVLLM("stand-in", server.base_url, max_batch_size=32, batch_wait=0.05)
+
+    async def run():
+        return await asyncio.gather(*[model.ainvoke(MESSAGES, temperature=1.0) for _ in range(4)])
+
+    responses = asyncio.run(run())
+    assert len(server.requests) == 1
+    assert server.requests[0]["n"] == 4
+    assert sorted(response.content for response in responses) == [f"response {i}" for i in range(1, 5)]
+    assert model.stats() == {"requests": 1, "flushes": 1}
+
+def test_requests_from_several_threads_are_merged(server):
+    # each thread runs its own loop (like sync chat, task graph nodes and stream workers used to)
+    model = ModelVLLM("stand-in", server.base_url, max_batch_size=32, batch_wait=0.2)
+    barrier = threading.Barrier(4)
+    responses = []
+
+    def call():
+        barrier.wait()
+        responses.append(asyncio.run(model.ainvoke(MESSAGES, temperature=1.0)))
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(server.requests) == 1
+    assert server.requests[0]["n"] == 4
+    assert sorted(response.content for response in responses) == [f"response {i}" for i in range(1, 5)]
+    assert model.stats() == {"requests": 1, "flushes": 1}
+
+def test_max_batch_size_flushes_early(server):
+    model = ModelVLLM("stand-in", server.base_url, max_batch_size=3, batch_wait=30)
+
+    async def run():
+        messages_list = [[{"role": "user", "content": f"Propose hypothesis {i}."}] for i in range(3)]
+        return await asyncio.wait_for(asyncio.gather(*[model.ainvoke(messages) for messages in messages_list]), timeout=10)
+
+    responses = asyncio.run(run()) # well before batch_wait
+    assert len(responses) == 3
+    assert len(server.requests) == 3
+    assert all(body["n"] == 1 for body in server.requests)
+    assert model.stats() == {"requests": 3, "flushes": 1}
+
+class Verdict(BaseModel):
+    winner: int
+    reason: str
+
+def test_areformat_parses_server_json():
+    answer = {"winner": 2, "reason": "better supported"}
+    with StandInServer(responder=lambda body: f"Here is the JSON:\n{json.dumps(answer)}\nDone.") as server:
+        model = ModelVLLM("stand-in", server.base_url)
+        parsed = asyncio.run(model.areformat([{"role": "system", "content": "Reformat."}, *MESSAGES], Verdict))
+
+    assert parsed == answer
+    assert server.requests[0]["guided_json"] == Verdict.schema()
+    assert "JSON schema" in server.requests[0]["messages"][0]["content"]
+
+def test_server_error_reaches_every_future():
+    def failing(body):
+        raise RuntimeError("model crashed")
+
+    with StandInServer(responder=failing) as server:
+        model = ModelVLLM("stand-in", server.base_url, batch_wait=0.05)
+
+        async def run():
+            return await asyncio.gather(*[model.ainvoke(MESSAGES) for _ in range(3)], return_exceptions=True)
+
+        results = asyncio.run(run())
+
+    assert len(results) == 3
+    assert all(isinstance(result, Exception) for result in results)
+    assert all(body["n"] == 3 for body in server.requests) # one merged request (retried by the client)
@@ -0,0 +1,124 @@
+import argparse
+import gzip
+import json
+from collections import defaultdict
+
+# offline viewer for the trace files written by tracing.Tracer (run_pipeline --trace_path) :
+# a timeline of the top-level stages, and the critical path of the run broken down by stage and model
+
+BAR_WIDTH = 50
+EPSILON = 1e-6
+
+def load_trace(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    spans, events = {}, []
+    with opener(path, "rt", encoding="utf-8") as rf:
+        for line in rf:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["k"] == "span":
+                spans[record["id"]] = record
+            elif record["k"] == "event":
+                events.append(record)
+    return spans, events
+
+def ancestors(span, spans):
+    while span["p"] is not None and span["p"] in spans:
+        span = spans[span["p"]]
+        yield span
+
+def label(span):
+    if span["kind"] == "llm":
+        return f"llm:{span['name']}"
+    if span["kind"] in ("hypothesis", "job"):
+        return span["kind"]
+    return f"{span['kind']}:{span['name']}"
+
+def stage_timeline(spans, start, end):
+    # top-level stages (nested stages are part of their parent), in start order, grouped by goal and iteration
+    lines = [f"{'t0 s':>9}{'dur s':>9}  {'stage':<40}{'llm calls':>10}{'tokens':>10}  timeline"]
+    scale = BAR_WIDTH / max(end - start, EPSILON)
+    group = None
+    for span in sorted(spans.values(), key=lambda span: span["t0"]):
+        if span["kind"] != "stage" or any(parent["kind"] == "stage" for parent in ancestors(span, spans)):
+            continue
+        span_group = " / ".join(parent["name"] for parent in reversed(list(ancestors(span, spans))) if parent["kind"] in ("goal", "iteration"))
+        if span_group != group:
+            group = span_group
+            lines.append(f"[{group or 'run'}]")
+
+        calls = tokens = 0
+        for other in spans.values():
+            if other["kind"] == "llm" and span in ancestors(other, spans):
+                calls += 1
+                tokens += other["a"].get("prompt_tokens", 0) + other["a"].get("completion_tokens", 0)
+        offset = int((span["t0"] - start) * scale)
+        width = max(1, int((span["t1"] - span["t0"]) * scale))
+        lines.append(f"{span['t0'] - start:>9.2f}{span['t1'] - span['t0']:>9.2f}  {span['name']:<40}{calls:>10}{tokens:>10}  {' ' * offset}{'#' * width}")
+    return "\n".join(lines)
+
+def critical_path(span, children):
+    # segments (span, t0, t1) on the longest chain, latest first : walking back from the end of the span,
+    # the child that finished last is on the path, then whatever finished last before that child started
+    segments, cursor = [], span["t1"]
+    while True:
+        candidates = [child for child in children[span["id"]] if child["t0"] < cursor and child["t1"] <= cursor + EPSILON]
+        if not candidates:
+            break
+        child = max(candidates, key=lambda child: child["t1"])
+        if cursor - child["t1"] > EPSILON:
+            segments.append((span, child["t1"], cursor))
+        segments += critical_path(child, children)
+        cursor = child["t0"]
+    if cursor - span["t0"] > EPSILON:
+        segments.append((span, span["t0"], cursor))
+    return segments
+
+def critical_path_report(root, spans, top):
+    children = defaultdict(list)
+    for span in spans.values():
+        children[span["p"]].append(span)
+    segments = critical_path(root, children)[::-1]
+    total = root["t1"] - root["t0"]
+
+    breakdown = defaultdict(float)
+    for span, t0, t1 in segments:
+        stage = next((parent["name"] for parent in [span, *ancestors(span, spans)] if parent["kind"] == "stage"), "-")
+        breakdown[(stage, label(span))] += t1 - t0
+
+    lines = [f"critical path of {label(root)} : {total:.2f} s", f"{'stage':<40}{'spent in':<40}{'s':>9}{'%':>7}"]
+    for (stage, spent_in), seconds in sorted(breakdown.items(), key=lambda item: item[1], reverse=True)[:top]:
+        lines.append(f"{stage:<40}{spent_in:<40}{seconds:>9.2f}{100 * seconds / max(total, EPSILON):>7.1f}")
+    return "\n".join(lines)
+
+def main(args):
+    spans, events = load_trace(args.trace_path)
+    if not spans:
+        print("no spans in trace")
+        return
+    roots = [span for span in spans.values() if span["p"] is None or span["p"] not in spans]
+    root = max(roots, key=lambda span: span["t1"] - span["t0"])
+    if args.goal:
+        root = next(span for span in spans.values() if span["kind"] == "goal" and span["name"] == args.goal)
+        spans = {span_id: span for span_id, span in spans.items() if span is root or root in ancestors(span, spans)}
+
+    print(f"Stage timeline\n##########################################")
+    print(stage_timeline(spans, root["t0"], root["t1"]))
+    print(f"\nCritical path\n##########################################")
+    print(critical_path_report(root, spans, args.top))
+    if args.events:
+        print(f"\nEvents\n##########################################")
+        for event in events:
+            if args.events == "all" or event["name"] == args.events:
+                print(f"{event['t']:>9.2f}  {event['name']:<24}{json.dumps(event['a'], ensure_ascii=False)[:args.max_chars]}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace_path", type=str)
+    parser.add_argument("--goal", type=str, default=None, help="only the spans of one goal of a batch run")
+    parser.add_argument("--top", type=int, default=20, help="rows of the critical path breakdown")
+    parser.add_argument("--events", type=str, default=None, help="also list events : 'all' or one event name, e.g. best_hypothesis")
+    parser.add_argument("--max_chars", type=int, default=200, help="truncate event attributes to this many characters")
+    args = parser.parse_args()
+    main(args)
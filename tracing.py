@@ -0,0 +1,145 @@
+import atexit
+import contextlib
+import contextvars
+import gzip
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+
+LEVELS = {"off": 0, "warning": 1, "info": 2, "debug": 3}
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+def encode(obj):
+    # attributes that are not JSON types : records with a JSON form (e.g. a Hypothesis) as that form, the rest as str
+    return obj.to_json() if hasattr(obj, "to_json") else str(obj)
+
+class Span:
+    def __init__(self, tracer, span_id, parent, kind, name, attrs):
+        self.tracer = tracer
+        self.id = span_id
+        self.parent = parent
+        self.kind = kind
+        self.name = name
+        self.attrs = attrs
+        self.start = tracer.now()
+        self._token = current_span.set(self)
+
+    def annotate(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, **counts):
+        # accumulates numeric attributes, e.g. the tokens of every response recorded inside an llm span
+        for key, value in counts.items():
+            self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def end(self):
+        try:
+            current_span.reset(self._token)
+        except ValueError: # ended from another context : the parent link is already recorded
+            pass
+        self.tracer.emit({"k": "span", "id": self.id, "p": self.parent, "kind": self.kind, "name": self.name, "t0": self.start, "t1": self.tracer.now(), "a": self.attrs})
+
+class NullSpan:
+    id = None
+    def annotate(self, **attrs):
+        pass
+    def add(self, **counts):
+        pass
+    def end(self):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class Tracer:
+    # nested spans (run -> goal -> iteration -> stage -> hypothesis -> llm) and events, written as compact JSONL
+    # (gzip if the path ends in .gz) by a background thread, so tracing never blocks the pipeline on file I/O.
+    # level "info" keeps spans and short events; "debug" adds prompts, responses and full reviews for a
+    # sample_rate share of the hypotheses (sampled by id, so a sampled hypothesis is traced in every stage).
+    # trace_viewer.py prints the stage timeline and critical path of a trace file
+    def __init__(self):
+        self.level = LEVELS["off"]
+        self.sample_rate = 1.0
+        self.path = None
+        self._queue = None
+        self._thread = None
+        self._ids = itertools.count(1)
+        self._start = time.monotonic()
+
+    def configure(self, path, level="info", sample_rate=1.0):
+        self.close()
+        if path is None or level == "off":
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.level = LEVELS[level]
+        self.sample_rate = sample_rate
+        self.path = path
+        self._start = time.monotonic()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, args=(path, self._queue), daemon=True)
+        self._thread.start()
+        self.emit({"k": "meta", "time": time.time(), "level": level, "sample_rate": sample_rate, "pid": os.getpid()})
+
+    def enabled(self, level="info", hyp_ids=()):
+        if LEVELS[level] > self.level:
+            return False
+        if level == "debug" and hyp_ids and self.sample_rate < 1.0:
+            return any(zlib.crc32(str(hyp_id).encode("utf-8")) % 10000 < self.sample_rate * 10000 for hyp_id in hyp_ids)
+        return True
+
+    def now(self):
+        return round(time.monotonic() - self._start, 6)
+
+    def emit(self, record):
+        trace_queue = self._queue
+        if trace_queue is not None:
+            trace_queue.put(record)
+
+    def _write(self, path, trace_queue):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "wt", encoding="utf-8") as wf:
+            while True:
+                record = trace_queue.get()
+                if record is None:
+                    return
+                wf.write(json.dumps(record, separators=(",", ":"), ensure_ascii=False, default=encode) + "\n")
+
+    def start_span(self, kind, name, **attrs):
+        # for spans that cannot be a with-block (e.g. one iteration of the main loop); end() must run in the same context
+        if not self.enabled("info"):
+            return NULL_SPAN
+        parent = current_span.get()
+        return Span(self, next(self._ids), parent.id if parent is not None else None, kind, name, attrs)
+
+    @contextlib.contextmanager
+    def span(self, kind, name, **attrs):
+        span = self.start_span(kind, name, **attrs)
+        try:
+            yield span
+        finally:
+            span.end()
+
+    def current(self):
+        return current_span.get() or NULL_SPAN
+
+    def event(self, name, level="info", hyp_ids=(), **attrs):
+        if self.enabled(level, hyp_ids):
+            parent = current_span.get()
+            self.emit({"k": "event", "p": parent.id if parent is not None else None, "t": self.now(), "name": name, "lvl": level, "a": {"hyp_ids": list(hyp_ids), **attrs} if hyp_ids else attrs})
+
+    def close(self):
+        # flushes pending records
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+        self._queue, self._thread = None, None
+        self.level = LEVELS["off"]
+
+# process-wide tracer, configured by run_pipeline (--trace_path, --trace_level, --trace_sample_rate)
+tracer = Tracer()
+atexit.register(tracer.close)
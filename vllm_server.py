@@ -0,0 +1,258 @@
+import asyncio
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pydantic import BaseModel
+
+from event_loop import llm_loop
+from gpt import SimpleResponse
+from http_pool import http_pool
+from metrics import usage_tracker
+from rate_limit import estimate_tokens
+
+class ModelVLLM:
+    # any OpenAI-compatible server (vLLM, TGI, llama.cpp, ...) reachable at base_url.
+    # concurrent ainvoke calls are micro-batched : requests arriving within batch_wait seconds are flushed together
+    # (at most max_batch_size), so the server schedules them in the same decoding batch, and identical requests
+    # (e.g. explorator sampling one prompt N times) are merged into a single request with n=<count>. the batch lives
+    # on event_loop.llm_loop : requests awaited on another loop are handed to it, so callers on every thread share it
+    def __init__(self, model_name, base_url, api_key="EMPTY", max_batch_size=32, batch_wait=0.01, guided_json=True):
+        self.model_name = model_name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.guided_json = guided_json # constrain reformat output with the server's guided decoding (vLLM extra_body)
+        self._client = None
+        self._async_client = self._async_loop = None
+        self._pending = [] # [(messages, temperature, future)] waiting for the next flush, only used on llm_loop
+        self._flush_handle = None
+        self.num_requests = 0
+        self.num_flushes = 0
+
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI # imported on first use, it is slow to import
+            self._client = OpenAI(base_url=self.base_url, api_key=self.api_key, http_client=http_pool.client())
+        return self._client
+
+    def async_client(self):
+        # bound to one event loop like the shared httpx client it wraps (see HTTPPool.async_client)
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, http_client=http_pool.async_client())
+            self._async_loop = loop
+        return self._async_client
+
+    def invoke(self, messages, temperature=0):
+        start = time.monotonic()
+        response = self.client().chat.completions.create(model=self.model_name, messages=messages, temperature=temperature)
+        usage_tracker.record_response(response, latency=time.monotonic() - start)
+        return SimpleResponse(content=response.choices[0].message.content)
+
+    async def ainvoke(self, messages, temperature=0):
+        if not llm_loop.in_loop():
+            return await llm_loop.submit(self.ainvoke(messages, temperature))
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((messages, temperature, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_wait, self.flush)
+        return SimpleResponse(content=await future)
+
+    def flush(self):
+        loop = asyncio.get_running_loop()
+        self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        groups = {}
+        for messages, temperature, future in pending:
+            group_key = json.dumps([messages, temperature], sort_keys=True, ensure_ascii=False)
+            groups.setdefault(group_key, (messages, temperature, []))[2].append(future)
+        self.num_flushes += 1
+        self.num_requests += len(groups)
+        for messages, temperature, futures in groups.values():
+            loop.create_task(self.send(messages, temperature, futures))
+
+    async def send(self, messages, temperature, futures):
+        start = time.monotonic()
+        try:
+            response = await self.async_client().chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=temperature,
+                n=len(futures),
+            )
+        except Exception as error:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        usage_tracker.record_response(response, latency=time.monotonic() - start)
+        choices = sorted(response.choices, key=lambda choice: choice.index)
+        for i, future in enumerate(futures):
+            if not future.done():
+                # servers that ignore n return a single choice, which is then shared
+                future.set_result(choices[min(i, len(choices) - 1)].message.content)
+
+    async def astream(self, messages, temperature=0):
+        # streamed requests bypass the micro-batcher, since each one can be cut at a different point
+        start = time.monotonic()
+        stream = await self.async_client().chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+        )
+        text = ""
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+            usage_tracker.record(self.model_name, estimate_tokens(messages), len(text) // 4, latency=time.monotonic() - start)
+
+    def reformat_request(self, reformat_messages, return_format: BaseModel):
+        # models without function calling get the schema in the prompt (and as a guided decoding constraint)
+        schema = return_format.schema()
+        messages = [dict(message) for message in reformat_messages]
+        messages[0]["content"] = f"{messages[0]['content']}\nJSON schema:\n{json.dumps(schema)}\n\nRespond with the JSON instance only."
+        extra_body = {"guided_json": schema} if self.guided_json else None
+        return messages, extra_body
+
+    def parse_reformat(self, content, return_format: BaseModel):
+        match = re.search(r"\{.*\}", content, re.DOTALL)
+        if not match:
+            raise ValueError(f"reformat response contains no JSON object: {content[:200]}")
+        return return_format.parse_raw(match.group(0)).dict()
+
+    def reformat(self, reformat_messages, return_format: BaseModel, temperature=0):
+        messages, extra_body = self.reformat_request(reformat_messages, return_format)
+        start = time.monotonic()
+        response = self.client().chat.completions.create(model=self.model_name, messages=messages, temperature=temperature, extra_body=extra_body)
+        usage_tracker.record_response(response, latency=time.monotonic() - start)
+        return self.parse_reformat(response.choices[0].message.content, return_format)
+
+    async def areformat(self, reformat_messages, return_format: BaseModel, temperature=0):
+        if not llm_loop.in_loop():
+            return await llm_loop.submit(self.areformat(reformat_messages, return_format, temperature))
+        messages, extra_body = self.reformat_request(reformat_messages, return_format)
+        start = time.monotonic()
+        response = await self.async_client().chat.completions.create(model=self.model_name, messages=messages, temperature=temperature, extra_body=extra_body)
+        usage_tracker.record_response(response, latency=time.monotonic() - start)
+        return self.parse_reformat(response.choices[0].message.content, return_format)
+
+    def stats(self):
+        return {"requests": self.num_requests, "flushes": self.num_flushes}
+
+def register_vllm_llm(model_name, base_url, api_key="EMPTY", max_batch_size=32, batch_wait=0.01, guided_json=True):
+    # replaces the environment-configured "vllm" backend ("vllm-gpt_reformat" shares it)
+    from models import register_llm
+
+    register_llm("vllm", lambda: ModelVLLM(model_name, base_url, api_key, max_batch_size, batch_wait, guided_json))
+
+class StandInServer:
+    # minimal OpenAI-compatible chat completions server for offline testing : answers every request with
+    # responder(body) -> content (a responder that raises gives a 500 error), supports n and stream, and keeps the
+    # received request bodies in self.requests
+    def __init__(self, responder=None, host="127.0.0.1", port=0):
+        self.responder = responder or (lambda body: f"[stand-in response to {len(body['messages'])} messages]")
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.requests.append(body)
+                try:
+                    contents = [server.responder(body) for _ in range(body.get("n") or 1)]
+                except Exception as error:
+                    self.error(500, repr(error))
+                    return
+                prompt_tokens = estimate_tokens(body["messages"])
+                completion_tokens = sum(len(content) // 4 for content in contents)
+                if body.get("stream"):
+                    self.stream(body, contents[0])
+                    return
+                payload = json.dumps({
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [{"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"} for i, content in enumerate(contents)],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+                }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def error(self, status, message):
+                payload = json.dumps({"error": {"message": message, "type": "server_error", "code": status}}).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def stream(self, body, content, chunk_size=16):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+                for i in range(0, len(content), chunk_size):
+                    chunk = {
+                        "id": chunk_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": body["model"],
+                        "choices": [{"index": 0, "delta": {"content": content[i:i + chunk_size]}, "finish_reason": None}],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()